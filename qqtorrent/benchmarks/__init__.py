@@ -0,0 +1,154 @@
+"""Microbenchmarks for qqbt hot paths.
+
+Run from the qqtorrent directory:
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --baseline baseline.json --threshold 0.2
+
+Each benchmark is a function registered with @benchmark that does its setup
+and returns (run, num_ops): run() is the code to time and num_ops how many
+operations (messages, pieces, peers...) one call of run() performs. The
+runner calls run() repeatedly for at least min_time seconds per round and
+keeps the best round, which is least disturbed by other load on the machine.
+"""
+import gc
+import sys
+import time
+import json
+import platform
+
+# Benchmark name -> function returning (run, num_ops)
+BENCHMARKS = {}
+
+DEFAULT_THRESHOLD = 0.25    # allowed slowdown vs. the baseline, as a fraction
+
+
+def benchmark(name):
+    """Register a benchmark under a dotted name, e.g. 'peer.decode'."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def time_benchmark(func, min_time=0.2, rounds=5):
+    """Time one benchmark.
+
+    Returns:
+        dict with 'seconds' (best time of one call of run), 'ops' and
+        'ops_per_sec'
+    """
+    (run, num_ops) = func()
+    run()   # warm up caches and lazy imports
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            calls = 0
+            start = time.perf_counter()
+            while True:
+                run()
+                calls += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+            per_call = elapsed / calls
+            if best is None or per_call < best:
+                best = per_call
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {'seconds': best, 'ops': num_ops, 'ops_per_sec': num_ops / best}
+
+
+def run_benchmarks(names=None, min_time=0.2, rounds=5, log=None):
+    """Run benchmarks and return a results document for save_results().
+
+    Args:
+        names (list): substrings selecting benchmarks to run; all if None
+        min_time (float): seconds to spend in each timing round
+        rounds (int): timing rounds per benchmark
+        log (function): called with a line of progress per benchmark
+    """
+    load_benchmarks()
+    results = {}
+    for name in sorted(BENCHMARKS):
+        if names and not any(n in name for n in names):
+            continue
+        result = time_benchmark(BENCHMARKS[name], min_time, rounds)
+        results[name] = result
+        if log:
+            log('%-40s %12.3f us/op %14.0f ops/s'
+                % (name, 1e6 * result['seconds'] / result['ops'],
+                   result['ops_per_sec']))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+
+
+def load_benchmarks():
+    """Import the modules that register benchmarks."""
+    from benchmarks import (bench_metainfo, bench_peer, bench_torrent,
+                            bench_tracker)
+
+
+def save_results(doc, path):
+    with open(path, 'w') as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(doc, baseline, threshold=DEFAULT_THRESHOLD,
+                    thresholds=None):
+    """Compare results against a baseline.
+
+    A benchmark regresses when it is more than its threshold slower than in
+    the baseline. Thresholds come from the thresholds argument, then the
+    baseline's own 'thresholds' dict, then the threshold argument.
+
+    Args:
+        doc (dict): results from run_benchmarks()
+        baseline (dict): earlier results, e.g. from load_results()
+        threshold (float): default allowed slowdown, e.g. 0.25 for 25%
+        thresholds (dict): benchmark name -> allowed slowdown
+
+    Returns:
+        list of (name, ratio, allowed, is_regression) tuples, where ratio is
+        new time / baseline time
+    """
+    allowed_by_name = dict(baseline.get('thresholds', {}))
+    allowed_by_name.update(thresholds or {})
+    comparison = []
+    base_results = baseline['results']
+    for (name, result) in sorted(doc['results'].items()):
+        base = base_results.get(name)
+        if base is None:
+            continue
+        ratio = ((result['seconds'] / result['ops'])
+                 / (base['seconds'] / base['ops']))
+        allowed = allowed_by_name.get(name, threshold)
+        comparison.append((name, ratio, allowed, ratio > 1 + allowed))
+    return comparison
+
+
+def format_comparison(comparison):
+    lines = []
+    for (name, ratio, allowed, is_regression) in comparison:
+        lines.append('%-40s %6.2fx (allowed %.2fx)%s'
+                     % (name, ratio, 1 + allowed,
+                        '  REGRESSION' if is_regression else ''))
+    return '\n'.join(lines)
+
+
+def log_stderr(line):
+    print(line, file=sys.stderr)
@@ -0,0 +1,54 @@
+"""Run the qqbt microbenchmarks and compare them against a baseline."""
+import sys
+import argparse
+
+from benchmarks import (run_benchmarks, save_results, load_results,
+                        compare_results, format_comparison, log_stderr,
+                        DEFAULT_THRESHOLD)
+
+
+def parse_threshold(value):
+    (name, _, allowed) = value.rpartition('=')
+    if not name:
+        raise argparse.ArgumentTypeError('expected NAME=FRACTION: %s' % value)
+    return (name, float(allowed))
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description=__doc__)
+    parser.add_argument('names', nargs='*',
+                        help='run only benchmarks whose names contain these')
+    parser.add_argument('--output', '-o', help='write results JSON here')
+    parser.add_argument('--baseline', '-b',
+                        help='results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown vs. the baseline as a '
+                             'fraction (default: %.2f)' % DEFAULT_THRESHOLD)
+    parser.add_argument('--benchmark-threshold', metavar='NAME=FRACTION',
+                        type=parse_threshold, action='append', default=[],
+                        help='allowed slowdown for one benchmark; '
+                             'may be repeated')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds per timing round (default: 0.2)')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='timing rounds per benchmark (default: 5)')
+    args = parser.parse_args(argv)
+
+    doc = run_benchmarks(args.names, args.min_time, args.rounds,
+                         log=log_stderr)
+    if args.output:
+        save_results(doc, args.output)
+    if not args.baseline:
+        return 0
+    comparison = compare_results(doc, load_results(args.baseline),
+                                 args.threshold,
+                                 dict(args.benchmark_threshold))
+    print(format_comparison(comparison))
+    return 1 if any(v[3] for v in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+from qqbt.torrent_metainfo import TorrentMetainfo
+
+from benchmarks import benchmark
+from benchmarks.fixtures import shared_torrents, make_torrent_file
+
+
+@benchmark('metainfo.parse_shared')
+def parse_shared():
+    contents = shared_torrents()
+
+    def run():
+        for data in contents:
+            TorrentMetainfo(data)
+    return (run, len(contents))
+
+
+@benchmark('metainfo.parse_100k_pieces')
+def parse_100k_pieces():
+    data = make_torrent_file(100000)
+    return (lambda: TorrentMetainfo(data), 1)
+
+
+@benchmark('metainfo.parse_100k_pieces_1k_files')
+def parse_100k_pieces_1k_files():
+    data = make_torrent_file(100000, num_files=1000)
+    return (lambda: TorrentMetainfo(data), 1)
+
+
+@benchmark('metainfo.piece_file_spans')
+def piece_file_spans():
+    metainfo = TorrentMetainfo(make_torrent_file(100000, num_files=1000))
+    num_pieces = len(metainfo.info['pieces'])
+
+    def run():
+        for i in range(0, num_pieces, 100):
+            metainfo.get_piece_file_spans(i)
+    return (run, len(range(0, num_pieces, 100)))
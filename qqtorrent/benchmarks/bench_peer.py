@@ -0,0 +1,70 @@
+import struct
+
+from qqbt.peer import TorrentPeer
+
+from benchmarks import benchmark
+from benchmarks.fixtures import make_torrent, connect_peer, message
+
+
+@benchmark('peer.build_message')
+def build_message():
+    def run():
+        for i in range(1000):
+            TorrentPeer.build_message('request', index=i, begin=2**14,
+                                      length=2**14)
+    return (run, 1000)
+
+
+@benchmark('peer.decode_message')
+def decode_message():
+    msgs = [message(6, struct.pack('!LLL', i, 0, 2**14))[4:]
+            for i in range(1000)]
+
+    def run():
+        for data in msgs:
+            TorrentPeer.decode_message(data)
+    return (run, len(msgs))
+
+
+@benchmark('peer.handle_data_received.have')
+def handle_data_received_have():
+    """Small messages arriving in recv()-sized chunks."""
+    torrent = make_torrent(4096)
+    peer = connect_peer(torrent, have_all=False, unchoke=False)
+    stream = b''.join(message(4, struct.pack('!L', i)) for i in range(4096))
+    chunks = [stream[i:i+4096] for i in range(0, len(stream), 4096)]
+
+    def run():
+        for chunk in chunks:
+            peer.handle_data_received(chunk)
+        assert peer.conn
+    return (run, 4096)
+
+
+@benchmark('peer.handle_data_received.piece')
+def handle_data_received_piece():
+    """Block messages for a piece we already have, in 4 KiB chunks."""
+    torrent = make_torrent(16)
+    peer = connect_peer(torrent)
+    torrent.complete_pieces[0] = torrent.metainfo.data
+    block = bytes(2**14)
+    stream = b''.join(message(7, struct.pack('!LL', 0, begin) + block)
+                      for begin in range(0, 2**18, 2**14))
+    chunks = [stream[i:i+4096] for i in range(0, len(stream), 4096)]
+
+    def run():
+        for chunk in chunks:
+            peer.handle_data_received(chunk)
+    return (run, 16)
+
+
+@benchmark('peer.choose_next_piece.100k')
+def choose_next_piece():
+    """Picking a piece late in a 100k piece download."""
+    torrent = make_torrent(100000, piece_length=2**14)
+    peer = connect_peer(torrent)
+    for i in range(90000):
+        torrent.complete_pieces[i] = True
+    for i in range(90000, 90100):
+        torrent.piece_requests[i].append(peer)
+    return (peer._choose_next_piece, 1)
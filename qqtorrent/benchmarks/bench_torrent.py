@@ -0,0 +1,23 @@
+from benchmarks import benchmark
+from benchmarks.fixtures import make_torrent, connect_peer
+
+NUM_PIECES = 8
+PIECE_LENGTH = 2**18
+BLOCK_LENGTH = 2**14
+
+
+@benchmark('torrent.assemble_piece')
+def assemble_piece():
+    """handle_block for every block of a piece, then hashing it."""
+    data = make_torrent(1, PIECE_LENGTH).metainfo.data
+    blocks = [(begin, data[begin:begin+BLOCK_LENGTH])
+              for begin in range(0, PIECE_LENGTH, BLOCK_LENGTH)]
+
+    def run():
+        torrent = make_torrent(NUM_PIECES, PIECE_LENGTH)
+        peer = connect_peer(torrent)
+        for i in range(NUM_PIECES):
+            for (begin, block) in blocks:
+                torrent.handle_block(peer, i, begin, block)
+        assert torrent.is_complete
+    return (run, NUM_PIECES)
@@ -0,0 +1,40 @@
+import os
+import struct
+
+from qqbt import bencode
+from qqbt.tracker import TorrentTracker
+
+from benchmarks import benchmark
+
+NUM_PEERS = 5000
+
+
+@benchmark('tracker.decode_binary_peers')
+def decode_binary_peers():
+    peers = b''.join(os.urandom(4) + struct.pack('!H', 6881 + i % 1000)
+                     for i in range(NUM_PEERS))
+    return (lambda: TorrentTracker.decode_binary_model_peers(peers),
+            NUM_PEERS)
+
+
+@benchmark('tracker.decode_dict_peers')
+def decode_dict_peers():
+    peers = [{b'ip': ('10.0.%d.%d' % (i // 256, i % 256)).encode(),
+              b'port': 6881, b'peer id': os.urandom(20)}
+             for i in range(NUM_PEERS)]
+    return (lambda: TorrentTracker.decode_dict_model_peers(peers), NUM_PEERS)
+
+
+@benchmark('tracker.decode_announce')
+def decode_announce():
+    """A whole compact announce response, bdecoding included."""
+    data = bencode.encode({
+        'interval': 1800,
+        'complete': 10,
+        'incomplete': 100,
+        'peers': os.urandom(6 * NUM_PEERS),
+    })
+
+    def run():
+        TorrentTracker.decode_announce_response(bencode.decode(data))
+    return (run, NUM_PEERS)
@@ -0,0 +1,113 @@
+"""Synthetic torrents and peers shared by the benchmarks."""
+import os
+import struct
+import hashlib
+
+from qqbt import bencode
+from qqbt.torrent import Torrent
+from qqbt.peer import TorrentPeer
+
+SHARED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', '..', 'shared')
+
+
+def shared_torrents():
+    """Contents of the sample .torrent files in shared/."""
+    contents = []
+    for filename in sorted(os.listdir(SHARED_DIR)):
+        if filename.endswith('.torrent'):
+            with open(os.path.join(SHARED_DIR, filename), 'rb') as f:
+                contents.append(f.read())
+    return contents
+
+
+def make_torrent_file(num_pieces, num_files=0, piece_length=2**18):
+    """Bencoded metainfo with random piece hashes.
+
+    Args:
+        num_pieces (int): number of pieces
+        num_files (int): number of files, or 0 for a single-file torrent
+        piece_length (int): piece length in bytes
+    """
+    length = num_pieces * piece_length
+    info = {
+        'name': 'synthetic',
+        'piece length': piece_length,
+        'pieces': os.urandom(20 * num_pieces),
+    }
+    if num_files:
+        file_length = length // num_files
+        info['files'] = [{'length': file_length,
+                          'path': ['dir%d' % (i % 10), 'file%d.bin' % i]}
+                         for i in range(num_files)]
+        info['files'][-1]['length'] += length - file_length * num_files
+    else:
+        info['length'] = length
+    return bencode.encode({'announce': 'http://tracker.example.com/announce',
+                           'info': info})
+
+
+class MetainfoMock():
+    """In-memory torrent of num_pieces pieces of known content."""
+    def __init__(self, num_pieces, piece_length=2**18, hashes=True):
+        self.info_hash = b'\x11' * 20
+        self.piece_length = piece_length
+        self.data = bytes(range(256)) * (piece_length // 256)
+        piece_hash = hashlib.sha1(self.data).digest() if hashes else bytes(20)
+        self.info = {
+            'piece_length': piece_length,
+            'length': num_pieces * piece_length,
+            'pieces': [piece_hash] * num_pieces,
+        }
+
+    def get_piece_length(self, piece_index):
+        return self.piece_length
+
+
+class ConnectionManagerMock():
+    listen_port = None
+
+    def call_later(self, delay, callback, *args):
+        return TimerMock()
+
+    def connect_peer(self, peer):
+        pass
+
+
+class TimerMock():
+    def cancel(self):
+        pass
+
+
+class ConnMock():
+    def write(self, data):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def make_torrent(num_pieces, piece_length=2**18):
+    return Torrent(ConnectionManagerMock(), MetainfoMock(num_pieces,
+                                                         piece_length))
+
+
+def connect_peer(torrent, port=6881, have_all=True, unchoke=True):
+    """A peer past the handshake, by default with every piece and having
+    unchoked us."""
+    peer = torrent.add_peer({'ip': '10.0.0.1', 'port': port})
+    peer.conn = ConnMock()
+    data = TorrentPeer.build_handshake(torrent.metainfo.info_hash,
+                                       b'-XX0000-000000000000',
+                                       TorrentPeer.build_reserved())
+    if have_all:
+        data += message(14)
+    if unchoke:
+        data += message(1)
+    peer.handle_data_received(data)
+    assert peer.conn, 'peer disconnected during setup'
+    return peer
+
+
+def message(msg_id, payload=b''):
+    return struct.pack('!LB', len(payload) + 1, msg_id) + payload
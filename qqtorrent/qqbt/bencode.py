@@ -0,0 +1,150 @@
+"""Single-pass bencode decoder.
+
+Unlike bencodepy, the decoder can report the raw byte span of any top-level
+dict value, so that e.g. a torrent's info hash can be computed directly from
+the original bytes instead of re-encoding the decoded info dict.
+"""
+
+
+def decode(data):
+    """Decode a complete bencoded value.
+
+    Args:
+        data (bytes): bencoded data
+    Returns:
+        decoded value (bytes, int, list or dict with bytes keys)
+    """
+    (value, pos) = _decode(data, 0)
+    if pos != len(data):
+        raise BencodeDecodeError('Trailing data at offset %d' % pos)
+    return value
+
+
+def decode_dict_spans(data):
+    """Decode a bencoded dict and record the byte span of each value.
+
+    Args:
+        data (bytes): bencoded data, which must be a dict
+    Returns:
+        (dict, dict): the decoded dict, and a dict mapping each key to a
+            (begin, end) tuple giving the raw span of its value in data
+    """
+    if not data or data[0:1] != b'd':
+        raise BencodeDecodeError('Expected a dict at offset 0')
+    d = {}
+    spans = {}
+    pos = 1
+    try:
+        while data[pos] != _END:
+            (key, pos) = _decode_string(data, pos)
+            begin = pos
+            (d[key], pos) = _decode(data, pos)
+            spans[key] = (begin, pos)
+    except IndexError as e:
+        raise BencodeDecodeError('Unexpected end of data') from e
+    if pos + 1 != len(data):
+        raise BencodeDecodeError('Trailing data at offset %d' % (pos + 1))
+    return (d, spans)
+
+
+def encode(value):
+    """Bencode a value.
+
+    Args:
+        value: bytes, str, int, list or dict
+    Returns:
+        bytes
+    """
+    out = []
+    _encode(value, out)
+    return b''.join(out)
+
+
+_INT = ord('i')
+_LIST = ord('l')
+_DICT = ord('d')
+_END = ord('e')
+
+
+def _decode(data, pos):
+    try:
+        c = data[pos]
+        if c == _DICT:
+            d = {}
+            pos += 1
+            while data[pos] != _END:
+                (key, pos) = _decode_string(data, pos)
+                (d[key], pos) = _decode(data, pos)
+            return (d, pos + 1)
+        elif c == _LIST:
+            v = []
+            pos += 1
+            while data[pos] != _END:
+                (item, pos) = _decode(data, pos)
+                v.append(item)
+            return (v, pos + 1)
+        elif c == _INT:
+            end = data.find(b'e', pos)
+            if end < 0:
+                raise BencodeDecodeError('Unterminated integer')
+            try:
+                return (int(data[pos+1:end]), end + 1)
+            except ValueError as e:
+                raise BencodeDecodeError(
+                    'Invalid integer at offset %d' % pos) from e
+        else:
+            return _decode_string(data, pos)
+    except IndexError as e:
+        raise BencodeDecodeError('Unexpected end of data') from e
+
+
+def _decode_string(data, pos):
+    try:
+        colon = data.index(b':', pos)
+    except ValueError as e:
+        raise BencodeDecodeError(
+            'Invalid string at offset %d' % pos) from e
+    try:
+        length = int(data[pos:colon])
+    except ValueError as e:
+        raise BencodeDecodeError(
+            'Invalid string length at offset %d' % pos) from e
+    begin = colon + 1
+    end = begin + length
+    if length < 0 or end > len(data):
+        raise BencodeDecodeError('Invalid string length at offset %d' % pos)
+    return (bytes(data[begin:end]), end)
+
+
+def _encode(value, out):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        out.append(b'%d:' % len(value))
+        out.append(value)
+    elif isinstance(value, str):
+        _encode(value.encode('utf-8'), out)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        out.append(b'i%de' % value)
+    elif isinstance(value, (list, tuple)):
+        out.append(b'l')
+        for v in value:
+            _encode(v, out)
+        out.append(b'e')
+    elif isinstance(value, dict):
+        out.append(b'd')
+        items = [(k.encode('utf-8') if isinstance(k, str) else k, v)
+                 for k, v in value.items()]
+        for k, v in sorted(items, key=lambda kv: kv[0]):
+            _encode(k, out)
+            _encode(v, out)
+        out.append(b'e')
+    else:
+        raise BencodeEncodeError('Cannot encode: %r' % (value,))
+
+
+class BencodeDecodeError(ValueError):
+    pass
+
+
+class BencodeEncodeError(ValueError):
+    pass
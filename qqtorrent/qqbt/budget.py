@@ -0,0 +1,103 @@
+"""Client-wide budget for downloaded data held in memory.
+
+Data is in flight from the time a block is received until its piece is on
+disk: blocks of partial pieces (including pieces waiting to be verified, and
+blocks of failed pieces kept to find who sent bad data) and verified pieces
+the write-back cache has not flushed yet. Torrents add and release the bytes
+they hold; other holders, like the write cache, are registered as sources.
+A source can also have a limit of its own, like the write cache's budget
+for pieces not yet on disk, which holds back new pieces the same way.
+
+Backpressure is applied where the download starts: while the budget is
+full, peers don't start new pieces, and wait until it drains below
+resume_bytes. Pieces already in progress are finished, which frees their
+blocks for the disk, so the budget can be exceeded by at most one piece per
+downloading peer. That includes partial pieces whose peer went away: other
+peers may still pick those up, or they would hold the budget forever.
+Stopped torrents are not charged for their partial pieces.
+"""
+import logging
+
+from qqbt.config import CONFIG
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05    # seconds between checks while peers are waiting
+
+
+class MemoryBudget():
+    def __init__(self, conn_man, max_bytes=None, resume_fraction=0.75):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop to poll on
+            max_bytes (int): in-flight bytes at which new pieces are held
+                back; defaults to CONFIG['inflight_bytes']
+            resume_fraction (float): waiting peers resume once usage drops
+                to this fraction of max_bytes
+        """
+        self.conn_man = conn_man
+        self.max_bytes = (CONFIG['inflight_bytes'] if max_bytes is None
+                          else max_bytes)
+        self.resume_fraction = resume_fraction
+        self.resume_bytes = int(self.max_bytes * resume_fraction)
+        self.used_bytes = 0
+        self.sources = []
+        self.limits = []        # (get_bytes, max_bytes)
+        self.waiters = []
+        self.poll_timer = None
+
+    def add_source(self, get_bytes):
+        """Count the bytes returned by get_bytes() against the budget."""
+        self.sources.append(get_bytes)
+
+    def add_limit(self, get_bytes, max_bytes):
+        """Also count the budget full while get_bytes() is at least
+        max_bytes."""
+        self.limits.append((get_bytes, max_bytes))
+
+    def add(self, num_bytes):
+        self.used_bytes += num_bytes
+
+    def release(self, num_bytes):
+        self.used_bytes -= num_bytes
+
+    def get_used_bytes(self):
+        return self.used_bytes + sum(f() for f in self.sources)
+
+    def is_full(self):
+        return (self.get_used_bytes() >= self.max_bytes
+                or any(f() >= n for (f, n) in self.limits))
+
+    def is_drained(self):
+        return (self.get_used_bytes() <= self.resume_bytes
+                and all(f() <= n * self.resume_fraction
+                        for (f, n) in self.limits))
+
+    def wait(self, callback):
+        """Call callback() from the event loop once the budget drains."""
+        if not self.waiters:
+            log.info('Memory budget full (%d bytes), holding back requests'
+                     % self.get_used_bytes())
+        if callback not in self.waiters:
+            self.waiters.append(callback)
+        if self.poll_timer is None:
+            self.poll_timer = self.conn_man.call_later(POLL_INTERVAL,
+                                                       self.poll)
+
+    def poll(self):
+        self.poll_timer = None
+        if not self.is_drained():
+            self.poll_timer = self.conn_man.call_later(POLL_INTERVAL,
+                                                       self.poll)
+            return
+        log.info('Memory budget drained, resuming %d peers'
+                 % len(self.waiters))
+        (waiters, self.waiters) = (self.waiters, [])
+        for callback in waiters:
+            callback()
+
+    def close(self):
+        if self.poll_timer:
+            self.poll_timer.cancel()
+            self.poll_timer = None
+        self.waiters = []
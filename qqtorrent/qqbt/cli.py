@@ -3,17 +3,49 @@ import sys
 import argparse
 import logging
 
+from qqbt.config import CONFIG
+from qqbt.conn import BACKENDS
 from qqbt.client import QqbtClient
+from qqbt.torrent import FILE_PRIORITIES
+from qqbt.daemon import ControlServer
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('torrent', help='.torrent metainfo file')
+    parser.add_argument('torrent', nargs='?', help='.torrent metainfo file')
     parser.add_argument('-t', '--torrent2',
                         help='other .torrent metainfo file')
     parser.add_argument('--outdir', type=str, help='output directory')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory for cached metainfo and state')
+    parser.add_argument('--piece-store', metavar='DIR', type=str,
+                        help='reuse data downloaded for other torrents, '
+                             'indexed by hash in this directory')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='connection backend (default: %s)'
+                             % CONFIG['concurrency_mode'])
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes to shard torrents '
+                             'across (default: run in this process)')
+    parser.add_argument('--max-active', type=int,
+                        help='torrents to run at once; the rest are queued '
+                             '(default: %d)' % CONFIG['max_active_torrents'])
+    parser.add_argument('--file-priority', metavar='FILE=PRIORITY',
+                        action='append', default=[],
+                        help='priority of a file of the torrent, by path or '
+                             'index: %s; may be repeated'
+                             % ', '.join(sorted(FILE_PRIORITIES)))
+    parser.add_argument('--dht', default=None, action='store_true',
+                        help='also find peers on the DHT')
+    parser.add_argument('--utp', default=None, action='store_true',
+                        help='also connect to peers over uTP')
+    parser.add_argument('--lsd', default=None, action='store_true',
+                        help='also find peers on the local network')
+    parser.add_argument('--daemon', metavar='SOCKET', type=str,
+                        help='keep running and accept commands on this '
+                             'Unix-domain socket (see qqbt.ctl)')
     parser.add_argument('--hello', default=False, action='store_true')
     parser.add_argument('--verbose', '-v', default=False, action='store_true')
     args = parser.parse_args(argv)
@@ -27,8 +59,31 @@ def main(argv=None):
     else:
         logging.basicConfig(level=logging.INFO)
 
-    client = QqbtClient(outdir=args.outdir)
-    client.add_torrent(args.torrent)
+    if not args.torrent and not args.daemon:
+        parser.error('a torrent is required unless running with --daemon')
+    file_priorities = []
+    for v in args.file_priority:
+        (file, _, name) = v.rpartition('=')
+        if not file or name not in FILE_PRIORITIES:
+            parser.error('invalid --file-priority: %s' % v)
+        file_priorities.append((int(file) if file.isdigit() else file,
+                                FILE_PRIORITIES[name]))
+
+    client = QqbtClient(outdir=args.outdir, cache_dir=args.cache_dir,
+                        num_workers=args.workers, backend=args.backend,
+                        dht=args.dht, max_active=args.max_active,
+                        utp=args.utp, lsd=args.lsd,
+                        piece_store_dir=args.piece_store)
+    if args.daemon:
+        client.keep_running = True
+        ControlServer(client, args.daemon)
+    if args.torrent:
+        torrent = client.add_torrent(args.torrent)
+        for (file, priority) in file_priorities:
+            try:
+                client.set_file_priority(torrent, file, priority)
+            except (KeyError, IndexError) as e:
+                parser.error('--file-priority: %s' % e)
     if args.torrent2:
         client.add_torrent(args.torrent2)
     client.start_torrents()
@@ -1,9 +1,15 @@
 import os
 import logging
 
+from qqbt.config import CONFIG
 from qqbt.torrent_metainfo import TorrentMetainfo
+from qqbt.metainfo_cache import MetainfoCache
 from qqbt.torrent import Torrent
+from qqbt.peer import InboundPeerHandshake
 from qqbt.conn import ConnectionManager
+from qqbt.storage import TorrentStorage, WriteBackCache
+from qqbt.budget import MemoryBudget
+from qqbt.scheduler import TorrentScheduler, PRIORITY_NORMAL
 
 log = logging.getLogger(__name__)
 
@@ -15,68 +21,394 @@ class QqbtClient():
     a torrent.  All CLI or GUI entry points should interface only with this
     class. All file operations should happen only within this class.
     """
-    def __init__(self, outdir=None):
+    def __init__(self, outdir=None, cache_dir=None, num_workers=0,
+                 backend=None, listen_port=None, dht=None, max_active=None,
+                 utp=None, lsd=None, piece_store_dir=None):
+        """
+        Args:
+            outdir (str): output directory
+            cache_dir (str): directory for cached metainfo and state,
+                including each torrent's fast-resume file
+            num_workers (int): if nonzero, run torrents in this many worker
+                processes instead of in this process
+            backend (str): connection backend name (see qqbt.conn);
+                defaults to CONFIG['concurrency_mode']
+            listen_port (int): port for inbound peer connections; defaults
+                to CONFIG['listen_port'], 0 picks any free port. With worker
+                processes, worker i listens on listen_port + 1 + i.
+            dht (bool): find peers on the DHT; defaults to
+                CONFIG['dht_enabled']. The routing table is kept in
+                cache_dir if given.
+            max_active (int): torrents to run at once, the rest are queued;
+                defaults to CONFIG['max_active_torrents']
+            utp (bool): also accept and dial peers over uTP, on the UDP port
+                numbered like the listen port (shared with the DHT);
+                defaults to CONFIG['utp_enabled']
+            lsd (bool): announce torrents and find peers on the local
+                network (BEP 14); defaults to CONFIG['lsd_enabled']
+            piece_store_dir (str): directory of a piece store shared by all
+                torrents, to take data already downloaded for other
+                torrents from instead of the network
+        """
         self.active_torrents = []
         self.finished_torrents = []
+        self.failed_torrents = []
+        self.torrents_by_info_hash = {}
+        if listen_port is None:
+            listen_port = CONFIG['listen_port']
         self.outdir = outdir
-        self.conn_man = ConnectionManager()
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.keep_running = False
+        self.dht = None
+        self.utp = None
+        self.web_seed_pool = None
+        self.lsd = None
+        self.scheduler = None
+        if dht is None:
+            dht = CONFIG['dht_enabled']
+        if utp is None:
+            utp = CONFIG['utp_enabled']
+        if lsd is None:
+            lsd = CONFIG['lsd_enabled']
+        self.conn_man = ConnectionManager(backend)
+        self.metainfo_cache = MetainfoCache(cache_dir) if cache_dir else None
+        self.piece_store = None
+        if num_workers:
+            from qqbt.workers import WorkerPool
+            self.worker_pool = WorkerPool(
+                num_workers, self, outdir=outdir, cache_dir=cache_dir,
+                backend=backend, listen_port=listen_port, dht=dht,
+                max_active=max_active, utp=utp, lsd=lsd,
+                piece_store_dir=piece_store_dir)
+            self.write_cache = None
+            self.budget = None
+        else:
+            self.worker_pool = None
+            self.write_cache = WriteBackCache()
+            self.budget = MemoryBudget(self.conn_man)
+            self.budget.add_source(self.write_cache.get_dirty_bytes)
+            # The write cache doesn't wait for the disk; requests do.
+            self.budget.add_limit(self.write_cache.get_dirty_bytes,
+                                  self.write_cache.max_bytes)
+            if piece_store_dir:
+                from qqbt.piecestore import PieceStore
+                self.piece_store = PieceStore(piece_store_dir)
+            self.scheduler = TorrentScheduler(
+                self.conn_man, max_active=max_active,
+                on_failed_torrent=self.on_failed_torrent)
+            try:
+                self.conn_man.listen(listen_port, self.make_inbound_peer)
+            except OSError as e:
+                log.warning('Cannot listen on port %d: %s' % (listen_port, e))
+            if dht:
+                self.start_dht(cache_dir)
+            if utp:
+                self.start_utp()
+            if lsd:
+                self.start_lsd()
+
+    def start_dht(self, cache_dir):
+        from qqbt.dht import DHTNode
+        # The DHT conventionally shares the TCP listen port number.
+        port = getattr(self.conn_man, 'listen_port', None) or 0
+        state_path = (os.path.join(cache_dir, 'dht-%d.state' % port)
+                      if cache_dir and port else None)
+        try:
+            self.dht = DHTNode(self.conn_man, port, state_path=state_path)
+        except OSError as e:
+            log.warning('Cannot start DHT on port %d: %s' % (port, e))
+            return
+        self.dht.bootstrap()
+
+    def start_utp(self):
+        from qqbt.utp import UTPSocketManager
+        try:
+            if self.dht:
+                # One UDP socket for both, as other clients do.
+                self.utp = UTPSocketManager(self.conn_man, sock=self.dht.sock)
+                self.dht.on_other_datagram = self.utp.handle_datagram
+            else:
+                port = getattr(self.conn_man, 'listen_port', None) or 0
+                self.utp = UTPSocketManager(self.conn_man, port)
+        except OSError as e:
+            log.warning('Cannot start uTP: %s' % e)
+            return
+        self.utp.listen(self.make_inbound_peer)
+
+    def start_lsd(self):
+        from qqbt.lsd import LocalServiceDiscovery
+        port = getattr(self.conn_man, 'listen_port', None)
+        if not port:
+            log.warning('Not starting LSD: not listening for peers')
+            return
+        try:
+            self.lsd = LocalServiceDiscovery(self.conn_man, port,
+                                             self.handle_local_peer)
+        except OSError as e:
+            log.warning('Cannot start LSD: %s' % e)
+
+    def handle_local_peer(self, info_hash, ip, port):
+        torrent = self.find_torrent(info_hash)
+        if torrent:
+            torrent.add_local_peer(ip, port)
 
-    def add_torrent(self, filename):
-        with open(filename, 'rb') as f:
-            contents = f.read()
+    def get_web_seed_pool(self, metainfo):
+        """Return the pool shared by all web seeds, if metainfo has any."""
+        if not metainfo.url_list:
+            return None
+        if self.web_seed_pool is None:
+            from qqbt.webseed import WebSeedPool
+            self.web_seed_pool = WebSeedPool(self.conn_man)
+        return self.web_seed_pool
 
+    def get_resume_path(self, metainfo):
+        if not self.cache_dir:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir,
+                            metainfo.info_hash.hex() + '.resume')
+
+    def add_torrent(self, filename, priority=PRIORITY_NORMAL):
         # TODO: comprehensively handle errors
-        metainfo = TorrentMetainfo(contents)
-        torrent = Torrent(
-            self.conn_man, metainfo, self.on_completed_torrent,
-            self.on_completed_piece)
+        if self.metainfo_cache:
+            metainfo = self.metainfo_cache.load_metainfo(filename)
+        else:
+            with open(filename, 'rb') as f:
+                contents = f.read()
+            metainfo = TorrentMetainfo(contents)
+        torrent = self.find_torrent(metainfo.info_hash)
+        if torrent:
+            # A second Torrent would download into the same files.
+            log.info('add_torrent: %s already added' % torrent)
+            return torrent
+
+        if self.worker_pool:
+            torrent = self.worker_pool.add_torrent(filename, metainfo)
+        else:
+            storage = TorrentStorage(metainfo, self.write_cache, self.outdir)
+            torrent = Torrent(
+                self.conn_man, metainfo, self.on_completed_torrent,
+                self.on_completed_piece, storage=storage, dht=self.dht,
+                utp=self.utp, web_seeds=self.get_web_seed_pool(metainfo),
+                budget=self.budget, lsd=self.lsd,
+                piece_store=self.piece_store,
+                resume_path=self.get_resume_path(metainfo),
+                on_start_failed=self.on_start_failed)
+            torrent.load_resume()
+            self.scheduler.add(torrent, priority)
         self.active_torrents.append(torrent)
+        self.torrents_by_info_hash[metainfo.info_hash] = torrent
+        return torrent
 
     def start_torrents(self):
-        for torrent in self.active_torrents:
-            torrent.start_torrent()
+        if self.worker_pool:
+            self.worker_pool.run()
+            return
+        self.scheduler.start()
         self.conn_man.start_event_loop()
 
-    def on_completed_piece(self, torrent):
+    def start_torrent(self, torrent):
+        """Schedule a torrent added while the event loop is running."""
+        if not self.worker_pool:
+            self.scheduler.reschedule()
+
+    def set_priority(self, torrent, priority):
+        if self.scheduler:
+            self.scheduler.set_priority(torrent, priority)
+            self.scheduler.reschedule()
+
+    def set_file_priority(self, torrent, file, priority):
+        """Set the priority of one file of a torrent.
+
+        Args:
+            torrent (Torrent): torrent added to this client
+            file (int or str): file index, or path within the torrent
+            priority (int): a scheduler priority, or PRIORITY_SKIP to leave
+                the file out
+        """
+        if isinstance(file, str):
+            file = torrent.metainfo.get_file_index(file)
+        if self.worker_pool:
+            self.worker_pool.send_command(torrent, 'file_priority', file,
+                                          priority)
+            return
+        was_complete = torrent.is_complete
+        torrent.set_file_priority(file, priority)
+        if was_complete and not torrent.is_complete:
+            # Files that were skipped are wanted now: queue it again.
+            torrent.stop_torrent()
+            self.finished_torrents.remove(torrent)
+            self.active_torrents.append(torrent)
+            self.scheduler.add(torrent)
+            self.scheduler.reschedule()
+        elif not torrent.is_complete and torrent.is_wanted_complete():
+            torrent.handle_completed_torrent()
+
+    def open_stream(self, torrent, file=0, timeout=None):
+        """Open a file of a torrent for reading while it downloads.
+
+        Pieces ahead of the stream's position are fetched first, and reads
+        block until the data they need is verified (see qqbt.stream).
+
+        Args:
+            torrent (Torrent): torrent added to this client
+            file (int or str): file index, or path within the torrent
+            timeout (float): seconds a read may wait, or None for no limit
+
+        Returns:
+            TorrentStream: seekable, read-only raw file object
+        """
+        if self.worker_pool:
+            raise ValueError('Streaming needs torrents run in this process')
+        from qqbt.stream import TorrentStream
+        if isinstance(file, str):
+            file = torrent.metainfo.get_file_index(file)
+        return TorrentStream(torrent, file, timeout=timeout)
+
+    def find_torrent(self, info_hash):
+        return self.torrents_by_info_hash.get(info_hash)
+
+    def make_inbound_peer(self, ip, port):
+        return InboundPeerHandshake(ip, port, self.find_inbound_peer)
+
+    def find_inbound_peer(self, info_hash, ip, port):
+        """Route an inbound connection to its torrent by info hash."""
+        torrent = self.torrents_by_info_hash.get(info_hash)
+        if torrent is None:
+            return None
+        return torrent.accept_inbound_peer(ip, port)
+
+    def pause_torrent(self, torrent):
+        if self.worker_pool:
+            self.worker_pool.send_command(torrent, 'pause')
+            torrent.is_paused = True
+        else:
+            torrent.stop_torrent()
+            torrent.is_paused = True
+            self.scheduler.reschedule()
+
+    def resume_torrent(self, torrent):
+        """Unpause a torrent, or queue one that failed to start again."""
+        if torrent in self.failed_torrents:
+            self.failed_torrents.remove(torrent)
+            self.active_torrents.append(torrent)
+        if self.worker_pool:
+            self.worker_pool.send_command(torrent, 'resume')
+            torrent.is_paused = False
+        else:
+            torrent.is_paused = False
+            if self.scheduler.is_failed(torrent):
+                self.scheduler.retry(torrent)
+            self.scheduler.reschedule()
+
+    def remove_torrent(self, torrent):
+        if self.worker_pool:
+            self.worker_pool.send_command(torrent, 'remove')
+        else:
+            self.scheduler.remove(torrent)
+            torrent.stop_torrent()
+            torrent.close_streams()
+            torrent.discard_partial_pieces()
+            torrent.storage.close()
+            self.scheduler.reschedule()
+        for torrents in (self.active_torrents, self.finished_torrents,
+                         self.failed_torrents):
+            if torrent in torrents:
+                torrents.remove(torrent)
+        del self.torrents_by_info_hash[torrent.metainfo.info_hash]
+
+    def get_status(self):
+        """Return a status dict for each torrent."""
+        status = []
+        for torrent in (self.active_torrents + self.finished_torrents
+                        + self.failed_torrents):
+            if torrent.is_complete:
+                state = 'complete'
+            elif torrent in self.failed_torrents:
+                state = 'failed'
+            elif torrent.is_paused:
+                state = 'paused'
+            elif self.scheduler and self.scheduler.is_queued(torrent):
+                state = 'queued'
+            else:
+                state = 'active'
+            status.append({
+                'name': torrent.metainfo.name,
+                'info_hash': torrent.metainfo.info_hash.hex(),
+                'state': state,
+                'num_complete': torrent.get_num_complete(),
+                'num_pieces': len(torrent.metainfo.info['pieces'])
+            })
+        return status
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() from the running loop when fileobj is readable."""
+        if self.worker_pool:
+            self.worker_pool.add_reader(fileobj, callback)
+        else:
+            self.conn_man.add_reader(fileobj, callback)
+
+    def remove_reader(self, fileobj):
+        if self.worker_pool:
+            self.worker_pool.remove_reader(fileobj)
+        else:
+            self.conn_man.remove_reader(fileobj)
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) from the running loop after delay seconds."""
+        if self.worker_pool:
+            return self.worker_pool.call_later(delay, callback, *args)
+        return self.conn_man.call_later(delay, callback, *args)
+
+    def on_completed_piece(self, torrent, piece_index):
         print('%s: %s' % (torrent, torrent.get_progress_string()))
 
     def on_completed_torrent(self, torrent, data):
         print('Torrent completed!')
-        if torrent.metainfo.info['format'] == 'SINGLE_FILE':
-            self._save_single_file(torrent, data)
-        else:
-            self._save_multiple_file(torrent, data)
+        if torrent.storage:
+            torrent.storage.close()
 
         self.active_torrents.remove(torrent)
         self.finished_torrents.append(torrent)
+        if self.scheduler:
+            self.scheduler.remove(torrent)
+            self.scheduler.reschedule()
+
+        if not self.active_torrents:
+            self.on_all_torrents_completed()
+
+    def on_start_failed(self, torrent, error):
+        self.scheduler.handle_start_failure(torrent, error)
+        self.scheduler.reschedule()
 
+    def on_failed_torrent(self, torrent):
+        # Kept listed as failed; resume_torrent queues it again.
+        if torrent in self.active_torrents:
+            self.active_torrents.remove(torrent)
+            self.failed_torrents.append(torrent)
         if not self.active_torrents:
             self.on_all_torrents_completed()
 
     def on_all_torrents_completed(self):
-        self.conn_man.stop_event_loop()
+        if not self.keep_running:
+            self.stop()
 
-    def _save_single_file(self, torrent, data):
-        (_, filename) = os.path.split(torrent.metainfo.name)
-        filepath = (os.path.join(os.path.expanduser(self.outdir), filename)
-                    if self.outdir else filename)
-        with open(filepath, 'wb') as f:
-            f.write(data)
-        log.info('save_single_file: %s' % filepath)
-
-    def _save_multiple_file(self, torrent, data):
-        begin = 0
-        base_dir = torrent.metainfo.name
-        base_dir = (os.path.join(os.path.expanduser(self.outdir), base_dir)
-                    if self.outdir else base_dir)
-        for file_dict in torrent.metainfo.info['files']:
-            filepath = os.path.join(base_dir, file_dict['path'])
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            file_data = data[begin: begin+file_dict['length']]
-            with open(filepath, 'wb') as f:
-                f.write(file_data)
-            log.info('save_multiple_file: %s' % filepath)
-            begin += file_dict['length']
-
-        if begin != len(data):
-            log.warn('begin != len(data)')
+    def stop(self):
+        if self.worker_pool:
+            self.worker_pool.stop()
+        else:
+            self.scheduler.stop()
+            for torrent in self.active_torrents:
+                if torrent.is_running:
+                    torrent.save_resume(flush=True)
+            self.budget.close()
+            self.write_cache.close()
+        if self.utp:
+            self.utp.close()
+        if self.web_seed_pool:
+            self.web_seed_pool.close()
+        if self.lsd:
+            self.lsd.close()
+        if self.dht:
+            self.dht.close()
+        self.conn_man.stop_event_loop()
@@ -2,6 +2,36 @@
 
 CONFIG = {
     'peer_id': b'QQ-0000-000000000000',
+    'concurrency_mode': 'select',
     'block_length': 2**14,
-    'max_peers': 8
+    'max_peers': 8,
+    'max_connections': 200,
+    'max_active_torrents': 8,
+    'scheduler_interval': 10,
+    'stall_timeout': 300,
+    'start_retries': 5,
+    'start_retry_delay': 30,
+    'resume_interval': 60,
+    'max_known_peers': 200,
+    'listen_port': 6881,
+    'keepalive_interval': 120,
+    'peer_idle_timeout': 180,
+    'peer_tick_interval': 30,
+    'connect_interval': 15,
+    'request_timeout': 30,
+    'connect_timeout': 10,
+    'write_buffer_bytes': 2**18,
+    'rotate_interval': 60,
+    'max_hash_failures': 2,
+    'announce_retry_interval': 300,
+    'write_cache_bytes': 64 * 2**20,
+    'inflight_bytes': 128 * 2**20,
+    'stream_window_bytes': 8 * 2**20,
+    'dht_enabled': False,
+    'utp_enabled': False,
+    'lsd_enabled': False,
+    'lsd_interval': 300,
+    'web_seed_requests': 4,
+    'dht_bootstrap': [('router.bittorrent.com', 6881),
+                      ('dht.transmissionbt.com', 6881)]
 }
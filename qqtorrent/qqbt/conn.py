@@ -5,26 +5,104 @@ The peer networking functionality has three entirely entirely separate implement
     2. using Twisted, which is a library that provides everything in (1)
     3. using threads, with a separate thread for each connection to handle the
        blocking I/O, and the event loop reading back results through queues
+
+Backends are registered by name in BACKENDS and imported only when selected,
+so that e.g. Twisted is never loaded unless the 'twisted' backend is used.
+(1) lives in this module, (2) in conn_twisted and (3) in conn_threads.
 """
 import logging
+import importlib
 import selectors
 import socket
 import queue
-import time
-import threading
-from twisted.internet import protocol, reactor
+
+from qqbt.config import CONFIG
+from qqbt.timers import TimerQueue
 
 log = logging.getLogger(__name__)
 
-concurrency_mode = 'select'
-#concurrency_mode = 'twisted'
-#concurrency_mode = 'threads'
+# Backend name -> 'module:class' of its connection manager.
+BACKENDS = {
+    'select': 'qqbt.conn:ConnectionManagerSelect',
+    'twisted': 'qqbt.conn_twisted:ConnectionManagerTwisted',
+    'threads': 'qqbt.conn_threads:ConnectionManagerThreaded',
+}
+
+
+def register_backend(name, path):
+    """Register a connection manager class given as 'module:class'."""
+    BACKENDS[name] = path
+
+
+def get_backend(name=None):
+    """Import and return the connection manager class for a backend.
+
+    Args:
+        name (str): backend name; defaults to CONFIG['concurrency_mode']
+    """
+    if name is None:
+        name = CONFIG['concurrency_mode']
+    try:
+        (module_name, class_name) = BACKENDS[name].split(':')
+    except KeyError:
+        raise ConnectionBackendError('Unknown backend: %s' % name)
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        raise ConnectionBackendError(
+            'Backend %s is unavailable: %s' % (name, e)) from e
+    return getattr(module, class_name)
+
+
+def ConnectionManager(backend=None):
+    """Create a connection manager for the selected backend."""
+    return get_backend(backend)()
 
 
 class ConnectionManagerBase():
     def connect_peer(peer):
         raise NotImplementedError
 
+    def add_reader(fileobj, callback):
+        """Call callback() from the event loop whenever fileobj is readable."""
+        raise NotImplementedError
+
+    def remove_reader(fileobj):
+        raise NotImplementedError
+
+    def listen(port, make_peer):
+        """Accept inbound peer connections on port.
+
+        make_peer(ip, port) is called for each accepted connection and returns
+        the peer object to receive its callbacks; the peer may hand the
+        connection to another peer by setting conn.peer. The bound port is
+        stored in listen_port.
+        """
+        raise NotImplementedError
+
+    def call_later(delay, callback, *args):
+        """Call callback(*args) from the event loop after delay seconds.
+
+        Returns a timer object whose cancel() unschedules the call.
+        """
+        raise NotImplementedError
+
+    def call_every(interval, callback, *args):
+        """Call callback(*args) every interval seconds until cancelled."""
+        raise NotImplementedError
+
+    # Optional: backends with a thread pool provide run_in_thread, which
+    # runs func(*args) off the loop thread and then calls callback(result)
+    # from the event loop; piece hashing uses it when available.
+    def run_in_thread(callback, func, *args):
+        raise NotImplementedError
+
+    # Optional: call_from_thread may be called from any thread, and calls
+    # callback(*args) from the event loop soon after; streams read on other
+    # threads use it to have the loop check pieces.
+    def call_from_thread(callback, *args):
+        raise NotImplementedError
+
     def start_event_loop():
         raise NotImplementedError
 
@@ -45,8 +123,19 @@ class PeerConnectionBase():
 class ConnectionManagerSelect():
     def __init__(self):
         self.sel = selectors.DefaultSelector()
+        self.timers = TimerQueue()
         self.conns = []
         self.loop_active = False
+        self.listen_sock = None
+        self.listen_port = None
+        # Calls queued by other threads, and a socket pair to wake the loop
+        # up for them.
+        self.thread_calls = queue.SimpleQueue()
+        (self.wakeup_sock, self.wakeup_send_sock) = socket.socketpair()
+        self.wakeup_sock.setblocking(False)
+        self.wakeup_send_sock.setblocking(False)
+        self.sel.register(self.wakeup_sock, selectors.EVENT_READ,
+                          lambda sock, mask: self.run_thread_calls())
 
     def connect_peer(self, peer):
         try:
@@ -56,27 +145,92 @@ class ConnectionManagerSelect():
 
         self.conns.append(conn)
 
+    def add_reader(self, fileobj, callback):
+        self.sel.register(fileobj, selectors.EVENT_READ,
+                          lambda fileobj, mask: callback())
+
+    def remove_reader(self, fileobj):
+        self.sel.unregister(fileobj)
+
+    def listen(self, port, make_peer):
+        self.listen_sock = create_listen_socket(port)
+        self.listen_port = self.listen_sock.getsockname()[1]
+        self.sel.register(
+            self.listen_sock, selectors.EVENT_READ,
+            lambda sock, mask: self.handle_accept(make_peer))
+
+    def handle_accept(self, make_peer):
+        try:
+            (sock, (ip, port)) = self.listen_sock.accept()
+        except BlockingIOError:
+            return
+        conn = PeerConnectionSelect(self.sel, make_peer(ip, port), sock=sock)
+        self.conns.append(conn)
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        return self.timers.call_every(interval, callback, *args)
+
+    def call_from_thread(self, callback, *args):
+        self.thread_calls.put((callback, args))
+        try:
+            self.wakeup_send_sock.send(b'\0')
+        except BlockingIOError:
+            # Already full of wakeups the loop hasn't read yet.
+            pass
+
+    def run_thread_calls(self):
+        try:
+            while self.wakeup_sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                (callback, args) = self.thread_calls.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args)
+
     def start_event_loop(self):
         self.loop_active = True
         while self.loop_active:
-            events = self.sel.select()
+            events = self.sel.select(self.timers.next_timeout())
             for key, mask in events:
                 callback = key.data
                 callback(key.fileobj, mask)
+            self.timers.run_expired()
 
     def stop_event_loop(self):
         for conn in self.conns:
             conn.disconnect()
+        if self.listen_sock:
+            self.sel.unregister(self.listen_sock)
+            self.listen_sock.close()
+            self.listen_sock = None
         self.loop_active = False
 
 
 class PeerConnectionSelect():
-    def __init__(self, sel, peer):
+    def __init__(self, sel, peer, sock=None):
+        """
+        Args:
+            sel (selectors.BaseSelector): event loop selector
+            peer (TorrentPeer): peer receiving connection callbacks
+            sock (socket.socket): already connected (accepted) socket; if
+                None, connect to the peer
+        """
         log.debug('PeerConnectionSelect.__init__: %s' % peer)
         self.sel = sel
         self.peer = peer
         self.write_queue = queue.Queue()
-        self.connect()
+        if sock:
+            self.sock = sock
+            self.handle_connected()
+        else:
+            self.connect()
 
     def connect(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -86,7 +240,9 @@ class PeerConnectionSelect():
         except OSError:
             self.handle_connection_failed()
             raise PeerConnectionFailedError
+        self.handle_connected()
 
+    def handle_connected(self):
         self.sock.setblocking(False)
         self.sel.register(
             self.sock, selectors.EVENT_READ, self.handle_event)
@@ -159,228 +315,18 @@ class PeerConnectionSelect():
         self.sock = None
 
 
-class PeerConnectionFailedError(Exception):
-    pass
-
-# =============================================================================
-
-
-class PeerConnectionProtocol(protocol.Protocol):
-    def connectionMade(self):
-        #log.debug('%s: connectionMade' % self.factory.peer)
-        self.factory.peer.handle_connection_made(self)
-
-    def dataReceived(self, data):
-        #log.debug('%s: dataReceived' % self.factory.peer)
-        self.factory.peer.handle_data_received(data)
-
-    def connectionLost(self, reason):
-        pass
-
-    def write(self, data):
-        self.transport.write(data)
-
-    def disconnect(self):
-        self.transport.loseConnection()
-
-
-class PeerConnectionFactory(protocol.ClientFactory):
-    protocol = PeerConnectionProtocol
-
-    def __init__(self, peer):
-        self.peer = peer
-
-    def clientConnectionFailed(self, connector, reason):
-        #log.warn('%s: clientConnectionFailed: %s' % (self.peer, reason))
-        self.peer.handle_connection_failed()
-
-    def clientConnectionLost(self, connector, reason):
-        #log.warn('%s: clientConnectionLost: %s' % (self.peer, reason))
-        self.peer.handle_connection_lost()
-
-
-class ConnectionManagerTwisted():
-    @staticmethod
-    def connect_peer(peer):
-        f = PeerConnectionFactory(peer)
-        reactor.connectTCP(peer.ip, peer.port, f)
-
-    @staticmethod
-    def start_event_loop():
-        reactor.run()
-
-    @staticmethod
-    def stop_event_loop():
-        reactor.stop()
-
-
-# =============================================================================
-
-class ConnectionManagerThreaded():
-    def __init__(self):
-        self.conns = []
-        self.loop_active = False
-
-    def connect_peer(self, peer):
-        conn = PeerConnectionThreaded(peer)
-        self.conns.append(conn)
-
-    def start_event_loop(self):
-        self.loop_active = True
-        while self.loop_active:
-            time.sleep(0)
-            for conn in self.conns:
-                if not conn.thread.is_alive():
-                    continue
-                conn.check_events()
-
-    def stop_event_loop(self):
-        self.loop_active = False
-        for conn in self.conns:
-            conn.disconnect()
-
-
-class PeerConnectionThreaded():
-    def __init__(self, peer):
-        self.peer = peer
-        self.is_stopped = False
-
-        self.receive_queue = queue.Queue()
-        self.write_queue = queue.Queue()
-        self.connect_event = threading.Event()
-        self.disconnect_event = threading.Event()
-        self.connection_succeeded = threading.Event()
-        self.connection_failed = threading.Event()
-        self.connection_lost = threading.Event()
-
-        self.thread = PeerConnectionThreadedThread(self)
-        self.thread.start()
-        self.connect()
-
-    def check_events(self):
-        """Check receive queue and event flags from thread and take actions."""
-        if not self.receive_queue.empty():
-            try:
-                data = self.receive_queue.get_nowait()
-            except queue.Empty:
-                pass
-            else:
-                self.handle_data_received(data)
-
-        if self.connection_succeeded.is_set():
-            self.connection_succeeded.clear()
-            self.handle_connection_succeded()
-        if self.connection_failed.is_set():
-            self.connection_failed.clear()
-            self.handle_connection_failed()
-        if self.connection_lost.is_set():
-            self.connection_lost.clear()
-            self.handle_connection_lost()
-
-    def handle_connection_succeded(self):
-        self.peer.handle_connection_made(self)
-
-    def handle_connection_failed(self):
-        self.peer.handle_connection_failed()
-
-    def handle_connection_lost(self):
-        self.peer.handle_connection_lost()
-
-    def handle_data_received(self, data):
-        self.peer.handle_data_received(data)
-
-    def connect(self):
-        self.connect_event.set()
-
-    def write(self, data):
-        self.write_queue.put(data)
-
-    def disconnect(self):
-        self.disconnect_event.set()
-
-
-class PeerConnectionThreadedThread(threading.Thread):
-    def __init__(self, conn):
-        self.ip = conn.peer.ip
-        self.port = conn.peer.port
-
-        self.receive_queue = conn.receive_queue
-        self.write_queue = conn.write_queue
-        self.connect_event = conn.connect_event
-        self.disconnect_event = conn.disconnect_event
-        self.connection_succeeded = conn.connection_succeeded
-        self.connection_failed = conn.connection_failed
-        self.connection_lost = conn.connection_lost
-
-        threading.Thread.__init__(self)
-
-    def run(self):
-        self.connect_event.wait()
-        try:
-            self.thread_connect()
-        except PeerConnectionFailedError:
-            self.connection_failed.set()
-            self.sock.close()
-            self.sock = None
-            return
-
-        while not self.disconnect_event.is_set():
-            time.sleep(0)
-            self.thread_send()
-            self.thread_receive()
-
-        self.sock.close()
-        self.sock = None
-
-    def thread_connect(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(3.0)
-        try:
-            self.sock.connect((self.ip, self.port))
-        except OSError:
-            raise PeerConnectionFailedError
-
-        self.sock.setblocking(False)
-        self.connection_succeeded.set()
-
-    def thread_send(self):
-        while True:
-            try:
-                data = self.write_queue.get_nowait()
-
-                try:
-                    self.sock.send(data)
-                except BrokenPipeError:
-                    self.thread_handle_connection_lost()
-                    return
-            except queue.Empty:
-                return
-
-    def thread_receive(self):
-        try:
-            data = self.sock.recv(4096)
-        except BlockingIOError:
-            return
-        except ConnectionError:
-            self.thread_handle_connection_lost()
-            return
-
-        if not data:
-            self.thread_handle_connection_lost()
-            return
-
-        self.receive_queue.put(data)
+def create_listen_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(64)
+    sock.setblocking(False)
+    return sock
 
-    def thread_handle_connection_lost(self):
-        self.connection_lost.set()
-        self.disconnect_event.set()
 
+class PeerConnectionFailedError(Exception):
+    pass
 
-# =============================================================================
 
-if concurrency_mode == 'twisted':
-    ConnectionManager = ConnectionManagerTwisted
-elif concurrency_mode == 'select':
-    ConnectionManager = ConnectionManagerSelect
-elif concurrency_mode == 'threads':
-    ConnectionManager = ConnectionManagerThreaded
+class ConnectionBackendError(Exception):
+    pass
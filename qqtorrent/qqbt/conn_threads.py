@@ -0,0 +1,239 @@
+"""Threaded implementation of the peer connection event loop.
+
+Each connection gets a thread to handle its blocking I/O, and the event loop
+reads back results through queues.
+"""
+import logging
+import selectors
+import socket
+import queue
+import time
+import threading
+
+from qqbt.conn import PeerConnectionFailedError, create_listen_socket
+from qqbt.timers import TimerQueue
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionManagerThreaded():
+    def __init__(self):
+        self.conns = []
+        self.loop_active = False
+        self.sel = selectors.DefaultSelector()
+        self.timers = TimerQueue()
+        self.listen_sock = None
+        self.listen_port = None
+        self.thread_calls = queue.SimpleQueue()
+
+    def connect_peer(self, peer):
+        conn = PeerConnectionThreaded(peer)
+        self.conns.append(conn)
+
+    def listen(self, port, make_peer):
+        self.listen_sock = create_listen_socket(port)
+        self.listen_port = self.listen_sock.getsockname()[1]
+        self.add_reader(self.listen_sock,
+                        lambda: self.handle_accept(make_peer))
+
+    def handle_accept(self, make_peer):
+        try:
+            (sock, (ip, port)) = self.listen_sock.accept()
+        except BlockingIOError:
+            return
+        conn = PeerConnectionThreaded(make_peer(ip, port), sock=sock)
+        self.conns.append(conn)
+
+    def add_reader(self, fileobj, callback):
+        self.sel.register(fileobj, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fileobj):
+        self.sel.unregister(fileobj)
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def call_every(self, interval, callback, *args):
+        return self.timers.call_every(interval, callback, *args)
+
+    def call_from_thread(self, callback, *args):
+        self.thread_calls.put((callback, args))
+
+    def run_thread_calls(self):
+        while True:
+            try:
+                (callback, args) = self.thread_calls.get_nowait()
+            except queue.Empty:
+                return
+            callback(*args)
+
+    def start_event_loop(self):
+        self.loop_active = True
+        while self.loop_active:
+            time.sleep(0)
+            if self.sel.get_map():
+                for key, mask in self.sel.select(0):
+                    key.data()
+            for conn in self.conns:
+                if not conn.thread.is_alive():
+                    continue
+                conn.check_events()
+            self.run_thread_calls()
+            self.timers.run_expired()
+
+    def stop_event_loop(self):
+        self.loop_active = False
+        for conn in self.conns:
+            conn.disconnect()
+        if self.listen_sock:
+            self.remove_reader(self.listen_sock)
+            self.listen_sock.close()
+            self.listen_sock = None
+
+
+class PeerConnectionThreaded():
+    def __init__(self, peer, sock=None):
+        """
+        Args:
+            peer (TorrentPeer): peer receiving connection callbacks
+            sock (socket.socket): already connected (accepted) socket; if
+                None, connect to the peer
+        """
+        self.peer = peer
+        self.is_stopped = False
+
+        self.receive_queue = queue.Queue()
+        self.write_queue = queue.Queue()
+        self.connect_event = threading.Event()
+        self.disconnect_event = threading.Event()
+        self.connection_succeeded = threading.Event()
+        self.connection_failed = threading.Event()
+        self.connection_lost = threading.Event()
+
+        self.thread = PeerConnectionThreadedThread(self, sock)
+        self.thread.start()
+        self.connect()
+
+    def check_events(self):
+        """Check receive queue and event flags from thread and take actions."""
+        if self.connection_succeeded.is_set():
+            self.connection_succeeded.clear()
+            self.handle_connection_succeded()
+
+        if not self.receive_queue.empty():
+            try:
+                data = self.receive_queue.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                self.handle_data_received(data)
+        if self.connection_failed.is_set():
+            self.connection_failed.clear()
+            self.handle_connection_failed()
+        if self.connection_lost.is_set():
+            self.connection_lost.clear()
+            self.handle_connection_lost()
+
+    def handle_connection_succeded(self):
+        self.peer.handle_connection_made(self)
+
+    def handle_connection_failed(self):
+        self.peer.handle_connection_failed()
+
+    def handle_connection_lost(self):
+        self.peer.handle_connection_lost()
+
+    def handle_data_received(self, data):
+        self.peer.handle_data_received(data)
+
+    def connect(self):
+        self.connect_event.set()
+
+    def write(self, data):
+        self.write_queue.put(data)
+
+    def disconnect(self):
+        self.disconnect_event.set()
+
+
+class PeerConnectionThreadedThread(threading.Thread):
+    def __init__(self, conn, sock=None):
+        self.ip = conn.peer.ip
+        self.port = conn.peer.port
+        self.sock = sock
+
+        self.receive_queue = conn.receive_queue
+        self.write_queue = conn.write_queue
+        self.connect_event = conn.connect_event
+        self.disconnect_event = conn.disconnect_event
+        self.connection_succeeded = conn.connection_succeeded
+        self.connection_failed = conn.connection_failed
+        self.connection_lost = conn.connection_lost
+
+        threading.Thread.__init__(self)
+
+    def run(self):
+        self.connect_event.wait()
+        try:
+            self.thread_connect()
+        except PeerConnectionFailedError:
+            self.connection_failed.set()
+            self.sock.close()
+            self.sock = None
+            return
+
+        while not self.disconnect_event.is_set():
+            time.sleep(0)
+            self.thread_send()
+            self.thread_receive()
+
+        self.sock.close()
+        self.sock = None
+
+    def thread_connect(self):
+        if self.sock:
+            # Accepted inbound connection.
+            self.sock.setblocking(False)
+            self.connection_succeeded.set()
+            return
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(3.0)
+        try:
+            self.sock.connect((self.ip, self.port))
+        except OSError:
+            raise PeerConnectionFailedError
+
+        self.sock.setblocking(False)
+        self.connection_succeeded.set()
+
+    def thread_send(self):
+        while True:
+            try:
+                data = self.write_queue.get_nowait()
+
+                try:
+                    self.sock.send(data)
+                except BrokenPipeError:
+                    self.thread_handle_connection_lost()
+                    return
+            except queue.Empty:
+                return
+
+    def thread_receive(self):
+        try:
+            data = self.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            self.thread_handle_connection_lost()
+            return
+
+        if not data:
+            self.thread_handle_connection_lost()
+            return
+
+        self.receive_queue.put(data)
+
+    def thread_handle_connection_lost(self):
+        self.connection_lost.set()
+        self.disconnect_event.set()
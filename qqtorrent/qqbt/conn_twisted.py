@@ -0,0 +1,217 @@
+"""Twisted implementation of the peer connection event loop.
+
+Each connection registers itself as the push producer feeding its own
+transport. When the transport's write buffer passes
+CONFIG['write_buffer_bytes'], e.g. because we are uploading faster than the
+peer reads, Twisted pauses the producer and we stop reading from the peer,
+so it can't queue more requests until the buffer drains. Outbound connects
+time out after CONFIG['connect_timeout']. Timers run on reactor.callLater,
+and piece hashing is moved off the reactor thread with run_in_thread. Other
+threads schedule calls on the reactor with call_from_thread.
+"""
+import logging
+from zope.interface import implementer
+from twisted.internet import protocol, reactor, task, threads, error
+from twisted.internet.interfaces import IPushProducer
+
+from qqbt.config import CONFIG
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionStats():
+    """Counters for the connections of one connection manager."""
+    def __init__(self):
+        self.num_connections = 0
+        self.num_paused = 0             # connections paused for backpressure
+        self.num_pauses = 0
+        self.num_connect_timeouts = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.num_thread_calls = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+@implementer(IPushProducer)
+class PeerConnectionProtocol(protocol.Protocol):
+    peer = None
+    is_inbound = False
+    is_paused = False
+
+    def connectionMade(self):
+        #log.debug('%s: connectionMade' % self.factory.peer)
+        if self.peer is None:
+            self.peer = self.factory.peer
+        self.stats = self.factory.stats
+        self.stats.num_connections += 1
+        self.transport.bufferSize = CONFIG['write_buffer_bytes']
+        self.transport.registerProducer(self, True)
+        self.peer.handle_connection_made(self)
+
+    def dataReceived(self, data):
+        #log.debug('%s: dataReceived' % self.factory.peer)
+        self.stats.bytes_received += len(data)
+        self.peer.handle_data_received(data)
+
+    def connectionLost(self, reason):
+        self.stats.num_connections -= 1
+        if self.is_paused:
+            self.is_paused = False
+            self.stats.num_paused -= 1
+        # Outbound connections report this through their ClientFactory.
+        if self.is_inbound:
+            self.peer.handle_connection_lost()
+
+    def write(self, data):
+        self.stats.bytes_sent += len(data)
+        self.transport.write(data)
+
+    def disconnect(self):
+        self.transport.loseConnection()
+
+    # IPushProducer, called by our transport as its write buffer fills up
+    # and drains.
+
+    def pauseProducing(self):
+        if self.is_paused:
+            return
+        log.debug('%s: write buffer full, pausing reads' % self.peer)
+        self.is_paused = True
+        self.stats.num_paused += 1
+        self.stats.num_pauses += 1
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if not self.is_paused:
+            return
+        self.is_paused = False
+        self.stats.num_paused -= 1
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        pass
+
+
+class PeerConnectionFactory(protocol.ClientFactory):
+    protocol = PeerConnectionProtocol
+
+    def __init__(self, peer, stats):
+        self.peer = peer
+        self.stats = stats
+
+    def clientConnectionFailed(self, connector, reason):
+        #log.warn('%s: clientConnectionFailed: %s' % (self.peer, reason))
+        if reason.check(error.TimeoutError):
+            self.stats.num_connect_timeouts += 1
+        self.peer.handle_connection_failed()
+
+    def clientConnectionLost(self, connector, reason):
+        #log.warn('%s: clientConnectionLost: %s' % (self.peer, reason))
+        self.peer.handle_connection_lost()
+
+
+class PeerServerFactory(protocol.Factory):
+    def __init__(self, make_peer, stats):
+        self.make_peer = make_peer
+        self.stats = stats
+
+    def buildProtocol(self, addr):
+        p = PeerConnectionProtocol()
+        p.factory = self
+        p.peer = self.make_peer(addr.host, addr.port)
+        p.is_inbound = True
+        return p
+
+
+class FileReaderTwisted():
+    """IReadDescriptor calling back when a plain file object is readable."""
+    def __init__(self, fileobj, callback):
+        self.fileobj = fileobj
+        self.callback = callback
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def doRead(self):
+        self.callback()
+
+    def connectionLost(self, reason):
+        pass
+
+    def logPrefix(self):
+        return 'FileReaderTwisted'
+
+
+class TimerTwisted():
+    """Cancellable wrapper for a DelayedCall or LoopingCall."""
+    def __init__(self, delayed_call=None, looping_call=None):
+        self.delayed_call = delayed_call
+        self.looping_call = looping_call
+
+    def cancel(self):
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.cancel()
+        if self.looping_call and self.looping_call.running:
+            self.looping_call.stop()
+
+
+class ConnectionManagerTwisted():
+    def __init__(self):
+        self.readers = {}
+        self.listen_port = None
+        self.stats = ConnectionStats()
+
+    def connect_peer(self, peer):
+        f = PeerConnectionFactory(peer, self.stats)
+        reactor.connectTCP(peer.ip, peer.port, f,
+                           timeout=CONFIG['connect_timeout'])
+
+    def add_reader(self, fileobj, callback):
+        reader = FileReaderTwisted(fileobj, callback)
+        self.readers[fileobj] = reader
+        reactor.addReader(reader)
+
+    def remove_reader(self, fileobj):
+        reactor.removeReader(self.readers.pop(fileobj))
+
+    def listen(self, port, make_peer):
+        listening_port = reactor.listenTCP(
+            port, PeerServerFactory(make_peer, self.stats))
+        self.listen_port = listening_port.getHost().port
+
+    @staticmethod
+    def call_later(delay, callback, *args):
+        return TimerTwisted(delayed_call=reactor.callLater(
+            delay, callback, *args))
+
+    @staticmethod
+    def call_every(interval, callback, *args):
+        looping_call = task.LoopingCall(callback, *args)
+        looping_call.start(interval, now=False)
+        return TimerTwisted(looping_call=looping_call)
+
+    def run_in_thread(self, callback, func, *args):
+        """Run func(*args) on the reactor's thread pool and call
+        callback(result) back on the reactor thread."""
+        self.stats.num_thread_calls += 1
+        d = threads.deferToThread(func, *args)
+        d.addCallback(callback)
+        d.addErrback(lambda failure: log.error(
+            'run_in_thread: %s failed: %s' % (func, failure.getTraceback())))
+
+    @staticmethod
+    def call_from_thread(callback, *args):
+        reactor.callFromThread(callback, *args)
+
+    def get_stats(self):
+        return self.stats.as_dict()
+
+    @staticmethod
+    def start_event_loop():
+        reactor.run()
+
+    def stop_event_loop(self):
+        log.info('ConnectionManagerTwisted stats: %s' % self.get_stats())
+        reactor.stop()
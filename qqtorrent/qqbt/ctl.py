@@ -0,0 +1,60 @@
+"""Command-line client for a qqbt daemon's control socket."""
+import os
+import sys
+import argparse
+
+from qqbt.daemon import ControlClient, ControlProtocolError
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', '-s', required=True,
+                        help='daemon control socket')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    p = subparsers.add_parser('add', help='add and start a torrent')
+    p.add_argument('path', help='.torrent metainfo file')
+    for cmd in ('remove', 'pause', 'resume'):
+        p = subparsers.add_parser(cmd, help='%s a torrent' % cmd)
+        p.add_argument('info_hash', help='hex info hash')
+    p = subparsers.add_parser('priority', help='set a torrent\'s priority')
+    p.add_argument('info_hash', help='hex info hash')
+    p.add_argument('priority', choices=['low', 'normal', 'high'])
+    subparsers.add_parser('status', help='show all torrents')
+    subparsers.add_parser('shutdown', help='stop the daemon')
+    args = parser.parse_args(argv)
+
+    params = {}
+    if args.cmd == 'add':
+        params['path'] = os.path.abspath(args.path)
+    elif args.cmd in ('remove', 'pause', 'resume'):
+        params['info_hash'] = args.info_hash
+    elif args.cmd == 'priority':
+        params['info_hash'] = args.info_hash
+        params['priority'] = args.priority
+
+    try:
+        client = ControlClient(args.socket)
+        resp = client.request(args.cmd, **params)
+        client.close()
+    except (OSError, ControlProtocolError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 1
+
+    if not resp.get(b'ok'):
+        print('error: %s' % resp.get(b'error', b'').decode('utf-8'),
+              file=sys.stderr)
+        return 1
+    torrents = resp.get(b'torrents', [resp[b'torrent']]
+                        if b'torrent' in resp else [])
+    for t in torrents:
+        print('%s  %-8s %6s / %-6s %s' % (
+            t[b'info_hash'].decode('ascii'), t[b'state'].decode('utf-8'),
+            t[b'num_complete'], t[b'num_pieces'],
+            t[b'name'].decode('utf-8')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
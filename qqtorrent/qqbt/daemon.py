@@ -0,0 +1,272 @@
+"""Daemon mode: control a running QqbtClient over a Unix-domain socket.
+
+Requests and responses are bencoded dicts, each sent as a frame prefixed with
+its 4 byte big-endian length. A request has a 'cmd' key and command specific
+arguments:
+    {'cmd': 'add', 'path': <.torrent path>}
+    {'cmd': 'remove' | 'pause' | 'resume', 'info_hash': <hex info hash>}
+    {'cmd': 'priority', 'info_hash': <hex info hash>,
+     'priority': 'low' | 'normal' | 'high'}
+    {'cmd': 'status'}
+    {'cmd': 'shutdown'}
+Responses have 'ok' set to 1 on success, with 'torrent' or 'torrents' status
+dicts where applicable, or 'ok' set to 0 and an 'error' message. Adding a
+torrent that was already added returns the existing one.
+"""
+import os
+import socket
+import struct
+import logging
+
+from qqbt import bencode
+from qqbt.scheduler import PRIORITIES
+
+log = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct('!L')
+MAX_FRAME_LENGTH = 2**20
+SEND_RETRY_INTERVAL = 0.05          # seconds between tries to drain output
+MAX_PENDING_BYTES = 8 * MAX_FRAME_LENGTH
+
+
+def encode_frame(msg):
+    data = bencode.encode(msg)
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frames(buf):
+    """Decode complete frames from buf.
+
+    Returns:
+        (list, bytes): decoded messages and the unconsumed remainder of buf
+    """
+    msgs = []
+    while len(buf) >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(buf)
+        if length > MAX_FRAME_LENGTH:
+            raise ControlProtocolError('Frame too long: %d' % length)
+        end = FRAME_HEADER.size + length
+        if len(buf) < end:
+            break
+        try:
+            msg = bencode.decode(buf[FRAME_HEADER.size:end])
+        except bencode.BencodeDecodeError as e:
+            raise ControlProtocolError('Invalid frame: %s' % e) from e
+        if not isinstance(msg, dict):
+            raise ControlProtocolError('Frame is not a dict')
+        msgs.append(msg)
+        buf = buf[end:]
+    return (msgs, buf)
+
+
+class ControlServer():
+    """Listens on a Unix-domain socket and applies commands to a client."""
+    def __init__(self, client, path):
+        """
+        Args:
+            client (QqbtClient): client to control; its event loop serves
+                the socket
+            path (str): socket path; a stale socket file is replaced
+        """
+        self.client = client
+        self.path = path
+        self.conns = {}     # socket -> receive buffer
+        # Responses the socket hasn't taken yet, and the timers to retry
+        # them. The sockets are non-blocking so a client that doesn't read
+        # can't stall the event loop.
+        self.pending = {}   # socket -> bytes to send
+        self.send_timers = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        client.add_reader(self.sock, self.handle_accept)
+        log.info('ControlServer listening on %s' % path)
+
+    def handle_accept(self):
+        try:
+            (conn, _) = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        self.conns[conn] = b''
+        self.client.add_reader(conn, lambda: self.handle_read(conn))
+
+    def handle_read(self, conn):
+        try:
+            data = conn.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close_conn(conn)
+            return
+
+        try:
+            (msgs, self.conns[conn]) = decode_frames(self.conns[conn] + data)
+        except ControlProtocolError as e:
+            log.warning('ControlServer: %s' % e)
+            self.close_conn(conn)
+            return
+
+        for msg in msgs:
+            resp = self.handle_request(msg)
+            self.send(conn, encode_frame(resp))
+            if conn not in self.conns:
+                return
+            if msg.get(b'cmd') == b'shutdown':
+                self.close()
+                self.client.stop()
+                return
+
+    def send(self, conn, data):
+        """Queue data for conn, sending what the socket takes now."""
+        self.pending[conn] = self.pending.get(conn, b'') + data
+        if conn not in self.send_timers:
+            self.flush_conn(conn)
+
+    def flush_conn(self, conn):
+        self.send_timers.pop(conn, None)
+        data = self.pending.get(conn)
+        if conn not in self.conns or not data:
+            return
+        try:
+            n = conn.send(data)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        except OSError:
+            self.close_conn(conn)
+            return
+        data = self.pending[conn] = data[n:]
+        if not data:
+            return
+        if len(data) > MAX_PENDING_BYTES:
+            log.warning('ControlServer: client not reading, disconnecting')
+            self.close_conn(conn)
+            return
+        self.send_timers[conn] = self.client.call_later(
+            SEND_RETRY_INTERVAL, self.flush_conn, conn)
+
+    def close_conn(self, conn):
+        if conn in self.conns:
+            self.client.remove_reader(conn)
+            del self.conns[conn]
+            self.pending.pop(conn, None)
+            timer = self.send_timers.pop(conn, None)
+            if timer:
+                timer.cancel()
+            conn.close()
+
+    def close(self):
+        for conn in list(self.conns):
+            self.close_conn(conn)
+        self.client.remove_reader(self.sock)
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def handle_request(self, msg):
+        cmd = msg.get(b'cmd', b'').decode('utf-8', 'replace')
+        handler = getattr(self, 'cmd_' + cmd, None)
+        if handler is None:
+            return {'ok': 0, 'error': 'Unknown command: %s' % cmd}
+        try:
+            resp = handler(msg)
+        except ControlCommandError as e:
+            return {'ok': 0, 'error': str(e)}
+        except Exception as e:
+            # Keep the daemon up whatever a single command does.
+            log.exception('ControlServer: %s failed' % cmd)
+            return {'ok': 0, 'error': str(e)}
+        resp['ok'] = 1
+        return resp
+
+    def _find_torrent(self, msg):
+        try:
+            info_hash = bytes.fromhex(msg[b'info_hash'].decode('ascii'))
+        except (KeyError, ValueError, UnicodeDecodeError) as e:
+            raise ControlCommandError('Invalid info_hash') from e
+        torrent = self.client.find_torrent(info_hash)
+        if not torrent:
+            raise ControlCommandError('No such torrent')
+        return torrent
+
+    def _torrent_status(self, torrent):
+        info_hash = torrent.metainfo.info_hash.hex()
+        return next(v for v in self.client.get_status()
+                    if v['info_hash'] == info_hash)
+
+    def cmd_add(self, msg):
+        try:
+            path = msg[b'path'].decode('utf-8')
+        except (KeyError, UnicodeDecodeError) as e:
+            raise ControlCommandError('Invalid path') from e
+        torrent = self.client.add_torrent(path)
+        self.client.start_torrent(torrent)
+        return {'torrent': self._torrent_status(torrent)}
+
+    def cmd_remove(self, msg):
+        self.client.remove_torrent(self._find_torrent(msg))
+        return {}
+
+    def cmd_pause(self, msg):
+        torrent = self._find_torrent(msg)
+        self.client.pause_torrent(torrent)
+        return {'torrent': self._torrent_status(torrent)}
+
+    def cmd_resume(self, msg):
+        torrent = self._find_torrent(msg)
+        self.client.resume_torrent(torrent)
+        return {'torrent': self._torrent_status(torrent)}
+
+    def cmd_priority(self, msg):
+        torrent = self._find_torrent(msg)
+        try:
+            priority = PRIORITIES[msg[b'priority'].decode('ascii')]
+        except (KeyError, UnicodeDecodeError) as e:
+            raise ControlCommandError('Invalid priority') from e
+        self.client.set_priority(torrent, priority)
+        return {'torrent': self._torrent_status(torrent)}
+
+    def cmd_status(self, msg):
+        return {'torrents': self.client.get_status()}
+
+    def cmd_shutdown(self, msg):
+        return {}
+
+
+class ControlClient():
+    """Sends commands to a daemon's control socket."""
+    def __init__(self, path, timeout=10.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.buf = b''
+
+    def request(self, cmd, **params):
+        """Send a command and return the decoded response dict."""
+        params['cmd'] = cmd
+        self.sock.sendall(encode_frame(params))
+        while True:
+            (msgs, self.buf) = decode_frames(self.buf)
+            if msgs:
+                return msgs[0]
+            data = self.sock.recv(4096)
+            if not data:
+                raise ControlProtocolError('Connection closed by daemon')
+            self.buf += data
+
+    def close(self):
+        self.sock.close()
+
+
+class ControlProtocolError(Exception):
+    pass
+
+
+class ControlCommandError(Exception):
+    pass
@@ -0,0 +1,539 @@
+"""Mainline DHT (BEP 5) node for tracker-independent peer discovery.
+
+The node runs over one UDP socket served by the connection manager's event
+loop. It answers ping/find_node/get_peers/announce_peer queries from other
+nodes, and runs iterative get_peers lookups with ALPHA parallel queries to
+find peers for our torrents, announcing itself to the closest nodes found.
+The routing table can be saved to a state file and reloaded on restart, so
+later lookups skip the public bootstrap routers.
+"""
+import os
+import time
+import socket
+import struct
+import hashlib
+import logging
+
+from qqbt import bencode
+from qqbt.config import CONFIG
+
+log = logging.getLogger(__name__)
+
+K = 8                   # bucket size and lookup result size
+ALPHA = 3               # parallel queries per lookup
+QUERY_TIMEOUT = 5.0     # seconds
+TOKEN_INTERVAL = 300    # seconds a token stays valid (for two intervals)
+PEER_TTL = 30 * 60      # seconds an announced peer is kept
+MAX_FAILURES = 2        # failed queries before a node is replaceable
+SAVE_INTERVAL = 600     # seconds between saves of the routing table
+
+COMPACT_NODE = struct.Struct('!20s4sH')
+COMPACT_PEER = struct.Struct('!4sH')
+
+
+def encode_compact_nodes(contacts):
+    return b''.join(COMPACT_NODE.pack(c.node_id, socket.inet_aton(c.ip),
+                                      c.port)
+                    for c in contacts)
+
+
+def decode_compact_nodes(data):
+    contacts = []
+    for ofs in range(0, len(data) - len(data) % COMPACT_NODE.size,
+                     COMPACT_NODE.size):
+        (node_id, ip, port) = COMPACT_NODE.unpack_from(data, ofs)
+        if port > 0:
+            contacts.append(DHTContact(node_id, socket.inet_ntoa(ip), port))
+    return contacts
+
+
+def encode_compact_peer(ip, port):
+    return COMPACT_PEER.pack(socket.inet_aton(ip), port)
+
+
+def decode_compact_peer(data):
+    (ip, port) = COMPACT_PEER.unpack(data)
+    return {'ip': socket.inet_ntoa(ip), 'port': port}
+
+
+def is_node_id(value):
+    return isinstance(value, bytes) and len(value) == 20
+
+
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+class DHTContact():
+    """A remote DHT node."""
+    def __init__(self, node_id, ip, port):
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.failures = 0
+        self.last_seen = 0
+
+    def __repr__(self):
+        return ('DHTContact(id={}, ip={}, port={})'
+                .format(self.node_id.hex()[:8], self.ip, self.port))
+
+    @property
+    def addr(self):
+        return (self.ip, self.port)
+
+
+class RoutingTable():
+    """Kademlia routing table of K-buckets indexed by XOR distance prefix."""
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.buckets = [[] for _ in range(160)]
+
+    def __len__(self):
+        return sum(len(b) for b in self.buckets)
+
+    def _bucket(self, node_id):
+        d = distance(self.node_id, node_id)
+        return self.buckets[d.bit_length() - 1] if d else None
+
+    def add(self, contact):
+        """Add or refresh a contact. Returns the contact kept in the table."""
+        bucket = self._bucket(contact.node_id)
+        if bucket is None:
+            return None
+        for i, c in enumerate(bucket):
+            if c.node_id == contact.node_id:
+                # Keep buckets in least recently seen order.
+                del bucket[i]
+                c.ip = contact.ip
+                c.port = contact.port
+                c.failures = 0
+                c.last_seen = time.monotonic()
+                bucket.append(c)
+                return c
+        if len(bucket) >= K:
+            # Replace the stalest node only if it has stopped responding.
+            if bucket[0].failures < MAX_FAILURES:
+                return None
+            del bucket[0]
+        contact.last_seen = time.monotonic()
+        bucket.append(contact)
+        return contact
+
+    def find(self, node_id):
+        bucket = self._bucket(node_id)
+        for c in bucket or []:
+            if c.node_id == node_id:
+                return c
+        return None
+
+    def remove(self, contact):
+        bucket = self._bucket(contact.node_id)
+        if bucket and contact in bucket:
+            bucket.remove(contact)
+
+    def closest(self, target, n=K):
+        contacts = [c for b in self.buckets for c in b]
+        contacts.sort(key=lambda c: distance(c.node_id, target))
+        return contacts[:n]
+
+    def contacts(self):
+        return [c for b in self.buckets for c in b]
+
+
+class DHTNode():
+    """A DHT node on a UDP socket served by the connection manager."""
+    def __init__(self, conn_man, port=0, bind_ip='0.0.0.0', node_id=None,
+                 state_path=None):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop serving the socket
+            port (int): UDP port, 0 for any free port
+            bind_ip (str): address to bind
+            node_id (bytes): 20 byte node id; loaded from state_path or
+                random if None
+            state_path (str): file to persist the node id and routing table
+        """
+        self.conn_man = conn_man
+        self.state_path = state_path
+        self.pending = {}       # transaction id -> DHTQuery
+        self.next_tid = 0
+        self.lookups = []
+        self.peer_store = {}    # info_hash -> {(ip, port): time announced}
+        self.token_secret = os.urandom(20)
+        # Called with (data, addr) for datagrams that are not KRPC messages,
+        # e.g. uTP packets sharing the socket.
+        self.on_other_datagram = None
+
+        saved_nodes = []
+        if state_path:
+            (node_id, saved_nodes) = self._load_state(node_id)
+        self.node_id = node_id or os.urandom(20)
+        self.routing_table = RoutingTable(self.node_id)
+        for contact in saved_nodes:
+            self.routing_table.add(contact)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bind_ip, port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        conn_man.add_reader(self.sock, self.handle_readable)
+        self.timers = [conn_man.call_every(1.0, self.expire_queries)]
+        if state_path:
+            self.timers.append(conn_man.call_every(SAVE_INTERVAL,
+                                                   self.save_state))
+
+    def __repr__(self):
+        return 'DHTNode(id=%s, port=%d)' % (self.node_id.hex()[:8], self.port)
+
+    def close(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.save_state()
+        self.conn_man.remove_reader(self.sock)
+        self.sock.close()
+
+    # ===== Persistence
+
+    def _load_state(self, node_id):
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = bencode.decode(f.read())
+            nodes = decode_compact_nodes(state.get(b'nodes', b''))
+            return (node_id or state.get(b'id'), nodes)
+        except FileNotFoundError:
+            pass
+        except (OSError, bencode.BencodeDecodeError, AttributeError) as e:
+            log.warning('Ignoring DHT state %s: %s' % (self.state_path, e))
+        return (node_id, [])
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        state = {
+            'id': self.node_id,
+            'nodes': encode_compact_nodes(self.routing_table.contacts())
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode.encode(state))
+        os.replace(tmp_path, self.state_path)
+
+    # ===== Lookups
+
+    def bootstrap(self, addrs=None):
+        """Join the DHT by looking up our own id.
+
+        Args:
+            addrs (list): (host, port) tuples to ask first; defaults to
+                CONFIG['dht_bootstrap'] when the routing table is empty
+        """
+        if addrs is None:
+            addrs = [] if len(self.routing_table) else CONFIG['dht_bootstrap']
+        lookup = DHTLookup(self, self.node_id, 'find_node')
+        for (host, port) in addrs:
+            try:
+                ip = socket.gethostbyname(host)
+            except OSError as e:
+                log.warning('DHT bootstrap: cannot resolve %s: %s' % (host, e))
+                continue
+            # Bootstrap nodes' ids are unknown until they answer.
+            lookup.add_candidate(DHTContact(None, ip, port))
+        lookup.start()
+        return lookup
+
+    def get_peers(self, info_hash, on_peers, on_done=None,
+                  announce_port=None):
+        """Find peers for a torrent.
+
+        Args:
+            info_hash (bytes): torrent info hash
+            on_peers (function): called with a list of peer dicts as
+                batches of peers are found
+            on_done (function): called with the lookup when it finishes
+            announce_port (int): if set, announce that we are a peer on this
+                port to the closest nodes once the lookup finishes
+        """
+        lookup = DHTLookup(self, info_hash, 'get_peers', on_peers=on_peers,
+                           on_done=on_done, announce_port=announce_port)
+        lookup.start()
+        return lookup
+
+    # ===== KRPC transport
+
+    def send_query(self, contact, method, args, callback):
+        """Send a query; callback(contact, response dict or None on error)."""
+        tid = struct.pack('!H', self.next_tid)
+        self.next_tid = (self.next_tid + 1) & 0xFFFF
+        args = dict(args, id=self.node_id)
+        msg = {'t': tid, 'y': 'q', 'q': method, 'a': args}
+        self.pending[tid] = DHTQuery(contact, method, callback)
+        self._send(msg, contact.addr)
+
+    def _send(self, msg, addr):
+        try:
+            self.sock.sendto(bencode.encode(msg), addr)
+        except OSError as e:
+            log.debug('%s: sendto %s failed: %s' % (self, addr, e))
+
+    def expire_queries(self):
+        """Fail queries that have gone unanswered for QUERY_TIMEOUT."""
+        now = time.monotonic()
+        expired = [tid for (tid, q) in self.pending.items()
+                   if now - q.sent_at > QUERY_TIMEOUT]
+        for tid in expired:
+            query = self.pending.pop(tid)
+            contact = query.contact
+            if contact.node_id:
+                c = self.routing_table.find(contact.node_id)
+                if c:
+                    c.failures += 1
+            query.callback(contact, None)
+
+    def handle_readable(self):
+        while True:
+            try:
+                (data, addr) = self.sock.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on the next recv.
+                log.debug('%s: recvfrom failed: %s' % (self, e))
+                continue
+            self.handle_datagram(data, addr)
+
+    def handle_datagram(self, data, addr):
+        if not data.startswith(b'd') and self.on_other_datagram:
+            self.on_other_datagram(data, addr)
+            return
+        try:
+            msg = bencode.decode(data)
+            msg_type = msg[b'y']
+            tid = msg[b't']
+        except (bencode.BencodeDecodeError, KeyError, TypeError):
+            log.debug('%s: malformed message from %s' % (self, addr))
+            return
+
+        if msg_type == b'q':
+            self.handle_query(msg, tid, addr)
+        elif msg_type in (b'r', b'e'):
+            query = self.pending.pop(tid, None)
+            if query is None or query.contact.addr != addr:
+                return
+            resp = msg.get(b'r') if msg_type == b'r' else None
+            if not (isinstance(resp, dict) and is_node_id(resp.get(b'id'))):
+                query.callback(query.contact, None)
+                return
+            query.contact.node_id = resp[b'id']
+            self.routing_table.add(query.contact)
+            query.callback(query.contact, resp)
+
+    # ===== Handling queries from other nodes
+
+    def handle_query(self, msg, tid, addr):
+        try:
+            method = msg[b'q'].decode('ascii')
+            args = msg[b'a']
+            sender_id = args[b'id']
+        except (KeyError, TypeError, AttributeError, UnicodeDecodeError):
+            self._send_error(tid, addr, 203, 'Protocol Error')
+            return
+        if not isinstance(sender_id, bytes):
+            self._send_error(tid, addr, 203, 'Protocol Error')
+            return
+        if is_node_id(sender_id):
+            self.routing_table.add(DHTContact(sender_id, addr[0], addr[1]))
+
+        handler = getattr(self, 'handle_query_' + method, None)
+        if handler is None:
+            self._send_error(tid, addr, 204, 'Method Unknown')
+            return
+        try:
+            resp = handler(args, addr)
+        except KRPCError as e:
+            self._send_error(tid, addr, e.code, str(e))
+            return
+        except (KeyError, TypeError, ValueError, struct.error):
+            self._send_error(tid, addr, 203, 'Protocol Error')
+            return
+        resp['id'] = self.node_id
+        self._send({'t': tid, 'y': 'r', 'r': resp}, addr)
+
+    def _send_error(self, tid, addr, code, message):
+        self._send({'t': tid, 'y': 'e', 'e': [code, message]}, addr)
+
+    def handle_query_ping(self, args, addr):
+        return {}
+
+    def handle_query_find_node(self, args, addr):
+        target = args[b'target']
+        return {'nodes': encode_compact_nodes(
+            self.routing_table.closest(target))}
+
+    def handle_query_get_peers(self, args, addr):
+        info_hash = args[b'info_hash']
+        resp = {'token': self._make_token(addr[0])}
+        peers = self._get_stored_peers(info_hash)
+        if peers:
+            resp['values'] = [encode_compact_peer(ip, port)
+                              for (ip, port) in peers]
+        else:
+            resp['nodes'] = encode_compact_nodes(
+                self.routing_table.closest(info_hash))
+        return resp
+
+    def handle_query_announce_peer(self, args, addr):
+        info_hash = args[b'info_hash']
+        if not self._check_token(args[b'token'], addr[0]):
+            raise KRPCError(203, 'Bad token')
+        port = addr[1] if args.get(b'implied_port') else args[b'port']
+        peers = self.peer_store.setdefault(info_hash, {})
+        peers[(addr[0], port)] = time.monotonic()
+        return {}
+
+    def _get_stored_peers(self, info_hash):
+        peers = self.peer_store.get(info_hash, {})
+        now = time.monotonic()
+        for (addr, t) in list(peers.items()):
+            if now - t > PEER_TTL:
+                del peers[addr]
+        return list(peers)[:50]
+
+    def _make_token(self, ip, epoch=None):
+        if epoch is None:
+            epoch = int(time.time() // TOKEN_INTERVAL)
+        return hashlib.sha1(self.token_secret + socket.inet_aton(ip)
+                            + struct.pack('!Q', epoch)).digest()[:8]
+
+    def _check_token(self, token, ip):
+        epoch = int(time.time() // TOKEN_INTERVAL)
+        return token in (self._make_token(ip, epoch),
+                         self._make_token(ip, epoch - 1))
+
+
+class DHTQuery():
+    """An outstanding query awaiting a response."""
+    def __init__(self, contact, method, callback):
+        self.contact = contact
+        self.method = method
+        self.callback = callback
+        self.sent_at = time.monotonic()
+
+
+class DHTLookup():
+    """An iterative find_node or get_peers lookup for a target id."""
+    def __init__(self, node, target, method, on_peers=None, on_done=None,
+                 announce_port=None):
+        self.node = node
+        self.target = target
+        self.method = method
+        self.on_peers = on_peers
+        self.on_done = on_done
+        self.announce_port = announce_port
+
+        self.candidates = []    # contacts ordered by distance to target
+        self.seen = set()       # addrs ever added as candidates
+        self.queried = set()    # addrs queried
+        self.responded = []     # (contact, token) of nodes that answered
+        self.peers = set()
+        self.in_flight = 0
+        self.is_done = False
+
+    def __repr__(self):
+        return 'DHTLookup(%s, %s)' % (self.method, self.target.hex()[:8])
+
+    def add_candidate(self, contact):
+        if contact.addr in self.seen or contact.node_id == self.node.node_id:
+            return
+        self.seen.add(contact.addr)
+        self.candidates.append(contact)
+
+    def _sort_candidates(self):
+        # Bootstrap contacts with unknown ids go first.
+        self.candidates.sort(
+            key=lambda c: (-1 if c.node_id is None
+                           else distance(c.node_id, self.target)))
+
+    def start(self):
+        for contact in self.node.routing_table.closest(self.target):
+            self.add_candidate(contact)
+        self.node.lookups.append(self)
+        self.step()
+
+    def step(self):
+        """Query the closest unqueried candidates, or finish."""
+        if self.is_done:
+            return
+        self._sort_candidates()
+        closest = self.candidates[:K]
+        for contact in closest:
+            if self.in_flight >= ALPHA:
+                break
+            if contact.addr in self.queried:
+                continue
+            self.queried.add(contact.addr)
+            self.in_flight += 1
+            if self.method == 'get_peers':
+                args = {'info_hash': self.target}
+            else:
+                args = {'target': self.target}
+            self.node.send_query(contact, self.method, args,
+                                 self.handle_response)
+
+        if self.in_flight == 0 and all(c.addr in self.queried
+                                       for c in closest):
+            self.finish()
+
+    def handle_response(self, contact, resp):
+        self.in_flight -= 1
+        if resp is None:
+            if contact in self.candidates:
+                self.candidates.remove(contact)
+            self.step()
+            return
+
+        # Fields of the wrong type are ignored, as if missing.
+        nodes = resp.get(b'nodes')
+        if isinstance(nodes, bytes):
+            for c in decode_compact_nodes(nodes):
+                self.add_candidate(c)
+        if self.method == 'get_peers':
+            token = resp.get(b'token')
+            self.responded.append(
+                (contact, token if isinstance(token, bytes) else None))
+            values = resp.get(b'values')
+            new_peers = []
+            for v in values if isinstance(values, list) else []:
+                if not isinstance(v, bytes) or len(v) != COMPACT_PEER.size:
+                    continue
+                peer = decode_compact_peer(v)
+                if (peer['ip'], peer['port']) not in self.peers:
+                    self.peers.add((peer['ip'], peer['port']))
+                    new_peers.append(peer)
+            if new_peers and self.on_peers:
+                self.on_peers(new_peers)
+        self.step()
+
+    def finish(self):
+        self.is_done = True
+        if self in self.node.lookups:
+            self.node.lookups.remove(self)
+        log.debug('%s: done, %d peers' % (self, len(self.peers)))
+        if self.announce_port is not None:
+            self.responded.sort(
+                key=lambda v: distance(v[0].node_id, self.target))
+            for (contact, token) in self.responded[:K]:
+                if token:
+                    self.node.send_query(
+                        contact, 'announce_peer',
+                        {'info_hash': self.target, 'token': token,
+                         'port': self.announce_port},
+                        lambda contact, resp: None)
+        if self.on_done:
+            self.on_done(self)
+
+
+class KRPCError(Exception):
+    """Error reply to a query, with a BEP 5 error code."""
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
@@ -0,0 +1,209 @@
+"""Local Service Discovery (BEP 14): find peers on the local network.
+
+Announces are small HTTP-style messages multicast over UDP to
+239.192.152.143:6771:
+
+    BT-SEARCH * HTTP/1.1
+    Host: 239.192.152.143:6771
+    Port: <TCP listen port>
+    Infohash: <40 hex digits>       (one line per torrent)
+    cookie: <random token>
+
+Each running torrent's info hash is announced when it starts and every
+CONFIG['lsd_interval'] seconds, all of them batched into one datagram, and
+announces from other hosts are passed on as peers. The cookie identifies
+our own announces when multicast loopback brings them back.
+"""
+import os
+import time
+import socket
+import struct
+import logging
+
+from qqbt.config import CONFIG
+
+log = logging.getLogger(__name__)
+
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+MAX_DATAGRAM = 1400
+MIN_ANNOUNCE_INTERVAL = 60  # seconds between announces of one info hash
+ANNOUNCE_DELAY = 0.1        # seconds to gather torrents starting together
+
+
+def encode_announce(port, info_hashes, cookie, group=LSD_GROUP,
+                    group_port=LSD_PORT):
+    lines = ['BT-SEARCH * HTTP/1.1',
+             'Host: %s:%d' % (group, group_port),
+             'Port: %d' % port]
+    lines += ['Infohash: %s' % h.hex() for h in info_hashes]
+    lines += ['cookie: %s' % cookie, '', '']
+    return '\r\n'.join(lines).encode('ascii')
+
+
+def decode_announce(data):
+    """Parse an announce.
+
+    Returns:
+        (port, info_hashes, cookie) tuple
+
+    Raises:
+        LSDDecodeError: if data is not a valid announce
+    """
+    try:
+        text = data.decode('ascii')
+    except UnicodeDecodeError:
+        raise LSDDecodeError('Announce is not ASCII')
+    lines = text.split('\r\n')
+    if lines[0] != 'BT-SEARCH * HTTP/1.1':
+        raise LSDDecodeError('Not a BT-SEARCH request: %r' % lines[0])
+    port = None
+    info_hashes = []
+    cookie = None
+    for line in lines[1:]:
+        (name, sep, value) = line.partition(':')
+        if not sep:
+            continue
+        name = name.strip().lower()
+        value = value.strip()
+        try:
+            if name == 'port':
+                port = int(value)
+            elif name == 'infohash':
+                info_hash = bytes.fromhex(value)
+                if len(info_hash) == 20:
+                    info_hashes.append(info_hash)
+            elif name == 'cookie':
+                cookie = value
+        except ValueError:
+            raise LSDDecodeError('Bad %s header: %r' % (name, value))
+    if port is None or not 0 < port < 65536:
+        raise LSDDecodeError('Missing or bad Port header')
+    return (port, info_hashes, cookie)
+
+
+class LocalServiceDiscovery():
+    def __init__(self, conn_man, listen_port, on_peer, group=LSD_GROUP,
+                 port=LSD_PORT, interface='0.0.0.0'):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop to run on
+            listen_port (int): our TCP port, announced for peers to dial
+            on_peer (function): called with (info_hash, ip, port) for each
+                info hash in an announce from another host
+            group (str): multicast group
+            port (int): multicast UDP port
+            interface (str): address of the interface to multicast on
+        """
+        self.conn_man = conn_man
+        self.listen_port = listen_port
+        self.on_peer = on_peer
+        self.group = group
+        self.port = port
+        self.cookie = os.urandom(8).hex()
+        self.info_hashes = set()
+        self.pending = set()        # info hashes to announce soon
+        self.last_announce = {}     # info hash -> time of last announce
+        self.announce_timer = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                # Other LSD clients on this host listen on the same port.
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,
+                                     1)
+            self.sock.bind(('', port))
+            mreq = struct.pack('4s4s', socket.inet_aton(group),
+                               socket.inet_aton(interface))
+            self.sock.setsockopt(socket.IPPROTO_IP,
+                                 socket.IP_ADD_MEMBERSHIP, mreq)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                 socket.inet_aton(interface))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                                 1)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP,
+                                 1)
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+        self.conn_man.add_reader(self.sock, self.handle_readable)
+        self.refresh_timer = self.conn_man.call_every(
+            CONFIG['lsd_interval'], self.announce_all)
+
+    def add(self, info_hash):
+        """Announce info_hash now and periodically until removed."""
+        self.info_hashes.add(info_hash)
+        self.pending.add(info_hash)
+        if self.announce_timer is None:
+            self.announce_timer = self.conn_man.call_later(
+                ANNOUNCE_DELAY, self.send_pending)
+
+    def remove(self, info_hash):
+        self.info_hashes.discard(info_hash)
+        self.pending.discard(info_hash)
+
+    def announce_all(self):
+        self.pending |= self.info_hashes
+        self.send_pending()
+
+    def send_pending(self):
+        """Announce pending info hashes not announced too recently."""
+        self.announce_timer = None
+        now = time.monotonic()
+        since = now - MIN_ANNOUNCE_INTERVAL
+        due = sorted(h for h in self.pending
+                     if self.last_announce.get(h, since) <= since)
+        self.pending.difference_update(due)
+        # Pack as many 52 byte Infohash lines per datagram as fit beside the
+        # other headers.
+        per_datagram = (MAX_DATAGRAM - 120) // 52
+        for i in range(0, len(due), per_datagram):
+            batch = due[i:i+per_datagram]
+            data = encode_announce(self.listen_port, batch, self.cookie,
+                                   self.group, self.port)
+            try:
+                self.sock.sendto(data, (self.group, self.port))
+            except OSError as e:
+                log.warning('LSD announce failed: %s' % e)
+                return
+            for h in batch:
+                self.last_announce[h] = now
+        if due:
+            log.debug('LSD: announced %d torrents' % len(due))
+
+    def handle_readable(self):
+        while True:
+            try:
+                (data, (ip, _)) = self.sock.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.debug('LSD recvfrom: %s' % e)
+                return
+            self.handle_datagram(data, ip)
+
+    def handle_datagram(self, data, ip):
+        try:
+            (port, info_hashes, cookie) = decode_announce(data)
+        except LSDDecodeError as e:
+            log.debug('LSD: ignoring datagram from %s: %s' % (ip, e))
+            return
+        if cookie == self.cookie:
+            return
+        for info_hash in info_hashes:
+            log.debug('LSD: %s:%d has %s' % (ip, port, info_hash.hex()))
+            self.on_peer(info_hash, ip, port)
+
+    def close(self):
+        self.refresh_timer.cancel()
+        if self.announce_timer:
+            self.announce_timer.cancel()
+            self.announce_timer = None
+        self.conn_man.remove_reader(self.sock)
+        self.sock.close()
+
+
+class LSDDecodeError(Exception):
+    pass
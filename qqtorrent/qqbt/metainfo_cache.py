@@ -0,0 +1,282 @@
+"""Persistent on-disk cache of parsed torrent metainfo.
+
+Each torrent gets one entry file named by its info hash, holding the decoded
+metainfo in a flat binary layout together with derived structures (the
+piece-to-file index). Entries are mmapped on load, so piece hashes and file
+tables are never copied into Python objects until they are used. Download
+progress is kept in each torrent's resume file instead (see qqbt.resume).
+An index file maps .torrent paths to info hashes and records the mtime/size
+each entry was built from.
+
+Several processes may share a cache directory, e.g. the worker processes of
+one client. Writers merge their changes into the index on disk rather than
+overwriting it with their own copy, and read-only caches reload the index
+when they miss.
+
+Entries use native byte order and are only meant to be read on the machine
+that wrote them.
+"""
+import os
+import mmap
+import struct
+import logging
+from array import array
+from collections.abc import Sequence
+
+from qqbt import bencode
+from qqbt.torrent_metainfo import (
+    TorrentMetainfo, PieceHashes, TorrentDecodeError, SHA_LEN)
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'QQMC'
+VERSION = 3
+
+# magic, version, info_hash, mtime_ns, size, piece_length, length,
+# num_pieces, num_files, announce_len, name_len, url_list_len,
+# is_multiple_file
+HEADER = struct.Struct('=4sH20sqQQQIIIIIB')
+
+
+class MetainfoCache():
+    """Cache of parsed metainfo, keyed by info hash."""
+    def __init__(self, cache_dir, read_only=False):
+        """
+        Args:
+            cache_dir (str): directory for cache files, created if missing
+            read_only (bool): never write entries, e.g. in a process whose
+                parent owns the cache; missed files are parsed each time
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.read_only = read_only
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index_path = os.path.join(self.cache_dir, 'index')
+        self.index = self._load_index()
+
+    def load_metainfo(self, filename):
+        """Return metainfo for a .torrent file, from the cache if valid.
+
+        The file is parsed and a cache entry written on a miss.
+        """
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        entry = self._lookup(path, st)
+        if entry is None and self.read_only:
+            # The writer may have stored it since we loaded the index.
+            self.index = self._load_index()
+            entry = self._lookup(path, st)
+        if entry:
+            log.debug('load_metainfo: cache hit: %s' % path)
+            return entry.to_metainfo()
+
+        with open(path, 'rb') as f:
+            metainfo = TorrentMetainfo(f.read())
+        if self.read_only:
+            return metainfo
+        self.store(path, st, metainfo)
+        entry = self._lookup(path, st)
+        if entry:
+            metainfo.cache_entry = entry
+        return metainfo
+
+    def store(self, path, st, metainfo):
+        """Write a cache entry for metainfo parsed from path."""
+        entry_path = self._entry_path(metainfo.info_hash)
+        tmp_path = '%s.%d.tmp' % (entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(MetainfoCacheEntry.serialize(metainfo, st))
+        os.replace(tmp_path, entry_path)
+
+        # Merge with entries other processes have stored since we loaded it.
+        self.index = self._load_index()
+        self.index[path.encode('utf-8')] = [
+            metainfo.info_hash, st.st_mtime_ns, st.st_size]
+        self._save_index()
+
+    def _lookup(self, path, st):
+        record = self.index.get(path.encode('utf-8'))
+        if not record:
+            return None
+        (info_hash, mtime_ns, size) = record
+        if mtime_ns != st.st_mtime_ns or size != st.st_size:
+            return None
+        try:
+            entry = MetainfoCacheEntry(self._entry_path(info_hash))
+        except (OSError, ValueError, MetainfoCacheError) as e:
+            log.warning('Discarding cache entry for %s: %s' % (path, e))
+            return None
+        if (entry.info_hash != info_hash or entry.mtime_ns != mtime_ns
+                or entry.size != size):
+            entry.close()
+            return None
+        return entry
+
+    def _entry_path(self, info_hash):
+        return os.path.join(self.cache_dir, info_hash.hex() + '.qqmc')
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                return bencode.decode(f.read())
+        except FileNotFoundError:
+            return {}
+        except bencode.BencodeDecodeError:
+            log.warning('Corrupt metainfo cache index, rebuilding')
+            return {}
+
+    def _save_index(self):
+        tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode.encode(self.index))
+        os.replace(tmp_path, self.index_path)
+
+
+class MetainfoCacheEntry():
+    """An mmapped cache entry for one torrent."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise MetainfoCacheError('Truncated cache entry')
+        (magic, version, self.info_hash, self.mtime_ns, self.size,
+         self.piece_length, self.length, self.num_pieces, self.num_files,
+         announce_len, name_len, url_list_len,
+         is_multiple_file) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise MetainfoCacheError('Unsupported cache entry version')
+        self.is_multiple_file = bool(is_multiple_file)
+
+        ofs = HEADER.size
+        self.announce = self.mm[ofs:ofs+announce_len].decode('utf-8')
+        ofs += announce_len
+        self.name = self.mm[ofs:ofs+name_len].decode('utf-8')
+        ofs += name_len
+        url_list = self.mm[ofs:ofs+url_list_len].decode('utf-8')
+        self.url_list = url_list.split('\n') if url_list else []
+        ofs += url_list_len
+
+        sections = self._section_layout(
+            ofs, self.num_pieces, self.num_files, self._paths_length(ofs))
+        if sections['end'] != len(self.mm):
+            raise MetainfoCacheError('Cache entry size mismatch')
+        view = memoryview(self.mm)
+        self.pieces = view[sections['pieces']]
+        self.file_lengths = view[sections['file_lengths']].cast('Q')
+        self.path_offsets = view[sections['path_offsets']].cast('Q')
+        self.paths = view[sections['paths']]
+        self.piece_file_index = view[sections['piece_file_index']].cast('I')
+
+    def _paths_length(self, ofs):
+        # The path offsets table precedes the paths blob and ends with its
+        # total length.
+        sections = self._section_layout(
+            ofs, self.num_pieces, self.num_files, 0)
+        end = sections['path_offsets'].stop
+        (paths_length,) = struct.unpack_from('=Q', self.mm, end - 8)
+        return paths_length
+
+    @staticmethod
+    def _section_layout(ofs, num_pieces, num_files, paths_length):
+        def section(length, align=8):
+            nonlocal ofs
+            ofs += -ofs % align
+            s = slice(ofs, ofs + length)
+            ofs += length
+            return s
+        layout = {}
+        layout['pieces'] = section(num_pieces * SHA_LEN)
+        layout['file_lengths'] = section(num_files * 8)
+        layout['path_offsets'] = section((num_files + 1) * 8)
+        layout['paths'] = section(paths_length)
+        layout['piece_file_index'] = section(num_pieces * 4)
+        layout['end'] = ofs
+        return layout
+
+    @classmethod
+    def serialize(cls, metainfo, st):
+        info = metainfo.info
+        announce = metainfo.announce.encode('utf-8')
+        name = metainfo.name.encode('utf-8')
+        url_list = '\n'.join(metainfo.url_list).encode('utf-8')
+        is_multiple_file = info['format'] == 'MULTIPLE_FILE'
+        files = info['files'] if is_multiple_file else []
+        num_pieces = len(info['pieces'])
+
+        paths = [f['path'].encode('utf-8') for f in files]
+        path_offsets = array('Q', [0])
+        for p in paths:
+            path_offsets.append(path_offsets[-1] + len(p))
+        paths_blob = b''.join(paths)
+
+        header = HEADER.pack(
+            MAGIC, VERSION, metainfo.info_hash, st.st_mtime_ns, st.st_size,
+            info['piece_length'], info['length'], num_pieces, len(files),
+            len(announce), len(name), len(url_list), is_multiple_file)
+        ofs = len(header) + len(announce) + len(name) + len(url_list)
+        layout = cls._section_layout(ofs, num_pieces, len(files),
+                                     len(paths_blob))
+        buf = bytearray(layout['end'])
+        buf[:ofs] = header + announce + name + url_list
+        buf[layout['pieces']] = info['pieces'].buf[:num_pieces * SHA_LEN]
+        buf[layout['file_lengths']] = array(
+            'Q', (f['length'] for f in files)).tobytes()
+        buf[layout['path_offsets']] = path_offsets.tobytes()
+        buf[layout['paths']] = paths_blob
+        buf[layout['piece_file_index']] = array(
+            'I', metainfo.get_piece_file_index()).tobytes()
+        return bytes(buf)
+
+    def to_metainfo(self):
+        info = {
+            'piece_length': self.piece_length,
+            'pieces': PieceHashes(self.pieces),
+            'length': self.length,
+        }
+        if self.is_multiple_file:
+            info['format'] = 'MULTIPLE_FILE'
+            info['files'] = CachedFileList(self)
+        else:
+            info['format'] = 'SINGLE_FILE'
+            info['files'] = None
+        return TorrentMetainfo.from_fields(
+            self.announce, self.info_hash, self.name, info,
+            piece_file_index=self.piece_file_index, cache_entry=self,
+            url_list=self.url_list)
+
+    def close(self):
+        for name in ('pieces', 'file_lengths', 'path_offsets', 'paths',
+                     'piece_file_index'):
+            v = self.__dict__.pop(name, None)
+            if v is not None:
+                v.release()
+        self.mm.close()
+
+
+class CachedFileList(Sequence):
+    """The files of a MULTIPLE_FILE torrent, read lazily from a cache entry."""
+    def __init__(self, entry):
+        self.entry = entry
+
+    def lengths(self):
+        return self.entry.file_lengths.tolist()
+
+    def __len__(self):
+        return self.entry.num_files
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('file index out of range')
+        e = self.entry
+        path = e.paths[e.path_offsets[index]:e.path_offsets[index+1]]
+        return {
+            'length': e.file_lengths[index],
+            'path': path.tobytes().decode('utf-8')
+        }
+
+
+class MetainfoCacheError(TorrentDecodeError):
+    pass
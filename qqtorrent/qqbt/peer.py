@@ -1,12 +1,33 @@
+import time
 import struct
 import bitarray
 import logging
 import random
 
+from qqbt import bencode
 from qqbt.config import CONFIG
+from qqbt.pex import PeerExchange
 
 log = logging.getLogger(__name__)
 
+# Weight of the latest sample in the smoothed download rate.
+RATE_SMOOTHING = 0.5
+
+# Reserved handshake bits (byte, mask) for the extension protocol (BEP 10)
+# and the fast extension (BEP 6).
+EXTENSION_PROTOCOL_BIT = (5, 0x10)
+FAST_EXTENSION_BIT = (7, 0x04)
+
+# Extended message ids we assign, sent in our extension handshake.
+EXTENSIONS = {'ut_pex': 1}
+
+MESSAGE_TYPES = {
+    0: 'choke', 1: 'unchoke', 2: 'interested', 3: 'not_interested',
+    4: 'have', 5: 'bitfield', 6: 'request', 7: 'piece', 8: 'cancel',
+    9: 'port', 13: 'suggest_piece', 14: 'have_all', 15: 'have_none',
+    16: 'reject_request', 17: 'allowed_fast', 20: 'extended'
+}
+
 
 class TorrentPeer():
     """A peer available for download/upload of a torrent."""
@@ -17,16 +38,46 @@ class TorrentPeer():
         self.port = port
         self.conn = None
         self.recv_buffer = b''
-
+        self.tick_timer = None
+        self.request_timer = None
+        self.last_receive = None
+        self.last_write = None
+
+        # Performance of the current connection.
+        self.connected_at = None
+        self.download_rate = 0.0    # bytes/s, smoothed
+        self.bytes_since_update = 0
+        self.last_rate_update = None
+        self.is_snubbed = False
+
+        # Performance history, kept across connections to rank dials.
+        self.best_rate = 0.0
+        self.num_rotations = 0
+        self.hash_failures = 0
+        self.is_local = False       # found on the local network (LSD)
+
+        self.is_connecting = False
+        self.pending_conn = None    # uTP dial awaiting its handshake
+        self.use_utp = torrent.utp is not None
+        self.is_inbound = False
         self.is_started = False
         self.conn_failed = False
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
         self.peer_interested = False
-
-        self.peer_pieces = [False for _ in range(
-                            len(self.torrent.metainfo.info['pieces']))]
+        self.supports_extensions = False
+        self.supports_fast = False
+        self.peer_extensions = {}   # extension name -> peer's message id
+        self.pex = None
+
+        # Pieces the peer has; allocated on the first have or bitfield, and
+        # left unallocated for have_all/have_none.
+        self.peer_pieces = None
+        self.has_all = False
+        self.allowed_fast = set()
+        self.suggested_pieces = []
+        self.rejected_pieces = set()
         self.requested_piece = None
 
     def __repr__(self):
@@ -34,7 +85,35 @@ class TorrentPeer():
                 .format(**self.__dict__))
 
     def connect(self):
-        self.torrent.conn_man.connect_peer(self)
+        self.is_connecting = True
+        if self.use_utp:
+            self.pending_conn = self.torrent.utp.connect_peer(self)
+        else:
+            self.torrent.conn_man.connect_peer(self)
+
+    def is_active(self):
+        """Whether the peer holds (or is opening) a connection."""
+        return self.is_connecting or self.conn is not None
+
+    def is_dial_candidate(self):
+        # Inbound peers' ports are the remote end's ephemeral ports.
+        return not (self.is_active() or self.is_started or self.conn_failed
+                    or self.is_inbound or self.ip in self.torrent.banned_ips)
+
+    def is_trusted(self):
+        """Whether the peer has never sent us bad data."""
+        return self.hash_failures == 0
+
+    def get_dial_rank(self):
+        """Sort key putting peers that were fast before first, then untried
+        peers, then peers rotated out for being slow. Peers on the local
+        network come before all others."""
+        return (not self.is_local, self.num_rotations, -self.best_rate)
+
+    def has_piece(self, piece_index):
+        if self.has_all:
+            return True
+        return self.peer_pieces is not None and self.peer_pieces[piece_index]
 
     def run_download(self):
         """Take next action to begin or continue downloading from peer."""
@@ -42,15 +121,31 @@ class TorrentPeer():
             self.send_handshake()
         elif self.peer_choking:
             self.send_message('interested')
+            if self.requested_piece is None and not self.is_held_back():
+                self.request_allowed_fast_piece()
         elif self.requested_piece is not None:
             # Wait for piece to finish downloading.
             pass
+        elif self.is_snubbed:
+            # Wait for a late block before asking for more.
+            pass
+        elif self.is_held_back():
+            # Too much downloaded data in memory; only finish pieces that
+            # already hold blocks, e.g. ones another peer dropped, until it
+            # drains.
+            piece = self._choose_partial_piece()
+            if piece is not None:
+                self.requested_piece = piece
+                self.torrent.piece_requests[piece].append(self)
+                self.request_next_block(piece, None)
         else:
             # Request next piece.
             try:
                 piece = self._choose_next_piece()
             except PeerNoUnrequestedPiecesError:
+                self.stop_timers()
                 self.conn.disconnect()
+                self.conn = None
                 self.torrent.handle_peer_stopped(self)
                 return
 
@@ -58,22 +153,88 @@ class TorrentPeer():
             self.torrent.piece_requests[piece].append(self)
             self.request_next_block(piece, None)
 
+    def is_held_back(self):
+        """Whether new pieces must wait for the memory budget to drain.
+
+        If so, run_download is called again once it has.
+        """
+        budget = self.torrent.budget
+        if budget is None or not budget.is_full():
+            return False
+        budget.wait(self.handle_budget_available)
+        return True
+
+    def handle_budget_available(self):
+        if self.conn and self.is_started and self.requested_piece is None:
+            self.run_download()
+
+    def request_allowed_fast_piece(self):
+        """While choked, request a piece the peer lets us fetch anyway."""
+        for i in sorted(self.allowed_fast):
+            if (not self.torrent.complete_pieces[i]
+                    and self.torrent.is_wanted(i)
+                    and not self.torrent.piece_requests[i]
+                    and i not in self.rejected_pieces and self.has_piece(i)):
+                self.requested_piece = i
+                self.torrent.piece_requests[i].append(self)
+                self.request_next_block(i, None)
+                return
+
+    def _choose_partial_piece(self):
+        """Return a piece nobody is fetching that has blocks received, or
+        None."""
+        failed = self.torrent.failed_blocks
+        for i in self.torrent.get_piece_order():
+            if (self.torrent.piece_blocks[i]
+                    and not self.torrent.piece_requests[i]
+                    and i not in self.torrent.verifying_pieces
+                    and i not in self.rejected_pieces and self.has_piece(i)
+                    and (i not in failed or self.is_trusted())):
+                return i
+        return None
+
     def _choose_next_piece(self):
         """Return piece index of best piece to fetch from peer next."""
-        num_pieces = len(self.torrent.metainfo.info['pieces'])
-        # Get first piece that is not complete, not already request from any
-        # peer, and is available from this peer.
-        for i in range(num_pieces):
+        # Get first wanted piece that is not complete, not already request
+        # from any peer, and is available from this peer, in priority order.
+        # Pieces the peer suggested come first. Pieces that failed
+        # verification are re-fetched from trusted peers, or, if no
+        # connected peer holding them is trusted, from others once they
+        # have nothing else to fetch.
+        failed = self.torrent.failed_blocks
+        # Pieces open streams are waiting for go first. The one under a
+        # stream's cursor may be raced by a second peer to cut latency.
+        for (i, is_urgent) in self.torrent.get_stream_pieces():
+            requests = self.torrent.piece_requests[i]
+            max_requests = 2 if is_urgent and i not in failed else 1
+            if (len(requests) < max_requests and self not in requests
+                    and i not in self.rejected_pieces and self.has_piece(i)
+                    and (i not in failed or self.is_trusted()
+                         or not self.torrent.has_trusted_holder(i))):
+                return i
+        order = self.torrent.get_piece_order()
+        suggested = [i for i in self.suggested_pieces
+                     if self.torrent.is_wanted(i)]
+        last_resort = None
+        for i in suggested + list(order):
             if (not self.torrent.complete_pieces[i]
                     and not self.torrent.piece_requests[i]
-                    and self.peer_pieces[i]):
-                return i
+                    and i not in self.rejected_pieces and self.has_piece(i)):
+                if i not in failed or self.is_trusted():
+                    return i
+                if (last_resort is None
+                        and not self.torrent.has_trusted_holder(i)):
+                    last_resort = i
+        if last_resort is not None:
+            return last_resort
 
         # Engdgame. Get a piece that is not complete and is available from this
         # peer, even if already requested from another peer.
-        candidates = [i for i in range(num_pieces)
+        # Failed pieces stay with their single re-fetching peer.
+        candidates = [i for i in order
                       if not self.torrent.complete_pieces[i]
-                      and self.peer_pieces[i]]
+                      and i not in self.rejected_pieces and self.has_piece(i)
+                      and i not in failed]
         if not candidates:
             # Raise exception so we can disconnect.
             raise PeerNoUnrequestedPiecesError
@@ -82,18 +243,124 @@ class TorrentPeer():
     # =====
 
     def handle_connection_made(self, conn):
+        self.is_connecting = False
+        self.pending_conn = None
         self.conn = conn
+        now = time.monotonic()
+        self.last_receive = self.last_write = now
+        self.connected_at = self.last_rate_update = now
+        self.tick_timer = self.torrent.conn_man.call_every(
+            CONFIG['peer_tick_interval'], self.handle_tick)
         log.info('%s: handle_connection_made' % self)
         self.run_download()
 
+    def stop_timers(self):
+        if self.tick_timer:
+            self.tick_timer.cancel()
+            self.tick_timer = None
+        if self.request_timer:
+            self.request_timer.cancel()
+            self.request_timer = None
+
+    def disconnect(self):
+        """Drop the connection and reset state so the peer can be redialed.
+
+        Performance history is kept.
+        """
+        self.stop_timers()
+        if self.requested_piece is not None:
+            self.torrent.release_piece(self, self.requested_piece)
+        if self.conn:
+            self.conn.disconnect()
+        elif self.pending_conn:
+            # Cancel a dial still waiting for its handshake.
+            self.pending_conn.disconnect()
+        self.conn = None
+        self.pending_conn = None
+        self.recv_buffer = b''
+        self.is_connecting = False
+        self.is_started = False
+        self.conn_failed = False
+        self.am_choking = True
+        self.am_interested = False
+        self.peer_choking = True
+        self.peer_interested = False
+        self.supports_extensions = False
+        self.supports_fast = False
+        self.peer_extensions = {}
+        self.pex = None
+        self.peer_pieces = None
+        self.has_all = False
+        self.allowed_fast = set()
+        self.suggested_pieces = []
+        self.rejected_pieces = set()
+        self.requested_piece = None
+        self.download_rate = 0.0
+        self.bytes_since_update = 0
+        self.is_snubbed = False
+
+    def update_rate(self, now):
+        elapsed = now - self.last_rate_update
+        if elapsed <= 0:
+            return
+        rate = self.bytes_since_update / elapsed
+        self.download_rate = (RATE_SMOOTHING * rate
+                              + (1 - RATE_SMOOTHING) * self.download_rate)
+        self.best_rate = max(self.best_rate, self.download_rate)
+        self.bytes_since_update = 0
+        self.last_rate_update = now
+
+    def handle_block_received(self, length):
+        self.bytes_since_update += length
+        if self.is_snubbed:
+            log.info('%s: no longer snubbed' % self)
+            self.is_snubbed = False
+        if self.request_timer:
+            self.request_timer.cancel()
+            self.request_timer = None
+
+    def handle_request_timeout(self):
+        """No block arrived in time: stop relying on this peer."""
+        self.request_timer = None
+        if self.requested_piece is None:
+            return
+        log.info('%s: snubbed on piece %d' % (self, self.requested_piece))
+        self.is_snubbed = True
+        self.torrent.release_piece(self, self.requested_piece)
+
+    def handle_tick(self):
+        """Periodic upkeep: keep-alives, idle timeout and PEX."""
+        now = time.monotonic()
+        self.update_rate(now)
+        if now - self.last_receive > CONFIG['peer_idle_timeout']:
+            log.info('%s: idle timeout' % self)
+            self.disconnect()
+            self.conn_failed = True
+            self.torrent.handle_peer_stopped(self)
+            return
+        if now - self.last_write >= CONFIG['keepalive_interval']:
+            self.send_keepalive()
+        if self.pex:
+            self.pex.maybe_send()
+
     def handle_connection_failed(self):
         log.info('%s: handle_connection_failed' % self)
-        self.conn_failed = True
+        self.stop_timers()
+        self.is_connecting = False
+        self.pending_conn = None
+        if self.use_utp:
+            # Not reachable over uTP; the next dial tries TCP.
+            self.use_utp = False
+        else:
+            self.conn_failed = True
         self.conn = None
         self.torrent.handle_peer_stopped(self)
 
     def handle_connection_lost(self):
         log.info('%s: handle_connection_lost' % self)
+        self.stop_timers()
+        if self.requested_piece is not None:
+            self.torrent.release_piece(self, self.requested_piece)
         self.conn_failed = True
         self.conn = None
         self.torrent.handle_peer_stopped(self)
@@ -102,6 +369,7 @@ class TorrentPeer():
         """Parse individual messages from the data."""
         #log.info('%s: handle_data_received: %s' % (self, data))
         # TODO: mark connection failed on incomplete message
+        self.last_receive = time.monotonic()
         data = self.recv_buffer + recv_data
         while data:
             if not self.is_started:
@@ -111,21 +379,95 @@ class TorrentPeer():
             if nbytes == 0:
                 break
             data = data[nbytes:]
+            if self.conn is None:
+                # Dropped while handling the message, e.g. banned.
+                data = b''
+                break
         self.recv_buffer = data
 
     def handle_torrent_completed(self):
+        self.stop_timers()
         if self.conn:
             self.conn.disconnect()
+        self.conn = None
         self.requested_piece = None
 
+    def handle_torrent_stopped(self):
+        self.disconnect()
+
     def handle_handshake_ok(self):
+        if self.supports_fast:
+            self.send_have_pieces()
+        if self.supports_extensions:
+            self.send_extended_handshake()
+        self.run_download()
+
+    def handle_choke(self):
+        if self.requested_piece is None:
+            return
+        if self.supports_fast:
+            # Outstanding requests are answered or explicitly rejected.
+            return
+        # Without the fast extension a choke drops our requests.
+        self.torrent.release_piece(self, self.requested_piece)
+
+    def handle_reject(self, index, begin, length):
+        if index != self.requested_piece:
+            return
+        log.debug('%s: request rejected: %d/%d' % (self, index, begin))
+        self.rejected_pieces.add(index)
+        self.torrent.release_piece(self, index)
         self.run_download()
 
+    def is_valid_piece(self, piece_index, msg_type):
+        """Whether a piece index sent by the peer is in range; messages
+        naming pieces the torrent doesn't have are ignored."""
+        if piece_index < len(self.torrent.complete_pieces):
+            return True
+        log.info('%s: ignoring %s for piece %d out of range'
+                 % (self, msg_type, piece_index))
+        return False
+
+    def handle_allowed_fast(self, piece_index):
+        self.allowed_fast.add(piece_index)
+        if self.peer_choking and self.requested_piece is None:
+            self.request_allowed_fast_piece()
+
+    def handle_extended(self, payload):
+        if not payload:
+            raise PeerProtocolError('Empty extended message')
+        ext_id = payload[0]
+        data = payload[1:]
+        if ext_id == 0:
+            self.handle_extended_handshake(data)
+        elif ext_id == EXTENSIONS['ut_pex'] and self.pex:
+            self.pex.handle_message(data)
+        else:
+            log.debug('%s: unknown extended message: %d' % (self, ext_id))
+
+    def handle_extended_handshake(self, data):
+        try:
+            msg = bencode.decode(data)
+            m = msg[b'm']
+            self.peer_extensions = {k.decode('utf-8'): v for (k, v)
+                                    in m.items() if isinstance(v, int) and v}
+        except (bencode.BencodeDecodeError, KeyError, TypeError,
+                AttributeError, UnicodeDecodeError):
+            log.debug('%s: malformed extension handshake' % self)
+            return
+        log.debug('%s: peer extensions: %s' % (self, self.peer_extensions))
+        if 'ut_pex' in self.peer_extensions and self.pex is None:
+            self.pex = PeerExchange(self)
+            self.pex.maybe_send()
+
     def handle_unchoke(self):
+        # Fast peers reject all pending requests when they choke us, so a
+        # rejection only stands until the next unchoke.
+        self.rejected_pieces = set()
         self.run_download()
 
     def handle_keepalive(self):
-        # TODO
+        # Any data received already resets the idle timeout.
         pass
 
     # =====
@@ -133,14 +475,45 @@ class TorrentPeer():
     def write_message(self, msg):
         """Write message data to wire."""
         if self.conn:
+            self.last_write = time.monotonic()
             self.conn.write(msg)
 
+    def send_keepalive(self):
+        self.write_message(struct.pack('!L', 0))
+
     def send_handshake(self):
         log.debug('%s: send_handshake' % self)
         msg = self.build_handshake(
-            self.torrent.metainfo.info_hash, CONFIG['peer_id'])
+            self.torrent.metainfo.info_hash, CONFIG['peer_id'],
+            self.build_reserved())
         self.write_message(msg)
 
+    def send_have_pieces(self):
+        """Send have_all, have_none or a bitfield as the first message."""
+        complete = [v is not None for v in self.torrent.complete_pieces]
+        if all(complete):
+            self.send_message('have_all')
+        elif not any(complete):
+            self.send_message('have_none')
+        else:
+            ba = bitarray.bitarray(complete, endian='big')
+            self.send_message('bitfield', bitfield=ba.tobytes())
+
+    def send_extended_handshake(self):
+        msg = {'m': EXTENSIONS, 'v': 'qqbt'}
+        port = getattr(self.torrent.conn_man, 'listen_port', None)
+        if port:
+            msg['p'] = port
+        self.send_message('extended', ext_id=0, data=bencode.encode(msg))
+
+    def send_extended(self, name, msg):
+        """Send an extension message if the peer supports it."""
+        ext_id = self.peer_extensions.get(name)
+        if ext_id is None:
+            return
+        self.send_message('extended', ext_id=ext_id,
+                          data=bencode.encode(msg))
+
     def send_message(self, msg_type, **params):
         """Validate, build, and send message to peer."""
         if not self.is_started:
@@ -148,31 +521,48 @@ class TorrentPeer():
                 'Attempted to send message before handshake received')
         log.debug('%s: send_message: type=%s params=%s' %
                   (self, msg_type, params))
-        if msg_type == 'request' and self.peer_choking:
+        if (msg_type == 'request' and self.peer_choking
+                and params['index'] not in self.allowed_fast):
             log.debug('Attempted to send message to choking peer')
-            return
+            return False
         msg = self.build_message(msg_type, **params)
         self.write_message(msg)
+        return True
 
     def request_next_block(self, piece_index, begin):
         piece_length = self.torrent.metainfo.get_piece_length(piece_index)
         begin = 0 if begin is None else begin + CONFIG['block_length']
+        # Skip blocks we hold already, e.g. restored from a resume file.
+        while (begin < piece_length
+               and self.torrent.has_block(piece_index, begin)):
+            begin += CONFIG['block_length']
+        if begin >= piece_length:
+            return
         block_length = min(piece_length - begin, CONFIG['block_length'])
 
-        self.send_message(
-            'request', index=piece_index, begin=begin, length=block_length)
+        if self.send_message('request', index=piece_index, begin=begin,
+                             length=block_length):
+            if self.request_timer:
+                self.request_timer.cancel()
+            self.request_timer = self.torrent.conn_man.call_later(
+                CONFIG['request_timeout'], self.handle_request_timeout)
 
     # =====
 
     def parse_handshake(self, data):
         """Parse a handshake and return bytes consumed, or raise exception."""
-        # TODO: check for incomplete message
         pstrlen = int(data[0])
+        if len(data) < 49 + pstrlen:
+            return 0
         handshake_data = data[1: 49 + pstrlen]
         handshake = self.decode_handshake(pstrlen, handshake_data)
         if handshake['pstr'] != 'BitTorrent protocol':
             raise PeerProtocolError('Protocol not recognized')
         self.is_started = True
+        (byte, mask) = EXTENSION_PROTOCOL_BIT
+        self.supports_extensions = bool(handshake['reserved'][byte] & mask)
+        (byte, mask) = FAST_EXTENSION_BIT
+        self.supports_fast = bool(handshake['reserved'][byte] & mask)
         log.debug('%s: received_handshake' % self)
         self.handle_handshake_ok()
         return(1 + len(handshake_data))
@@ -189,8 +579,8 @@ class TorrentPeer():
         nbytes += 4
 
         if length_prefix == 0:
-            # TODO: handle keep-alive
             log.debug('%s: receive_message: keep-alive' % self)
+            self.handle_keepalive()
             return nbytes
 
         if nbytes + length_prefix > len(data):
@@ -207,9 +597,7 @@ class TorrentPeer():
         """Perform actions in response to an incoming peer message."""
         msg_id = msg_dict['msg_id']
         payload = msg_dict['payload']
-        msg_types = ['choke', 'unchoke', 'interested', 'not_interested',
-                     'have', 'bitfield', 'request', 'piece', 'cancel', 'port']
-        msg_type = msg_types[msg_id]
+        msg_type = MESSAGE_TYPES.get(msg_id)
 
         log.debug('%s: receive_msg: id=%s type=%s payload=%s%s' %
                   (self, msg_id, msg_type,
@@ -220,6 +608,7 @@ class TorrentPeer():
         if msg_id == 0:
             assert(msg_type == 'choke')
             self.peer_choking = True
+            self.handle_choke()
         elif msg_id == 1:
             assert(msg_type == 'unchoke')
             self.peer_choking = False
@@ -233,7 +622,13 @@ class TorrentPeer():
         elif msg_id == 4:
             assert(msg_type == 'have')
             (index,) = struct.unpack('!L', payload)
-            self.peer_pieces[index] = True
+            if not self.is_valid_piece(index, msg_type):
+                return
+            if not self.has_all:
+                if self.peer_pieces is None:
+                    self.peer_pieces = [False] * len(
+                        self.torrent.metainfo.info['pieces'])
+                self.peer_pieces[index] = True
         elif msg_id == 5:
             assert(msg_type == 'bitfield')
             bitfield = payload
@@ -244,6 +639,11 @@ class TorrentPeer():
             self.peer_pieces = ba.tolist()[:num_pieces]
         elif msg_id == 6:
             assert(msg_type == 'request')
+            if self.supports_fast and self.am_choking:
+                # We don't upload to choked peers; say so instead of
+                # leaving the request hanging.
+                self.send_message('reject_request',
+                                  **self.decode_request(payload))
         elif msg_id == 7:
             assert(msg_type == 'piece')
             (index, begin) = struct.unpack('!LL', payload[:8])
@@ -253,18 +653,53 @@ class TorrentPeer():
             assert(msg_type == 'cancel')
         elif msg_id == 9:
             assert(msg_type == 'port')
+        elif msg_id == 13:
+            assert(msg_type == 'suggest_piece')
+            (index,) = struct.unpack('!L', payload)
+            if not self.is_valid_piece(index, msg_type):
+                return
+            if index not in self.suggested_pieces:
+                self.suggested_pieces.append(index)
+        elif msg_id == 14:
+            assert(msg_type == 'have_all')
+            self.has_all = True
+            self.peer_pieces = None
+        elif msg_id == 15:
+            assert(msg_type == 'have_none')
+            self.has_all = False
+            self.peer_pieces = None
+        elif msg_id == 16:
+            assert(msg_type == 'reject_request')
+            self.handle_reject(**self.decode_request(payload))
+        elif msg_id == 17:
+            assert(msg_type == 'allowed_fast')
+            (index,) = struct.unpack('!L', payload)
+            if not self.is_valid_piece(index, msg_type):
+                return
+            self.handle_allowed_fast(index)
+        elif msg_id == 20:
+            assert(msg_type == 'extended')
+            self.handle_extended(payload)
         else:
-            raise PeerProtocolMessageTypeError(
-                'Unrecognized message id: %s' % msg_id)
+            # Unknown messages are ignored, as the spec allows.
+            log.debug('%s: unrecognized message id: %s' % (self, msg_id))
 
     # =====
 
     @staticmethod
-    def build_handshake(info_hash, peer_id):
+    def build_reserved():
+        """Reserved handshake bytes advertising our protocol extensions."""
+        reserved = bytearray(8)
+        for (byte, mask) in (EXTENSION_PROTOCOL_BIT, FAST_EXTENSION_BIT):
+            reserved[byte] |= mask
+        return bytes(reserved)
+
+    @staticmethod
+    def build_handshake(info_hash, peer_id, reserved=bytes(8)):
         """<pstrlen><pstr><reserved><info_hash><peer_id>"""
         pstr = b'BitTorrent protocol'
-        fmt = '!B%ds8x20s20s' % len(pstr)
-        msg = struct.pack(fmt, len(pstr), pstr, info_hash, peer_id)
+        fmt = '!B%ds8s20s20s' % len(pstr)
+        msg = struct.pack(fmt, len(pstr), pstr, reserved, info_hash, peer_id)
         return msg
 
     @staticmethod
@@ -275,7 +710,7 @@ class TorrentPeer():
         # TODO: implement all
         if msg_type == 'choke':
             msg_id = 0
-        elif msg_id == 'unchoke':
+        elif msg_type == 'unchoke':
             msg_id = 1
         elif msg_type == 'interested':
             msg_id = 2
@@ -285,8 +720,9 @@ class TorrentPeer():
             msg_id = 4
         elif msg_type == 'bitfield':
             msg_id = 5
-        elif msg_type == 'request':
-            msg_id = 6
+            payload = params['bitfield']
+        elif msg_type in ('request', 'reject_request'):
+            msg_id = 6 if msg_type == 'request' else 16
             payload = struct.pack('!LLL',
                                   params['index'], params['begin'],
                                   params['length'])
@@ -296,6 +732,13 @@ class TorrentPeer():
             msg_id = 8
         elif msg_type == 'port':
             msg_id = 9
+        elif msg_type == 'have_all':
+            msg_id = 14
+        elif msg_type == 'have_none':
+            msg_id = 15
+        elif msg_type == 'extended':
+            msg_id = 20
+            payload = bytes([params['ext_id']]) + params['data']
         else:
             raise PeerProtocolMessageTypeError(
                 'Unrecognized message id: %s' % msg_id)
@@ -308,15 +751,21 @@ class TorrentPeer():
 
     @staticmethod
     def decode_handshake(pstrlen, data):
-        fmt = '!%ds8x20s20s' % pstrlen
+        fmt = '!%ds8s20s20s' % pstrlen
         fields = struct.unpack(fmt, data)
 
         return {
             'pstr': fields[0].decode('utf-8'),
-            'info_hash': fields[1],
-            'peer_id': fields[2]
+            'reserved': fields[1],
+            'info_hash': fields[2],
+            'peer_id': fields[3]
         }
 
+    @staticmethod
+    def decode_request(payload):
+        (index, begin, length) = struct.unpack('!LLL', payload)
+        return {'index': index, 'begin': begin, 'length': length}
+
     @staticmethod
     def decode_message(data):
         msg_id = int(data[0])
@@ -328,6 +777,56 @@ class TorrentPeer():
         }
 
 
+class InboundPeerHandshake():
+    """An accepted connection waiting for the handshake to name its torrent.
+
+    Once the info hash has arrived, find_peer(info_hash, ip, port) returns the
+    torrent's TorrentPeer, which takes over the connection and is fed the data
+    received so far. The connection is dropped if no peer is returned.
+    """
+    def __init__(self, ip, port, find_peer):
+        self.ip = ip
+        self.port = port
+        self.find_peer = find_peer
+        self.conn = None
+        self.recv_buffer = b''
+
+    def __repr__(self):
+        return ('InboundPeerHandshake(ip={ip}, port={port})'
+                .format(**self.__dict__))
+
+    def handle_connection_made(self, conn):
+        self.conn = conn
+
+    def handle_data_received(self, recv_data):
+        self.recv_buffer += recv_data
+        if not self.recv_buffer:
+            return
+        pstrlen = int(self.recv_buffer[0])
+        info_hash_end = 1 + pstrlen + 8 + 20
+        if len(self.recv_buffer) < info_hash_end:
+            return
+
+        info_hash = self.recv_buffer[info_hash_end-20:info_hash_end]
+        peer = self.find_peer(info_hash, self.ip, self.port)
+        if peer is None:
+            log.info('%s: rejected' % self)
+            self.conn.disconnect()
+            self.conn = None
+            return
+        log.info('%s: handing off to %s' % (self, peer))
+        self.conn.peer = peer
+        peer.handle_connection_made(self.conn)
+        peer.handle_data_received(self.recv_buffer)
+        self.conn = None
+
+    def handle_connection_failed(self):
+        self.conn = None
+
+    def handle_connection_lost(self):
+        self.conn = None
+
+
 class AnnounceFailureError(Exception):
     pass
 
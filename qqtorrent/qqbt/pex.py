@@ -0,0 +1,92 @@
+"""Peer exchange (BEP 11) over the extension protocol (BEP 10).
+
+Each connection that negotiates ut_pex gets a PeerExchange which, at most
+once per PEX_INTERVAL, sends the peer the addresses we have connected to or
+dropped since the last message, and passes the addresses the peer sends us to
+the torrent.
+"""
+import time
+import socket
+import struct
+import logging
+
+from qqbt import bencode
+
+log = logging.getLogger(__name__)
+
+PEX_INTERVAL = 60           # seconds between messages in each direction
+MAX_PEX_PEERS = 50          # addresses per added/dropped list
+
+COMPACT_PEER = struct.Struct('!4sH')
+
+
+def encode_pex_peers(addrs):
+    return b''.join(COMPACT_PEER.pack(socket.inet_aton(ip), port)
+                    for (ip, port) in addrs)
+
+
+def decode_pex_peers(data):
+    """Decode a compact peer list, ignoring a truncated trailing entry."""
+    peers = []
+    for ofs in range(0, len(data) - len(data) % COMPACT_PEER.size,
+                     COMPACT_PEER.size):
+        (ip, port) = COMPACT_PEER.unpack_from(data, ofs)
+        if port > 0:
+            peers.append({'ip': socket.inet_ntoa(ip), 'port': port})
+    return peers
+
+
+class PeerExchange():
+    """PEX state for one peer connection."""
+    def __init__(self, peer):
+        """
+        Args:
+            peer (TorrentPeer): connected peer that negotiated ut_pex
+        """
+        self.peer = peer
+        self.sent_addrs = set()
+        self.last_sent = None
+        self.last_received = None
+
+    def maybe_send(self):
+        """Send an update if the last one is at least PEX_INTERVAL old."""
+        now = time.monotonic()
+        if self.last_sent is not None and now - self.last_sent < PEX_INTERVAL:
+            return
+        msg = self.build_update()
+        if msg is None:
+            return
+        self.last_sent = now
+        self.peer.send_extended('ut_pex', msg)
+
+    def build_update(self):
+        """Return the next ut_pex message dict, or None if nothing changed."""
+        current = set(self.peer.torrent.get_pex_addrs(exclude=self.peer))
+        added = list(current - self.sent_addrs)[:MAX_PEX_PEERS]
+        dropped = list(self.sent_addrs - current)[:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return None
+        self.sent_addrs.update(added)
+        self.sent_addrs.difference_update(dropped)
+        return {
+            'added': encode_pex_peers(added),
+            'added.f': bytes(len(added)),
+            'dropped': encode_pex_peers(dropped)
+        }
+
+    def handle_message(self, data):
+        now = time.monotonic()
+        if (self.last_received is not None
+                and now - self.last_received < PEX_INTERVAL / 2):
+            log.debug('%s: ignoring PEX flood' % self.peer)
+            return
+        self.last_received = now
+        try:
+            msg = bencode.decode(data)
+            added = decode_pex_peers(msg.get(b'added', b''))
+        except (bencode.BencodeDecodeError, AttributeError, TypeError):
+            log.debug('%s: malformed PEX message' % self.peer)
+            return
+        # Dropped peers may just have disconnected from the sender, so we
+        # keep them; their dials fail on their own if they are gone.
+        self.peer.torrent.add_pex_peers(added[:MAX_PEX_PEERS])
@@ -0,0 +1,234 @@
+"""Content-addressed store of downloaded data, shared by all torrents.
+
+The store is an index of verified data already on disk, so torrents that
+share content with earlier downloads get it locally instead of from the
+network:
+
+    pieces: piece SHA-1 -> where the piece's bytes are, as a list of
+            (path, offset, length) spans in the files of a finished torrent
+    files:  whole-file SHA-1 (the BEP 47 'sha1' key of a file, where the
+            torrent has one) -> a file with that content
+
+Pieces are only recorded, not copied, so the store takes no extra space for
+them; reading one back checks its hash, and entries whose data has changed
+or gone are dropped. Whole files are linked into the store directory, as a
+reflink where the filesystem supports copy-on-write clones and otherwise as
+a hardlink, so they outlive the torrent that downloaded them. A new torrent
+containing such a file gets it the same way.
+
+Several processes may share a store, e.g. the worker processes of one
+client. Each keeps its own copy of the index and records what it changed;
+saving takes a lock on the store, reloads the index from disk and applies
+those changes to it, so entries other processes added are not lost.
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+
+from qqbt import bencode
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409    # Linux ioctl: reflink a whole file
+
+# Tables of the index.
+PIECES = 0
+FILES = 1
+
+
+def clone_file(src, dst):
+    """Create dst, which must not exist, with the contents of src, sharing
+    storage if possible.
+
+    Returns:
+        'reflink' or 'hardlink', or None if the filesystem supports neither
+    """
+    if fcntl is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        return None
+
+
+class PieceStore():
+    def __init__(self, store_dir):
+        """
+        Args:
+            store_dir (str): directory for the index and linked files,
+                created if missing
+        """
+        self.store_dir = os.path.expanduser(store_dir)
+        self.files_dir = os.path.join(self.store_dir, 'files')
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.index_path = os.path.join(self.store_dir, 'index')
+        self.lock_path = os.path.join(self.store_dir, 'lock')
+        # Guards the index, which torrents read off the event loop thread.
+        self.lock = threading.RLock()
+        # Changes not saved yet: added entries, and keys of dropped ones.
+        self.added = ({}, {})
+        self.dropped = (set(), set())
+        (self.pieces, self.files) = self._load_index()
+
+    def get_piece(self, piece_sha, length):
+        """Return the verified data of a piece, or None if not stored."""
+        with self.lock:
+            spans = self.pieces.get(piece_sha)
+        if spans is None:
+            return None
+        out = []
+        try:
+            for (path, offset, n) in spans:
+                with open(path, 'rb') as f:
+                    out.append(os.pread(f.fileno(), n, offset))
+        except OSError as e:
+            log.debug('get_piece: %s' % e)
+            out = []
+        piece = b''.join(out)
+        if len(piece) != length or hashlib.sha1(piece).digest() != piece_sha:
+            log.info('PieceStore: dropping stale piece %s' % piece_sha.hex())
+            with self.lock:
+                self._drop(PIECES, piece_sha)
+            return None
+        return piece
+
+    def get_file(self, file_sha, length):
+        """Return the path of a stored file, or None if not stored."""
+        with self.lock:
+            path = self.files.get(file_sha)
+        if path is None:
+            return None
+        try:
+            if os.stat(path).st_size == length:
+                return path
+        except OSError:
+            pass
+        with self.lock:
+            self._drop(FILES, file_sha)
+        return None
+
+    def link_file(self, file_sha, length, dst):
+        """Create dst from a stored file.
+
+        Returns:
+            True if dst was created
+        """
+        src = self.get_file(file_sha, length)
+        if src is None or os.path.exists(dst):
+            return False
+        dirname = os.path.dirname(dst)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        how = clone_file(src, dst)
+        if how is None:
+            shutil.copyfile(src, dst)
+            how = 'copy'
+        log.info('PieceStore: %s %s -> %s' % (how, src, dst))
+        return True
+
+    def add_torrent(self, metainfo, paths, pieces):
+        """Record the data of a finished torrent.
+
+        Args:
+            metainfo (TorrentMetainfo): the torrent's metainfo
+            paths (list): path of each of its files on disk
+            pieces (list): indices of its verified pieces
+        """
+        paths = [os.path.abspath(p) for p in paths]
+        for i in pieces:
+            piece_sha = metainfo.info['pieces'][i]
+            self._add(PIECES, piece_sha, [
+                [paths[f], offset, n]
+                for (f, offset, n) in metainfo.get_piece_file_spans(i)])
+
+        complete = set(pieces)
+        offsets = metainfo.get_file_offsets()
+        piece_length = metainfo.info['piece_length']
+        for (f, file_sha) in enumerate(metainfo.get_file_hashes()):
+            length = offsets[f + 1] - offsets[f]
+            if (file_sha is None or not length
+                    or self.get_file(file_sha, length)):
+                continue
+            first = offsets[f] // piece_length
+            last = (offsets[f + 1] - 1) // piece_length
+            if not all(i in complete for i in range(first, last + 1)):
+                continue
+            path = os.path.join(self.files_dir, file_sha.hex())
+            if os.path.exists(path):
+                os.unlink(path)
+            if clone_file(paths[f], path) is None:
+                # No links on this filesystem: point at the original.
+                path = paths[f]
+            self._add(FILES, file_sha, path)
+        self.save()
+
+    def _add(self, table, key, value):
+        with self.lock:
+            (self.pieces, self.files)[table][key] = value
+            self.added[table][key] = value
+            self.dropped[table].discard(key)
+
+    def _drop(self, table, key):
+        (self.pieces, self.files)[table].pop(key, None)
+        self.added[table].pop(key, None)
+        self.dropped[table].add(key)
+
+    def reload(self):
+        """Pick up entries other processes have saved since we loaded."""
+        with self.lock:
+            self._merge(self._load_index())
+
+    def _merge(self, index):
+        for (table, entries) in enumerate(index):
+            for key in self.dropped[table]:
+                entries.pop(key, None)
+            entries.update(self.added[table])
+        (self.pieces, self.files) = index
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = bencode.decode(f.read())
+        except FileNotFoundError:
+            return ({}, {})
+        except bencode.BencodeDecodeError:
+            log.warning('Corrupt piece store index, rebuilding')
+            return ({}, {})
+        pieces = {k: [[os.fsdecode(p), offset, n] for (p, offset, n) in v]
+                  for (k, v) in index.get(b'pieces', {}).items()}
+        files = {k: os.fsdecode(v)
+                 for (k, v) in index.get(b'files', {}).items()}
+        return (pieces, files)
+
+    def save(self):
+        """Merge our changes into the index on disk."""
+        with self.lock, open(self.lock_path, 'ab') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._merge(self._load_index())
+            tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(bencode.encode({
+                    'pieces': {k: [[os.fsencode(p), offset, n]
+                                    for (p, offset, n) in v]
+                               for (k, v) in self.pieces.items()},
+                    'files': {k: os.fsencode(v)
+                              for (k, v) in self.files.items()},
+                }))
+            os.replace(tmp_path, self.index_path)
+            self.added = ({}, {})
+            self.dropped = (set(), set())
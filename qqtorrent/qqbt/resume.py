@@ -0,0 +1,154 @@
+"""Fast-resume state, so a restarted torrent carries on where it stopped.
+
+A torrent's resume file is a bencoded dict:
+
+    info_hash:  the torrent it belongs to
+    pieces:     bitmap of completed pieces, first piece in the high bit
+    unverified: indices of completed pieces not yet checked against their
+                hash since an earlier resume
+    files:      [size, mtime_ns] of each file when the bitmap was taken,
+                or [-1, 0] for a file not created yet
+    partial:    [piece_index, [[begin, block], ...]] for the received
+                blocks of unfinished pieces
+    peers:      [ip, port, best_rate] of peers that sent us good data,
+                fastest first
+
+Only pieces already written to disk are marked complete: periodic saves
+don't flush the write cache, and leave out pieces still dirty in it, while
+the final save at shutdown flushes it first. Periodic saves are written on
+a thread where the backend has one. The file is replaced atomically, so a
+crash leaves the previous state rather than a torn one.
+
+On load, completed pieces in files whose size and mtime still match are
+trusted without reading them. A file that changed since, usually because we
+kept writing other pieces after the last save, keeps its pieces too, but
+they are checked when first read and before the torrent completes. Pieces
+in files that are gone or shorter than they were are fetched again.
+"""
+import os
+import logging
+
+from qqbt import bencode
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+MAX_PEERS = 50
+
+
+def get_file_stats(paths):
+    """Return [size, mtime_ns] of each file, [-1, 0] if it doesn't exist."""
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stats.append([-1, 0])
+        else:
+            stats.append([st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def encode_bitmap(flags):
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for (i, v) in enumerate(flags):
+        if v:
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bitmap)
+
+
+def decode_bitmap(bitmap, num_pieces):
+    return [bool(bitmap[i >> 3] & (0x80 >> (i & 7)))
+            for i in range(num_pieces)]
+
+
+class ResumeState():
+    """What a torrent needs to restart without rehashing or re-downloading."""
+    def __init__(self, info_hash, complete, unverified=(), files=(),
+                 partial=None, peers=()):
+        """
+        Args:
+            info_hash (bytes): info hash of the torrent
+            complete (list): whether each piece is complete
+            unverified (iterable): indices of complete pieces not yet
+                checked since they were restored
+            files (list): [size, mtime_ns] of each file (see get_file_stats)
+            partial (dict): piece index -> list of (begin, block) received
+                for unfinished pieces
+            peers (list): (ip, port, best_rate) of peers worth dialing first
+        """
+        self.info_hash = info_hash
+        self.complete = complete
+        self.unverified = set(unverified)
+        self.files = [list(v) for v in files]
+        self.partial = partial or {}
+        self.peers = list(peers)[:MAX_PEERS]
+
+    def encode(self):
+        return bencode.encode({
+            'version': VERSION,
+            'info_hash': self.info_hash,
+            'pieces': encode_bitmap(self.complete),
+            'unverified': sorted(self.unverified),
+            'files': self.files,
+            'partial': [[i, [[begin, block] for (begin, block) in blocks]]
+                        for (i, blocks) in sorted(self.partial.items())],
+            'peers': [[ip.encode(), port, int(rate)]
+                      for (ip, port, rate) in self.peers],
+        })
+
+    @classmethod
+    def decode(cls, data, metainfo):
+        """Decode a resume file's contents, checking it fits metainfo.
+
+        Raises:
+            ResumeError: if data is not a resume file for this torrent
+        """
+        try:
+            d = bencode.decode(data)
+        except bencode.BencodeDecodeError as e:
+            raise ResumeError('Corrupt resume file: %s' % e)
+        if not isinstance(d, dict) or d.get(b'version') != VERSION:
+            raise ResumeError('Unknown resume file version')
+        if d.get(b'info_hash') != metainfo.info_hash:
+            raise ResumeError('Resume file is for another torrent')
+        num_pieces = len(metainfo.info['pieces'])
+        try:
+            bitmap = d[b'pieces']
+            if len(bitmap) != (num_pieces + 7) // 8:
+                raise ResumeError('Bitmap does not match piece count')
+            files = d[b'files']
+            if len(files) != len(metainfo.get_file_lengths()):
+                raise ResumeError('File list does not match torrent')
+            partial = {}
+            for (i, blocks) in d[b'partial']:
+                if not 0 <= i < num_pieces:
+                    continue
+                length = metainfo.get_piece_length(i)
+                partial[i] = [(begin, block) for (begin, block) in blocks
+                              if 0 <= begin < begin + len(block) <= length]
+            unverified = [i for i in d[b'unverified'] if 0 <= i < num_pieces]
+            peers = [(ip.decode(), port, rate)
+                     for (ip, port, rate) in d[b'peers']]
+        except (KeyError, TypeError, ValueError, IndexError) as e:
+            raise ResumeError('Malformed resume file: %r' % e)
+        return cls(metainfo.info_hash, decode_bitmap(bitmap, num_pieces),
+                   unverified, files, partial, peers)
+
+    def save(self, path):
+        """Write the state to path atomically."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, metainfo):
+        with open(path, 'rb') as f:
+            return cls.decode(f.read(), metainfo)
+
+
+class ResumeError(Exception):
+    pass
@@ -0,0 +1,204 @@
+"""Client-wide scheduling of torrents.
+
+At most max_active torrents run at a time; the rest wait in a queue ordered
+by priority, then by the order they were added. Running torrents share
+max_connections peer connections in proportion to their priority weight,
+each capped at CONFIG['max_peers']. When a torrent finishes, fails or is
+paused, or stalls without completing a piece while others are waiting, the
+next queued torrent is promoted. A torrent that fails to start on an error
+that may be transient is retried after a delay that doubles each time, up
+to CONFIG['start_retries'] times; after that, or when the tracker refuses
+it, it is marked failed until retry() is called.
+"""
+import time
+import logging
+
+from qqbt.config import CONFIG
+from qqbt.tracker import AnnounceFailureError, AnnounceDecodeError
+
+log = logging.getLogger(__name__)
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+PRIORITIES = {'low': PRIORITY_LOW, 'normal': PRIORITY_NORMAL,
+              'high': PRIORITY_HIGH}
+
+
+class TorrentScheduler():
+    def __init__(self, conn_man, max_active=None, max_connections=None,
+                 on_failed_torrent=None):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop to run on
+            max_active (int): torrents running at once; defaults to
+                CONFIG['max_active_torrents']
+            max_connections (int): peer connections shared by running
+                torrents; defaults to CONFIG['max_connections']
+            on_failed_torrent (function): called with a torrent that could
+                not be started and won't be retried
+        """
+        self.conn_man = conn_man
+        self.max_active = (CONFIG['max_active_torrents'] if max_active is None
+                           else max_active)
+        self.max_connections = (CONFIG['max_connections']
+                                if max_connections is None
+                                else max_connections)
+        self.on_failed_torrent = on_failed_torrent
+        self.entries = {}       # torrent -> ScheduleEntry
+        self.seq = 0
+        self.timer = None
+
+    def start(self):
+        self.timer = self.conn_man.call_every(CONFIG['scheduler_interval'],
+                                              self.reschedule)
+        self.reschedule()
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def add(self, torrent, priority=PRIORITY_NORMAL):
+        self.seq += 1
+        self.entries[torrent] = ScheduleEntry(priority, self.seq)
+
+    def remove(self, torrent):
+        self.entries.pop(torrent, None)
+
+    def set_priority(self, torrent, priority):
+        self.entries[torrent].priority = priority
+
+    def get_priority(self, torrent):
+        entry = self.entries.get(torrent)
+        return entry.priority if entry else None
+
+    def is_queued(self, torrent):
+        entry = self.entries.get(torrent)
+        return (entry is not None and not entry.is_failed
+                and not torrent.is_running)
+
+    def is_failed(self, torrent):
+        entry = self.entries.get(torrent)
+        return entry is not None and entry.is_failed
+
+    def retry(self, torrent):
+        """Queue a torrent that failed to start again."""
+        entry = self.entries[torrent]
+        entry.is_failed = False
+        entry.num_failures = 0
+        entry.retry_at = None
+
+    def reschedule(self):
+        """Start, stop and reallocate connections to match priorities."""
+        now = time.monotonic()
+        for (torrent, entry) in list(self.entries.items()):
+            if torrent.is_complete:
+                del self.entries[torrent]
+        waiting = [t for (t, e) in self.entries.items()
+                   if not t.is_paused and not t.is_running
+                   and e.can_start(now)]
+        for (torrent, entry) in self.entries.items():
+            if torrent.is_running:
+                self._check_stalled(torrent, entry, now, bool(waiting))
+
+        runnable = sorted((t for (t, e) in self.entries.items()
+                           if not t.is_paused and e.can_start(now)),
+                          key=lambda t: self.entries[t].sort_key())
+        chosen = runnable[:self.max_active]
+        for torrent in runnable[self.max_active:]:
+            if torrent.is_running:
+                log.info('%s: queued' % torrent)
+                torrent.stop_torrent()
+
+        self._allocate_connections(chosen)
+        failed = False
+        for torrent in chosen:
+            if not torrent.is_running:
+                failed |= not self._start(torrent, now)
+        if failed:
+            # Fill the slots of torrents that failed to start.
+            self.reschedule()
+
+    def _check_stalled(self, torrent, entry, now, others_waiting):
+        num_complete = torrent.get_num_complete()
+        if num_complete != entry.last_num_complete:
+            entry.last_num_complete = num_complete
+            entry.last_progress = now
+            entry.num_failures = 0
+        elif (others_waiting
+                and now - entry.last_progress > CONFIG['stall_timeout']):
+            # Make way for a queued torrent: go to the back of the line.
+            log.info('%s: stalled, requeueing' % torrent)
+            self.seq += 1
+            entry.seq = self.seq
+            entry.last_progress = now
+
+    def _allocate_connections(self, torrents):
+        """Split connection slots by priority weight."""
+        if not torrents:
+            return
+        weights = [self.entries[t].priority + 1 for t in torrents]
+        total = sum(weights)
+        for (torrent, weight) in zip(torrents, weights):
+            share = max(1, self.max_connections * weight // total)
+            torrent.set_max_peers(min(share, CONFIG['max_peers']))
+
+    def _start(self, torrent, now):
+        log.info('%s: starting' % torrent)
+        entry = self.entries[torrent]
+        entry.last_progress = now
+        entry.last_num_complete = torrent.get_num_complete()
+        entry.retry_at = None
+        try:
+            torrent.start_torrent()
+        except (OSError, AnnounceFailureError, AnnounceDecodeError) as e:
+            self.handle_start_failure(torrent, e)
+            return False
+        return True
+
+    def handle_start_failure(self, torrent, error):
+        """Stop a torrent that failed to start, and retry it later unless
+        the error is final or it has failed too often.
+
+        Args:
+            torrent (Torrent): torrent that failed to start
+            error (Exception): what starting it raised
+        """
+        torrent.stop_torrent()
+        entry = self.entries.get(torrent)
+        if entry is None:
+            return
+        entry.num_failures += 1
+        # The tracker's failure reason is final; an unreachable tracker, a
+        # garbled response or an I/O error may not be.
+        if (not isinstance(error, AnnounceFailureError)
+                and entry.num_failures <= CONFIG['start_retries']):
+            delay = (CONFIG['start_retry_delay']
+                     * 2 ** (entry.num_failures - 1))
+            entry.retry_at = time.monotonic() + delay
+            log.warning('%s: failed to start: %s; retrying in %d s'
+                        % (torrent, error, delay))
+            return
+        log.error('%s: failed to start: %s' % (torrent, error))
+        entry.is_failed = True
+        if self.on_failed_torrent:
+            self.on_failed_torrent(torrent)
+
+
+class ScheduleEntry():
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.seq = seq
+        self.last_progress = None
+        self.last_num_complete = None
+        self.num_failures = 0       # failed starts since the last progress
+        self.retry_at = None
+        self.is_failed = False
+
+    def can_start(self, now):
+        return not self.is_failed and (self.retry_at is None
+                                       or now >= self.retry_at)
+
+    def sort_key(self):
+        return (-self.priority, self.seq)
@@ -0,0 +1,311 @@
+"""Disk storage for torrent data.
+
+TorrentStorage maps a torrent's pieces onto its files. Verified pieces are
+handed to a WriteBackCache shared by all torrents, which holds them in memory
+up to a byte budget and flushes them on a background thread, coalescing
+pieces that are adjacent on disk into a single pwritev call per file. The
+cache also serves reads, so recently completed pieces can be uploaded without
+touching the disk.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from qqbt.config import CONFIG
+
+log = logging.getLogger(__name__)
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+WRITE_RETRY_INTERVAL = 1.0     # seconds before retrying failed writes
+
+
+class TorrentStorage():
+    """The files of a torrent on disk."""
+    def __init__(self, metainfo, cache, outdir=None):
+        """
+        Args:
+            metainfo (TorrentMetainfo): decoded torrent file
+            cache (WriteBackCache): cache through which pieces are written
+            outdir (str): output directory, or None for the current directory
+        """
+        self.metainfo = metainfo
+        self.cache = cache
+        self.paths = self._get_file_paths(metainfo, outdir)
+        self.fds = [None] * len(self.paths)
+        self.fds_lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TorrentStorage(%s)' % self.metainfo.name
+
+    @staticmethod
+    def _get_file_paths(metainfo, outdir):
+        base_dir = os.path.expanduser(outdir) if outdir else ''
+        if metainfo.info['format'] == 'SINGLE_FILE':
+            (_, filename) = os.path.split(metainfo.name)
+            return [os.path.join(base_dir, filename)]
+        base_dir = os.path.join(base_dir, metainfo.name)
+        return [os.path.join(base_dir, f['path'])
+                for f in metainfo.info['files']]
+
+    def write_piece(self, piece_index, piece):
+        """Queue a verified piece to be written to disk."""
+        self.cache.put(self, piece_index, piece)
+
+    def read(self, piece_index, begin, length):
+        """Read part of a completed piece, from the cache or from disk."""
+        return self.cache.read(self, piece_index, begin, length)
+
+    def flush(self):
+        """Write all cached pieces of this torrent to disk and wait."""
+        self.cache.flush(self)
+
+    def get_unwritten_pieces(self):
+        """Indices of pieces still waiting in the cache to be written."""
+        return self.cache.get_dirty_pieces(self)
+
+    def close(self):
+        self.flush()
+        # Empty files never receive a write, so create them here.
+        for (i, length) in enumerate(self.metainfo.get_file_lengths()):
+            if length == 0:
+                self._get_fd(i)
+        with self.fds_lock:
+            for (i, fd) in enumerate(self.fds):
+                if fd is not None:
+                    os.close(fd)
+                    log.info('save_file: %s' % self.paths[i])
+            self.fds = [None] * len(self.paths)
+
+    def _get_fd(self, file_index):
+        with self.fds_lock:
+            fd = self.fds[file_index]
+            if fd is None:
+                path = self.paths[file_index]
+                dirname = os.path.dirname(path)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                self.fds[file_index] = fd
+            return fd
+
+    def write_file(self, file_index, offset, buffers):
+        """Write contiguous buffers to a file at offset."""
+        fd = self._get_fd(file_index)
+        for i in range(0, len(buffers), IOV_MAX):
+            chunk = buffers[i:i+IOV_MAX]
+            if hasattr(os, 'pwritev'):
+                nbytes = os.pwritev(fd, chunk, offset)
+            else:
+                nbytes = os.pwrite(fd, b''.join(chunk), offset)
+            expected = sum(len(v) for v in chunk)
+            if nbytes != expected:
+                # Short write; fall back to writing the remainder directly.
+                data = b''.join(chunk)
+                while nbytes < expected:
+                    nbytes += os.pwrite(fd, data[nbytes:], offset + nbytes)
+            offset += expected
+
+    def read_from_disk(self, piece_index, begin, length):
+        piece_offset = 0
+        out = []
+        end = begin + length
+        for (f, file_offset, n) in self.metainfo.get_piece_file_spans(
+                piece_index):
+            lo = max(begin, piece_offset)
+            hi = min(end, piece_offset + n)
+            if lo < hi:
+                fd = self._get_fd(f)
+                out.append(os.pread(fd, hi - lo,
+                                    file_offset + lo - piece_offset))
+            piece_offset += n
+        return b''.join(out)
+
+
+class WriteBackCache():
+    """Write-back cache of verified pieces shared by all torrents.
+
+    Dirty pieces are flushed by a background thread once they exceed half
+    the budget; clean pieces are evicted, least recently used first, to stay
+    within the budget. Writers never wait for the disk: while dirty pieces
+    fill the cache it goes over budget, and the client's MemoryBudget holds
+    back new requests until they are written.
+    """
+    def __init__(self, max_bytes=None):
+        """
+        Args:
+            max_bytes (int): memory budget; defaults to
+                CONFIG['write_cache_bytes']
+        """
+        self.max_bytes = (CONFIG['write_cache_bytes'] if max_bytes is None
+                          else max_bytes)
+        self.flush_threshold = self.max_bytes // 2
+        # (storage, piece_index) -> [piece, is_dirty]
+        self.entries = {}
+        # Keys of the clean entries, least recently used first.
+        self.clean_keys = OrderedDict()
+        self.total_bytes = 0
+        self.dirty_bytes = 0
+        self.flush_requests = set()
+        self.write_error = None
+
+        self.cond = threading.Condition()
+        self.is_stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='WriteBackCache')
+        self.thread.start()
+
+    def put(self, storage, piece_index, piece):
+        with self.cond:
+            key = (storage, piece_index)
+            old = self.entries.pop(key, None)
+            if old:
+                self._forget(old)
+                self.clean_keys.pop(key, None)
+            self.entries[key] = [piece, True]
+            self.total_bytes += len(piece)
+            self.dirty_bytes += len(piece)
+            if self.dirty_bytes >= self.flush_threshold:
+                self.cond.notify_all()
+            self._evict()
+            self._check_write_error()
+
+    def get_dirty_bytes(self):
+        """Bytes of pieces waiting to be written to disk."""
+        return self.dirty_bytes
+
+    def get_dirty_pieces(self, storage):
+        """Indices of the pieces of storage waiting to be written."""
+        with self.cond:
+            return set(i for ((s, i), entry) in self.entries.items()
+                       if s is storage and entry[1])
+
+    def read(self, storage, piece_index, begin, length):
+        with self.cond:
+            key = (storage, piece_index)
+            entry = self.entries.get(key)
+            if entry:
+                if key in self.clean_keys:
+                    self.clean_keys.move_to_end(key)
+                return entry[0][begin:begin+length]
+        return storage.read_from_disk(piece_index, begin, length)
+
+    def flush(self, storage=None):
+        """Write dirty pieces to disk and wait until they are written.
+
+        Args:
+            storage (TorrentStorage): torrent whose pieces to wait for; all
+                dirty pieces are written either way
+        """
+        with self.cond:
+            self.flush_requests.add(storage)
+            self.cond.notify_all()
+            while storage in self.flush_requests:
+                self.cond.wait()
+            self._check_write_error()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.is_stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _check_write_error(self):
+        if self.write_error:
+            e = self.write_error
+            self.write_error = None
+            raise StorageError('Failed to write pieces: %s' % e) from e
+
+    def _forget(self, entry):
+        self.total_bytes -= len(entry[0])
+        if entry[1]:
+            self.dirty_bytes -= len(entry[0])
+
+    def _evict(self):
+        """Drop least recently used clean pieces while over budget."""
+        while self.total_bytes > self.max_bytes and self.clean_keys:
+            (key, _) = self.clean_keys.popitem(last=False)
+            self._forget(self.entries.pop(key))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while (not self.is_stopped and not self.flush_requests
+                        and self.dirty_bytes < self.flush_threshold):
+                    self.cond.wait()
+                if self.is_stopped:
+                    return
+                requests = self.flush_requests
+                self.flush_requests = set()
+                dirty = [(key, entry[0]) for (key, entry)
+                         in self.entries.items() if entry[1]]
+
+            (failed, error) = self._write_pieces(dirty)
+
+            with self.cond:
+                # Pieces that failed to write stay dirty, to be retried.
+                for (key, piece) in dirty:
+                    entry = self.entries.get(key)
+                    if (key not in failed and entry and entry[1]
+                            and entry[0] is piece):
+                        entry[1] = False
+                        self.dirty_bytes -= len(piece)
+                        self.clean_keys[key] = None
+                if error:
+                    log.error('WriteBackCache flush failed: %s' % error)
+                    self.write_error = error
+                self._evict()
+                self.flush_requests -= requests
+                self.cond.notify_all()
+                if error:
+                    # Don't spin on a full or failing disk.
+                    self.cond.wait(WRITE_RETRY_INTERVAL)
+
+    @staticmethod
+    def _write_pieces(pieces):
+        """Write pieces, coalescing runs that are contiguous within a file.
+
+        Returns:
+            (failed, error) tuple: the keys of pieces not entirely written,
+            and the last OSError raised writing them, or None
+        """
+        # (storage, file_index) -> [(file_offset, buffer, key)]
+        writes = {}
+        for (key, piece) in pieces:
+            (storage, piece_index) = key
+            view = memoryview(piece)
+            piece_offset = 0
+            for (f, file_offset, n) in storage.metainfo.get_piece_file_spans(
+                    piece_index):
+                writes.setdefault((storage, f), []).append(
+                    (file_offset, view[piece_offset:piece_offset+n], key))
+                piece_offset += n
+
+        failed = set()
+        error = None
+        for ((storage, f), segments) in writes.items():
+            segments.sort(key=lambda v: v[0])
+            runs = []   # [offset, buffers, keys, end]
+            for (offset, buf, key) in segments:
+                if not runs or offset != runs[-1][3]:
+                    runs.append([offset, [], set(), offset])
+                run = runs[-1]
+                run[1].append(buf)
+                run[2].add(key)
+                run[3] += len(buf)
+            for (offset, buffers, keys, _) in runs:
+                try:
+                    storage.write_file(f, offset, buffers)
+                except OSError as e:
+                    failed |= keys
+                    error = e
+        return (failed, error)
+
+
+class StorageError(Exception):
+    pass
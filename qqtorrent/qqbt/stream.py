@@ -0,0 +1,143 @@
+"""Read a file of a torrent while it is still downloading.
+
+A TorrentStream is a read-only file object over one file of a torrent. Its
+position is a playback cursor: while a stream is open, peers fetch the pieces
+in the CONFIG['stream_window_bytes'] ahead of the cursor before any others,
+and the piece under the cursor may be fetched from two peers at once.
+
+Reads happen on the caller's thread and block only until the piece under the
+cursor is verified, then return what is available up to the end of that
+piece, so playback can start as soon as the first piece arrives. Pieces
+restored from a resume file are checked by the event loop, on request, since
+a failed check changes the torrent's state.
+"""
+import io
+import time
+import logging
+
+from qqbt.torrent import TorrentPieceError
+
+log = logging.getLogger(__name__)
+
+
+class TorrentStream(io.RawIOBase):
+    def __init__(self, torrent, file_index, timeout=None):
+        """
+        Args:
+            torrent (Torrent): torrent to read from
+            file_index (int): index of the file in the torrent
+            timeout (float): seconds a read may wait for a piece, or None to
+                wait indefinitely
+        """
+        super().__init__()
+        self.torrent = torrent
+        self.file_index = file_index
+        self.timeout = timeout
+        offsets = torrent.metainfo.get_file_offsets()
+        self.file_begin = offsets[file_index]
+        self.length = offsets[file_index + 1] - self.file_begin
+        self.position = 0
+        self.is_aborted = False
+        torrent.add_stream(self)
+
+    def __repr__(self):
+        return ('TorrentStream(%s, file %d, %d/%d)'
+                % (self.torrent, self.file_index, self.position, self.length))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError('Invalid whence: %r' % whence)
+        if position < 0:
+            raise ValueError('Negative seek position %d' % position)
+        self.position = position
+        return position
+
+    def get_window(self, window_bytes):
+        """Return the torrent offset range the reader will need next."""
+        begin = self.file_begin + min(self.position, self.length)
+        end = self.file_begin + min(self.position + window_bytes, self.length)
+        return (begin, end)
+
+    def readinto(self, buf):
+        if self.closed:
+            raise ValueError('I/O operation on closed stream')
+        remaining = self.length - self.position
+        if remaining <= 0 or not len(buf):
+            return 0
+        piece_length = self.torrent.metainfo.info['piece_length']
+        offset = self.file_begin + self.position
+        piece_index = offset // piece_length
+        begin = offset - piece_index * piece_length
+        n = min(len(buf), remaining,
+                self.torrent.metainfo.get_piece_length(piece_index) - begin)
+        while True:
+            self.wait_for_piece(piece_index)
+            try:
+                data = self.torrent.read_block(piece_index, begin, n)
+                break
+            except TorrentPieceError:
+                # A resumed piece that failed its check; it is fetched
+                # again.
+                pass
+        buf[:n] = data
+        self.position += n
+        return n
+
+    def wait_for_piece(self, piece_index):
+        deadline = (None if self.timeout is None
+                    else time.monotonic() + self.timeout)
+        cond = self.torrent.stream_cond
+        is_check_requested = False
+        with cond:
+            while True:
+                if self.is_aborted:
+                    raise StreamClosedError('%s: torrent removed' % self)
+                if self.torrent.complete_pieces[piece_index]:
+                    if piece_index not in self.torrent.unverified_pieces:
+                        return
+                    if not is_check_requested:
+                        self.torrent.request_piece_check(piece_index)
+                        is_check_requested = True
+                        continue
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        raise StreamTimeoutError(
+                            '%s: timed out waiting for piece %d'
+                            % (self, piece_index))
+                cond.wait(timeout)
+
+    def abort(self):
+        """Make blocked and future reads fail, e.g. on torrent removal."""
+        with self.torrent.stream_cond:
+            self.is_aborted = True
+            self.torrent.stream_cond.notify_all()
+
+    def close(self):
+        if not self.closed:
+            self.torrent.remove_stream(self)
+        super().close()
+
+
+class StreamClosedError(Exception):
+    pass
+
+
+class StreamTimeoutError(Exception):
+    pass
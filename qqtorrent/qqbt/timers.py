@@ -0,0 +1,113 @@
+"""Timers for the select and threads event loops.
+
+TimerQueue keeps pending timers in a binary heap ordered by deadline, so
+scheduling is O(log n) and finding the next deadline is O(1). Cancelled
+timers stay in the heap and are skipped when they come due; the heap is
+rebuilt without them once they make up most of it, which keeps cancellation
+O(1) and lets every connection have its own timeouts.
+"""
+import heapq
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Rebuild the heap once cancelled timers outnumber live ones and there are
+# at least this many.
+COMPACT_MIN_CANCELLED = 64
+
+
+class Timer():
+    """A scheduled callback. Call cancel() to unschedule it."""
+    def __init__(self, queue, deadline, interval, callback, args):
+        self.queue = queue
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return 'Timer(%r, deadline=%.3f)' % (self.callback, self.deadline)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.queue:
+            self.queue.handle_cancelled()
+
+
+class TimerQueue():
+    def __init__(self, clock=time.monotonic):
+        """
+        Args:
+            clock (function): returns the current time in seconds
+        """
+        self.clock = clock
+        self.heap = []      # (deadline, seq, Timer)
+        self.seq = 0
+        self.num_cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.num_cancelled
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) once after delay seconds."""
+        return self._schedule(delay, None, callback, args)
+
+    def call_every(self, interval, callback, *args):
+        """Call callback(*args) every interval seconds until cancelled."""
+        return self._schedule(interval, interval, callback, args)
+
+    def _schedule(self, delay, interval, callback, args):
+        timer = Timer(self, self.clock() + delay, interval, callback, args)
+        self._push(timer)
+        return timer
+
+    def _push(self, timer):
+        self.seq += 1
+        heapq.heappush(self.heap, (timer.deadline, self.seq, timer))
+
+    def handle_cancelled(self):
+        self.num_cancelled += 1
+        if (self.num_cancelled >= COMPACT_MIN_CANCELLED
+                and self.num_cancelled * 2 > len(self.heap)):
+            self.heap = [v for v in self.heap if not v[2].cancelled]
+            heapq.heapify(self.heap)
+            self.num_cancelled = 0
+
+    def next_timeout(self):
+        """Seconds until the next deadline, or None if there are no timers."""
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.num_cancelled -= 1
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - self.clock())
+
+    def run_expired(self):
+        """Run callbacks of all timers that are due."""
+        now = self.clock()
+        repeating = []
+        while self.heap and self.heap[0][0] <= now:
+            (_, _, timer) = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.num_cancelled -= 1
+                continue
+            # Out of the heap while it runs, so cancel() has nothing to
+            # count.
+            timer.queue = None
+            if timer.interval is not None:
+                repeating.append(timer)
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                log.exception('Timer callback %r failed' % timer.callback)
+        for timer in repeating:
+            if timer.cancelled:
+                continue
+            timer.queue = self
+            # Skip missed runs rather than firing them all at once.
+            timer.deadline = max(timer.deadline + timer.interval, now)
+            self._push(timer)
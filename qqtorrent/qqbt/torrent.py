@@ -1,155 +1,1011 @@
+import time
 import hashlib
 import logging
+import threading
 
 from qqbt.config import CONFIG
 from qqbt.peer import TorrentPeer
-from qqbt.tracker import TorrentTracker
+from qqbt.scheduler import PRIORITY_NORMAL, PRIORITIES
+from qqbt.tracker import (TorrentTracker, AnnounceFailureError,
+                          AnnounceDecodeError)
 
 log = logging.getLogger(__name__)
 
+# File priorities are the scheduler's, plus one to leave a file out.
+PRIORITY_SKIP = -1
+FILE_PRIORITIES = dict(PRIORITIES, skip=PRIORITY_SKIP)
+
 
 class Torrent():
     """A torrent to be downloaded/uploaded."""
     def __init__(self, conn_man, metainfo, on_completed_torrent=None,
-                 on_completed_piece=None):
+                 on_completed_piece=None, storage=None, dht=None, utp=None,
+                 web_seeds=None, budget=None, lsd=None, piece_store=None,
+                 resume_path=None, on_start_failed=None):
         """
         Args:
             conn_man (ConnectionManager): manager for peer connections
             metainfo (TorrentMetainfo): decoded torrent file
             on_completed_torrent (function): torrent download callback
             on_completed_piece (function): torrent piece download callback
+            storage (TorrentStorage): disk storage for completed pieces; if
+                None, completed pieces are kept in memory
+            dht (DHTNode): DHT node to find peers with besides the tracker
+            utp (UTPSocketManager): if given, peers are dialed over uTP
+                first, falling back to TCP
+            web_seeds (WebSeedPool): if given, the metainfo's url-list web
+                seeds are downloaded from on this pool
+            budget (MemoryBudget): client-wide limit on downloaded data held
+                in memory; peers hold off new pieces while it is full. Only
+                running torrents are charged for the blocks they hold
+            lsd (LocalServiceDiscovery): if given, the torrent is announced
+                on the local network while it runs
+            piece_store (PieceStore): data of finished torrents; pieces
+                and files found there are not downloaded, and this torrent's
+                are added to it when it finishes
+            resume_path (str): file to keep fast-resume state in (see
+                qqbt.resume), loaded by load_resume and saved periodically
+                while the torrent runs; needs storage
+            on_start_failed (function): called with the torrent and the
+                error when starting fails after reading the piece store;
+                if None, the torrent is just stopped
         """
         self.metainfo = metainfo
         self.conn_man = conn_man
-        self.active_peers = []
+        self.storage = storage
+        self.dht = dht
+        self.utp = utp
+        self.budget = budget
+        self.held_bytes = 0     # bytes of blocks held, charged while running
+        self.lsd = lsd
+        self.piece_store = piece_store
+        self.is_store_checked = False
+        self.is_reading_store = False
+        self.resume_path = resume_path
+        # Resume files may be written on threads; saves are numbered so an
+        # older state never replaces a newer one.
+        self.resume_lock = threading.Lock()
+        self.resume_seq = 0
+        self.saved_resume_seq = 0
         self.peers = []
+        self.peers_by_addr = {}     # (ip, port) -> TorrentPeer
         self.tracker = None
+        self.connect_timer = None
+        self.rotate_timer = None
+        self.announce_timer = None
+        self.resume_timer = None
+
+        # Web seeds are kept apart from the swarm's peers: they don't use
+        # connection slots and are never dialed, rotated or announced.
+        self.web_seeds = []
+        if web_seeds:
+            from qqbt.webseed import WebSeedPeer
+            for url in metainfo.url_list:
+                for _ in range(CONFIG['web_seed_requests']):
+                    self.web_seeds.append(WebSeedPeer(self, url, web_seeds))
         self.is_complete = False
+        self.is_running = False
+        self.is_paused = False
+        self.max_peers = CONFIG['max_peers']
 
         self.on_completed_torrent = on_completed_torrent
         self.on_completed_piece = on_completed_piece
+        self.on_start_failed = on_start_failed
+
+        num_pieces = len(self.metainfo.info['pieces'])
 
         # Received blocks for incomplete pieces.
-        self.piece_blocks = [[] for _ in self.metainfo.info['pieces']]
+        self.piece_blocks = [[] for _ in range(num_pieces)]
 
         # Peers from which each piece has been requested.
-        self.piece_requests = [[] for _ in self.metainfo.info['pieces']]
+        self.piece_requests = [[] for _ in range(num_pieces)]
+
+        # Completed pieces, or True for pieces written to storage.
+        self.complete_pieces = [None] * num_pieces
+
+        # Blocks of pieces that failed verification, as (begin, block, peer),
+        # kept to find who sent bad data once a good copy arrives.
+        self.failed_blocks = {}
+        self.banned_ips = set()
+
+        # Pieces with all blocks received whose hash is being checked off
+        # the event loop thread.
+        self.verifying_pieces = set()
+
+        # Running hash of each incomplete piece, as [blocks, sha1, length,
+        # pending]: the piece_blocks list it was fed from, the length of the
+        # contiguous prefix fed so far, and begin -> block for the blocks
+        # past a gap, waiting for it to fill.
+        self.piece_hashes = {}
+
+        # Completed pieces restored from a resume file whose data may have
+        # changed since; checked when first read or before completing.
+        self.unverified_pieces = set()
+
+        # Per-file priorities, the priority of each piece (the highest of the
+        # files it overlaps) and the wanted pieces in the order to fetch
+        # them. None until a file priority is set: every piece is wanted.
+        self.file_priorities = None
+        self.piece_priorities = None
+        self.piece_order = None
 
-        # Completed pieces.
-        self.complete_pieces = [None for _ in self.metainfo.info['pieces']]
+        # Open TorrentStreams, and the condition their readers wait on for
+        # pieces to complete.
+        self.streams = []
+        self.stream_cond = threading.Condition()
 
     def start_torrent(self):
+        self.is_running = True
+        if self.budget:
+            self.budget.add(self.held_bytes)
+        if self.is_reading_store:
+            # Started again before the piece store was read; it resumes
+            # starting once it is.
+            return
+        if self.piece_store and not self.is_store_checked:
+            self.is_store_checked = True
+            run_in_thread = getattr(self.conn_man, 'run_in_thread', None)
+            if run_in_thread is not None:
+                # Stored data is read and hashed off the loop thread; the
+                # rest of starting waits for it.
+                self.is_reading_store = True
+                run_in_thread(self.handle_store_read, self.find_in_store,
+                              self.get_missing_pieces())
+                return
+            self.fill_from_store()
+        self.start_transfers()
+
+    def handle_store_read(self, found):
+        self.is_reading_store = False
+        self.fill_from_store(found)
+        if not self.is_running:
+            return
+        try:
+            self.start_transfers()
+        except (OSError, AnnounceFailureError, AnnounceDecodeError) as e:
+            if self.on_start_failed:
+                self.on_start_failed(self, e)
+            else:
+                log.error('%s: failed to start: %s' % (self, e))
+                self.stop_torrent()
+
+    def start_transfers(self):
+        """Finish starting: connect to peers, or complete if nothing is left
+        to download."""
+        if self.is_wanted_complete() and self.verify_unverified_pieces():
+            # Nothing to download. Finish from the loop rather than in the
+            # middle of the scheduler starting us.
+            self.conn_man.call_later(0, self.handle_completed_torrent)
+            return
         self.tracker = TorrentTracker(self, self.metainfo.announce)
-        self.tracker.send_announce_request()
-        for peer in self.peers[:CONFIG['max_peers']]:
-            peer.connect()
+        if self.lsd:
+            self.lsd.add(self.metainfo.info_hash)
+        # Without the DHT or LSD, the tracker is the only peer source at
+        # startup.
+        self.announce(raise_errors=not (self.dht or self.lsd))
+        self.connect_timer = self.conn_man.call_every(
+            CONFIG['connect_interval'], self.connect_more_peers)
+        self.rotate_timer = self.conn_man.call_every(
+            CONFIG['rotate_interval'], self.rotate_peers)
+        if self.resume_path:
+            self.resume_timer = self.conn_man.call_every(
+                CONFIG['resume_interval'], self.save_resume)
+        self.connect_more_peers()
+        for p in self.web_seeds:
+            p.connect()
+
+    def announce(self, raise_errors=False):
+        """Ask the tracker and DHT for peers and schedule the next announce."""
+        interval = CONFIG['announce_retry_interval']
+        try:
+            self.tracker.send_announce_request()
+            interval = self.tracker.interval or interval
+        except (OSError, AnnounceFailureError, AnnounceDecodeError) as e:
+            if raise_errors:
+                raise
+            log.warning('%s: tracker announce failed: %s' % (self, e))
+        if self.dht:
+            self.dht.get_peers(self.metainfo.info_hash, self.handle_dht_peers,
+                               announce_port=self.tracker.get_listen_port())
+        self.announce_timer = self.conn_man.call_later(interval, self.announce)
+
+    def cancel_timers(self):
+        if self.lsd:
+            self.lsd.remove(self.metainfo.info_hash)
+        for timer in (self.connect_timer, self.rotate_timer,
+                      self.announce_timer, self.resume_timer):
+            if timer:
+                timer.cancel()
+        self.connect_timer = self.rotate_timer = self.announce_timer = None
+        self.resume_timer = None
+
+    def handle_dht_peers(self, peer_dicts):
+        if not self.is_running:
+            return
+        for peer_dict in peer_dicts:
+            self.add_peer(peer_dict)
+        self.connect_more_peers()
+
+    def stop_torrent(self):
+        """Disconnect from all peers, e.g. to pause, queue or remove it."""
+        was_running = self.is_running
+        self.is_running = False
+        self.cancel_timers()
+        if was_running:
+            self.save_resume()
+            # Partial pieces wait here until we run again; don't let them
+            # hold back the torrents that are running.
+            if self.budget:
+                self.budget.release(self.held_bytes)
+        for p in self.peers + self.web_seeds:
+            p.handle_torrent_stopped()
+        self.piece_requests = [[] if v is None else None
+                               for v in self.complete_pieces]
 
     def add_peer(self, peer_dict):
-        """Add peer if not already present."""
+        """Add peer if not already present. Returns None if it is banned."""
+        if peer_dict['ip'] in self.banned_ips:
+            return None
         peer = self.find_peer(**peer_dict)
         if peer:
             return peer
         peer = TorrentPeer(self, **peer_dict)
         self.peers.append(peer)
+        self.peers_by_addr[(peer.ip, peer.port)] = peer
+        return peer
+
+    def add_local_peer(self, ip, port):
+        """Add a peer found on the local network; it is dialed first."""
+        if self.is_complete or not self.is_running:
+            return
+        peer = self.add_peer({'ip': ip, 'port': port})
+        if peer is None:
+            return
+        if not peer.is_local:
+            log.info('%s: local peer %s:%d' % (self, ip, port))
+            peer.is_local = True
+        self.connect_more_peers()
+
+    def add_pex_peers(self, peer_dicts):
+        """Add peers learned through peer exchange and dial them."""
+        if self.is_complete or not self.is_running:
+            return
+        for peer_dict in peer_dicts:
+            if len(self.peers) >= CONFIG['max_known_peers']:
+                log.debug('%s: peer table full' % self)
+                break
+            self.add_peer(peer_dict)
+        self.connect_more_peers()
+
+    def get_pex_addrs(self, exclude=None):
+        """Addresses of connected peers that others can dial."""
+        return [(p.ip, p.port) for p in self.peers
+                if p.is_started and p.conn and not p.is_inbound
+                and p is not exclude]
+
+    def accept_inbound_peer(self, ip, port):
+        """Return a peer to take over an inbound connection, or None."""
+        if self.is_complete or not self.is_running:
+            return None
+        if self.get_num_active_peers() >= self.max_peers:
+            log.info('%s: no slot for inbound peer %s:%d' % (self, ip, port))
+            return None
+        peer = self.add_peer({'ip': ip, 'port': port})
+        if peer is None or peer.is_active():
+            return None
+        peer.is_inbound = True
         return peer
 
+    def get_num_active_peers(self):
+        return sum(1 for p in self.peers if p.is_active())
+
     def find_peer(self, ip, port, **kwargs):
-        for peer_list in (self.active_peers, self.peers):
-            for v in peer_list:
-                if v.ip == ip and v.port == port:
-                    return v
-        return None
+        return self.peers_by_addr.get((ip, port))
+
+    def has_block(self, piece_index, begin):
+        blocks = self.piece_blocks[piece_index]
+        return bool(blocks) and any(v[0] == begin for v in blocks)
 
     def handle_block(self, peer, piece_index, begin, block):
-        if self.complete_pieces[piece_index]:
+        if (self.complete_pieces[piece_index]
+                or piece_index in self.verifying_pieces):
             # Piece already finished
             return
+        peer.handle_block_received(len(block))
+        if (piece_index in self.failed_blocks
+                and peer.requested_piece != piece_index):
+            # Failed pieces are re-fetched whole from the peer assigned them.
+            peer.run_download()
+            return
         for v in self.piece_blocks[piece_index]:
             # TODO: check for overlap of block range
             if v[0] == begin:
                 # Already got this block.
-                peer.request_next_block(piece_index, begin)
+                self._continue_piece(peer, piece_index, begin)
                 return
-        self.piece_blocks[piece_index].append((begin, block))
+        self.piece_blocks[piece_index].append((begin, block, peer))
+        self._hold_bytes(len(block))
+        self._update_piece_hash(piece_index, [(begin, block)])
 
         expected_length = self.metainfo.get_piece_length(piece_index)
         piece_length = sum(len(v[1]) for v in self.piece_blocks[piece_index])
         if piece_length == expected_length:
             self.handle_completed_piece(peer, piece_index)
         else:
+            self._continue_piece(peer, piece_index, begin)
+
+    def _continue_piece(self, peer, piece_index, begin):
+        if peer.requested_piece == piece_index:
             peer.request_next_block(piece_index, begin)
+        else:
+            # A late block after the piece was released from this peer.
+            peer.run_download()
+
+    def _update_piece_hash(self, piece_index, new_blocks=()):
+        """Feed the running hash of a piece the blocks that extend its
+        hashed prefix.
+
+        Args:
+            piece_index (int): piece the blocks belong to
+            new_blocks (list): (begin, block) added to its piece_blocks
+                since the last call
+        """
+        blocks = self.piece_blocks[piece_index]
+        state = self.piece_hashes.get(piece_index)
+        if state is None or state[0] is not blocks:
+            # New, or the blocks were discarded and are being fetched again.
+            state = self.piece_hashes[piece_index] = [blocks, hashlib.sha1(),
+                                                      0, {}]
+            new_blocks = [(v[0], v[1]) for v in blocks]
+        pending = state[3]
+        for (begin, block) in new_blocks:
+            if begin >= state[2]:
+                pending[begin] = block
+        block = pending.pop(state[2], None)
+        while block:
+            state[1].update(block)
+            state[2] += len(block)
+            block = pending.pop(state[2], None)
+
+    def get_streamed_hash(self, piece_index):
+        """Return the SHA-1 of a piece hashed as its blocks arrived, or
+        None if they didn't line up into the whole piece."""
+        state = self.piece_hashes.pop(piece_index, None)
+        if (state is None or state[0] is not self.piece_blocks[piece_index]
+                or state[2] != self.metainfo.get_piece_length(piece_index)):
+            return None
+        return state[1].digest()
 
     def handle_completed_piece(self, peer, piece_index):
         if self.complete_pieces[piece_index] is not None:
             log.warning('Piece %d already completed' % piece_index)
             return
 
-        self.piece_blocks[piece_index].sort(key=lambda v: v[0])
-        blocks = [v[1] for v in self.piece_blocks[piece_index]]
-        piece = bytes(v for block in blocks for v in block)
+        blocks = self.piece_blocks[piece_index]
+        blocks.sort(key=lambda v: v[0])
+        piece = b''.join(v[1] for v in blocks)
+
+        # Blocks normally tile the piece, so it was hashed as they came in.
+        piece_sha = self.get_streamed_hash(piece_index)
+        if piece_sha is not None:
+            self.handle_verified_piece(peer, piece_index, blocks, piece,
+                                       piece_sha)
+            return
 
-        piece_sha = hashlib.sha1(piece).digest()
+        # Otherwise hash it whole. Backends that can, do it on a thread so
+        # the loop keeps serving other peers meanwhile.
+        run_in_thread = getattr(self.conn_man, 'run_in_thread', None)
+        if run_in_thread is None:
+            self.handle_verified_piece(peer, piece_index, blocks, piece,
+                                       hash_piece(piece))
+            return
+        self.verifying_pieces.add(piece_index)
+        run_in_thread(
+            lambda piece_sha: self.handle_verified_piece(
+                peer, piece_index, blocks, piece, piece_sha),
+            hash_piece, piece)
+
+    def handle_verified_piece(self, peer, piece_index, blocks, piece,
+                              piece_sha):
+        """Finish a piece once its hash is known."""
+        self.verifying_pieces.discard(piece_index)
+        if self.piece_blocks[piece_index] is not blocks:
+            # Discarded while hashing, e.g. the torrent was removed.
+            return
+        self._release_blocks(blocks)
         canonical_sha = self.metainfo.info['pieces'][piece_index]
         if piece_sha != canonical_sha:
-            # TODO: discard and retry piece
-            raise TorrentPieceError('Piece %d sha mismatch')
+            self.handle_failed_piece(peer, piece_index)
+            return
+        if piece_index in self.failed_blocks:
+            self.attribute_failed_piece(piece_index, piece)
 
-        self.complete_pieces[piece_index] = piece
+        if self.storage:
+            self.storage.write_piece(piece_index, piece)
+            self.complete_pieces[piece_index] = True
+        else:
+            self.complete_pieces[piece_index] = piece
         self.piece_blocks[piece_index] = None
+        if self.streams:
+            with self.stream_cond:
+                self.stream_cond.notify_all()
 
         # Clear piece request bookkeeping on peers and torrent.
+        others = []
         for p in self.piece_requests[piece_index]:
             if p.requested_piece == piece_index:
                 p.requested_piece = None
             if p != peer:
                 # TODO: send cancel
-                pass
+                others.append(p)
         self.piece_requests[piece_index] = None
         log.debug('handle_completed_piece: %d' % piece_index)
         if self.on_completed_piece:
-            self.on_completed_piece(self)
+            self.on_completed_piece(self, piece_index)
 
-        peer.run_download()
-        if not any(v is None for v in self.complete_pieces):
+        if peer.conn:
+            # (It may have been dropped while the piece was hashed.)
+            peer.run_download()
+        for p in others:
+            # Endgame peers racing for this piece move on to another.
+            if p.conn and p.requested_piece is None:
+                p.run_download()
+        if self.is_wanted_complete() and self.verify_unverified_pieces():
             self.handle_completed_torrent()
 
+    def handle_failed_piece(self, peer, piece_index):
+        """Discard a piece that failed verification and fetch it again."""
+        blocks = self.piece_blocks[piece_index]
+        senders = set(v[2] for v in blocks)
+        log.warning('%s: piece %d failed hash check, sent by %s'
+                    % (self, piece_index, ', '.join(map(str, senders))))
+        failed = self.failed_blocks.setdefault(piece_index, [])
+        # Blocks restored from a resume file have no sender (None).
+        if len(senders) == 1:
+            self.add_hash_failure(peer)
+        else:
+            # Blame is assigned once a good copy shows which blocks were bad.
+            # They stay charged to the budget until then.
+            failed.extend(blocks)
+            self._hold_bytes(sum(len(v[1]) for v in blocks))
+        self.piece_blocks[piece_index] = []
+
+        requesters = self.piece_requests[piece_index]
+        self.piece_requests[piece_index] = []
+        for p in requesters:
+            if p.requested_piece == piece_index:
+                p.requested_piece = None
+        for p in set(requesters) | {peer}:
+            if p.conn and p.requested_piece is None:
+                p.run_download()
+
+    def attribute_failed_piece(self, piece_index, piece):
+        """Blame the senders of blocks that differ from the verified piece."""
+        view = memoryview(piece)
+        failed = self.failed_blocks.pop(piece_index)
+        self._release_blocks(failed)
+        offenders = set(p for (begin, block, p) in failed
+                        if p is not None
+                        and view[begin:begin+len(block)] != block)
+        for p in offenders:
+            self.add_hash_failure(p)
+
+    def has_trusted_holder(self, piece_index):
+        """Whether a connected peer that never sent bad data has a piece."""
+        return any(p.conn and p.is_started and p.is_trusted()
+                   and p.has_piece(piece_index) for p in self.peers)
+
+    def add_hash_failure(self, peer):
+        peer.hash_failures += 1
+        if peer.hash_failures >= CONFIG['max_hash_failures']:
+            self.ban_peer(peer)
+
+    def ban_peer(self, peer):
+        log.warning('%s: banning %s after %d hash failures'
+                    % (self, peer.ip, peer.hash_failures))
+        self.banned_ips.add(peer.ip)
+        for p in self.peers:
+            if p.ip == peer.ip and p.is_active():
+                p.disconnect()
+                p.conn_failed = True
+        self.connect_more_peers()
+
+    def _hold_bytes(self, num_bytes):
+        self.held_bytes += num_bytes
+        if self.budget and self.is_running:
+            self.budget.add(num_bytes)
+
+    def _release_blocks(self, blocks):
+        num_bytes = sum(len(v[1]) for v in blocks)
+        self.held_bytes -= num_bytes
+        if self.budget and self.is_running:
+            self.budget.release(num_bytes)
+
+    def discard_partial_pieces(self):
+        """Drop received blocks of unfinished pieces, e.g. on removal."""
+        for (i, blocks) in enumerate(self.piece_blocks):
+            if blocks:
+                self._release_blocks(blocks)
+                self.piece_blocks[i] = []
+        self.verifying_pieces = set()
+        self.piece_hashes = {}
+        for blocks in self.failed_blocks.values():
+            self._release_blocks(blocks)
+        self.failed_blocks = {}
+
+    def release_piece(self, peer, piece_index):
+        """Let other peers request a piece that peer won't be sending."""
+        requests = self.piece_requests[piece_index]
+        if requests and peer in requests:
+            requests.remove(peer)
+        if peer.requested_piece == piece_index:
+            peer.requested_piece = None
+
     def handle_completed_torrent(self):
         log.info('%s: handle_completed_torrent' % (self))
         self.is_complete = True
-        data = bytes(v for piece in self.complete_pieces for v in piece)
+        self.cancel_timers()
+        data = None
+        if self.storage:
+            self.storage.flush()
+            self.save_resume()
+            if self.piece_store:
+                self.piece_store.add_torrent(
+                    self.metainfo, self.storage.paths,
+                    [i for (i, v) in enumerate(self.complete_pieces) if v])
+        elif self.piece_order is None:
+            # Skipped pieces leave holes, so only a whole torrent is returned.
+            data = b''.join(self.complete_pieces)
 
-        for p in self.peers:
+        for p in self.peers + self.web_seeds:
             p.handle_torrent_completed()
 
         if self.on_completed_torrent:
             self.on_completed_torrent(self, data)
 
+    def get_missing_pieces(self):
+        """Wanted pieces that are not complete, in the order to fetch them."""
+        return [i for i in self.get_piece_order()
+                if self.complete_pieces[i] is None]
+
+    def find_in_store(self, pieces):
+        """Look pieces up in the piece store. Safe to run off the loop
+        thread: only the store and the files on disk are touched.
+
+        Files the store has whole are linked into place first, and their
+        pieces checked from disk; other pieces are looked up by hash.
+
+        Args:
+            pieces (list): indices of the pieces to look for
+
+        Returns:
+            list of (piece_index, piece) for the pieces found, where piece
+            is None if the data is already in place on disk
+        """
+        metainfo = self.metainfo
+        self.piece_store.reload()
+        linked = set()
+        if self.storage:
+            offsets = metainfo.get_file_offsets()
+            for (f, file_sha) in enumerate(metainfo.get_file_hashes()):
+                length = offsets[f + 1] - offsets[f]
+                if not (file_sha and length):
+                    continue
+                try:
+                    if self.piece_store.link_file(file_sha, length,
+                                                  self.storage.paths[f]):
+                        linked.add(f)
+                except OSError as e:
+                    log.warning('%s: cannot link %s from the piece store: %s'
+                                % (self, self.storage.paths[f], e))
+
+        found = []
+        for i in pieces:
+            piece_sha = metainfo.info['pieces'][i]
+            length = metainfo.get_piece_length(i)
+            spans = metainfo.get_piece_file_spans(i) if linked else ()
+            if spans and all(f in linked for (f, _, _) in spans):
+                piece = self.storage.read_from_disk(i, 0, length)
+                if hash_piece(piece) == piece_sha:
+                    found.append((i, None))
+                continue
+            piece = self.piece_store.get_piece(piece_sha, length)
+            if piece is not None:
+                found.append((i, piece))
+        return found
+
+    def fill_from_store(self, found=None):
+        """Complete wanted pieces from the piece store, without network I/O.
+
+        Args:
+            found (list): pieces found by find_in_store; looked up here if
+                None
+
+        Returns:
+            number of pieces completed
+        """
+        if found is None:
+            found = self.find_in_store(self.get_missing_pieces())
+        num_filled = 0
+        for (i, piece) in found:
+            if self.complete_pieces[i] is not None:
+                continue
+            if piece is None:
+                # Already in place.
+                self.complete_pieces[i] = True
+            elif self.storage:
+                self.storage.write_piece(i, piece)
+                self.complete_pieces[i] = True
+            else:
+                self.complete_pieces[i] = piece
+            if self.piece_blocks[i]:
+                # Restored from a resume file.
+                self._release_blocks(self.piece_blocks[i])
+                self.piece_hashes.pop(i, None)
+            self.piece_blocks[i] = None
+            self.piece_requests[i] = None
+            num_filled += 1
+            if self.on_completed_piece:
+                self.on_completed_piece(self, i)
+        if num_filled:
+            log.info('%s: %d pieces from the piece store'
+                     % (self, num_filled))
+        return num_filled
+
+    def load_resume(self):
+        """Restore the state saved in the resume file, if there is one.
+
+        Completed pieces are taken on trust where their files are as they
+        were, and marked unverified where the files have changed since.
+
+        Returns:
+            number of completed pieces restored
+        """
+        if not (self.resume_path and self.storage):
+            return 0
+        from qqbt.resume import ResumeState, ResumeError, get_file_stats
+        try:
+            state = ResumeState.load(self.resume_path, self.metainfo)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ResumeError) as e:
+            log.warning('%s: ignoring resume file: %s' % (self, e))
+            return 0
+
+        changed = set()
+        lost = set()
+        current = get_file_stats(self.storage.paths)
+        for (f, (saved, now)) in enumerate(zip(state.files, current)):
+            if saved == now:
+                continue
+            # Files only grow as pieces are written, so a shorter or missing
+            # file has lost data.
+            (lost if now[0] < saved[0] else changed).add(f)
+
+        num_restored = 0
+        for (i, is_complete) in enumerate(state.complete):
+            if not is_complete or self.complete_pieces[i] is not None:
+                continue
+            files = set(f for (f, _, _)
+                        in self.metainfo.get_piece_file_spans(i))
+            if files & lost:
+                continue
+            if i in state.unverified or files & changed:
+                self.unverified_pieces.add(i)
+            self.complete_pieces[i] = True
+            self.piece_blocks[i] = None
+            self.piece_requests[i] = None
+            num_restored += 1
+
+        num_partial = 0
+        for (i, blocks) in state.partial.items():
+            if self.piece_blocks[i] != [] or i in self.failed_blocks:
+                continue
+            self.piece_blocks[i] = [(begin, block, None)
+                                    for (begin, block) in blocks]
+            self._hold_bytes(sum(len(block) for (_, block) in blocks))
+            num_partial += 1
+            length = sum(len(block) for (_, block) in blocks)
+            if length == self.metainfo.get_piece_length(i):
+                # Saved after its last block arrived but before its hash
+                # was checked.
+                self._complete_restored_piece(i)
+            else:
+                self._update_piece_hash(i)
+
+        for (ip, port, best_rate) in state.peers:
+            peer = self.add_peer({'ip': ip, 'port': port})
+            if peer:
+                peer.best_rate = max(peer.best_rate, float(best_rate))
+
+        log.info('%s: resumed %d pieces (%d to verify), %d partial, %d peers'
+                 % (self, num_restored, len(self.unverified_pieces),
+                    num_partial, len(state.peers)))
+        return num_restored
+
+    def _complete_restored_piece(self, piece_index):
+        blocks = self.piece_blocks[piece_index]
+        self._release_blocks(blocks)
+        self.piece_blocks[piece_index] = []
+        blocks.sort(key=lambda v: v[0])
+        piece = b''.join(v[1] for v in blocks)
+        if hash_piece(piece) != self.metainfo.info['pieces'][piece_index]:
+            return
+        self.storage.write_piece(piece_index, piece)
+        self.complete_pieces[piece_index] = True
+        self.piece_blocks[piece_index] = None
+        self.piece_requests[piece_index] = None
+
+    def save_resume(self, flush=False):
+        """Write the resume file.
+
+        Args:
+            flush (bool): wait for the write cache to write this torrent's
+                completed pieces first, and write the file before returning.
+                Otherwise only those already on disk are recorded as
+                complete, and backends that can write the file on a thread
+                so the event loop isn't blocked.
+        """
+        if not (self.resume_path and self.storage):
+            return
+        from qqbt.resume import ResumeState, get_file_stats
+        if flush:
+            self.storage.flush()
+            unwritten = set()
+        else:
+            unwritten = self.storage.get_unwritten_pieces()
+        partial = {}
+        for (i, blocks) in enumerate(self.piece_blocks):
+            if blocks:
+                partial[i] = [(begin, block) for (begin, block, _) in blocks]
+        good_peers = sorted((p for p in self.peers
+                             if p.best_rate > 0 and p.is_trusted()),
+                            key=lambda p: -p.best_rate)
+        state = ResumeState(
+            self.metainfo.info_hash,
+            [v is not None and i not in unwritten
+             for (i, v) in enumerate(self.complete_pieces)],
+            self.unverified_pieces, get_file_stats(self.storage.paths),
+            partial, [(p.ip, p.port, p.best_rate) for p in good_peers])
+        self.resume_seq += 1
+        run_in_thread = getattr(self.conn_man, 'run_in_thread', None)
+        if flush or run_in_thread is None:
+            self.write_resume(state, self.resume_seq)
+        else:
+            run_in_thread(lambda _: None, self.write_resume, state,
+                          self.resume_seq)
+
+    def write_resume(self, state, seq):
+        """Write the seq'th saved state, unless a later one is written."""
+        with self.resume_lock:
+            if seq < self.saved_resume_seq:
+                return
+            self.saved_resume_seq = seq
+            try:
+                state.save(self.resume_path)
+            except OSError as e:
+                log.warning('%s: cannot save resume file: %s' % (self, e))
+
+    def verify_piece(self, piece_index):
+        """Check a restored piece from disk against its hash.
+
+        A bad piece is marked incomplete, to be fetched again.
+
+        Returns:
+            True if the piece is good
+        """
+        self.unverified_pieces.discard(piece_index)
+        length = self.metainfo.get_piece_length(piece_index)
+        piece = self.storage.read_from_disk(piece_index, 0, length)
+        if hash_piece(piece) == self.metainfo.info['pieces'][piece_index]:
+            return True
+        log.warning('%s: resumed piece %d failed hash check'
+                    % (self, piece_index))
+        self.complete_pieces[piece_index] = None
+        self.piece_blocks[piece_index] = []
+        self.piece_requests[piece_index] = []
+        return False
+
+    def verify_unverified_pieces(self):
+        """Check all restored pieces not checked yet.
+
+        Returns:
+            True if they were all good
+        """
+        return all([self.verify_piece(i)
+                    for i in sorted(self.unverified_pieces)])
+
+    def read_block(self, piece_index, begin, length):
+        """Read part of a completed piece, e.g. to upload it."""
+        piece = self.complete_pieces[piece_index]
+        if piece is None:
+            raise TorrentPieceError('Piece %d not complete' % piece_index)
+        if (piece_index in self.unverified_pieces
+                and not self.verify_piece(piece_index)):
+            raise TorrentPieceError('Piece %d failed verification'
+                                    % piece_index)
+        if self.storage:
+            return self.storage.read(piece_index, begin, length)
+        return piece[begin:begin+length]
+
+    def set_file_priority(self, file_index, priority):
+        """Set the priority of a file; PRIORITY_SKIP leaves it out.
+
+        Pieces that span a file boundary take the highest priority of the
+        files they overlap, so a piece shared with a wanted file is fetched
+        whole even if its other file is skipped.
+        """
+        if self.file_priorities is None:
+            num_files = len(self.metainfo.get_file_lengths())
+            self.file_priorities = [PRIORITY_NORMAL] * num_files
+        self.file_priorities[file_index] = priority
+        self._update_piece_priorities()
+        if self.is_complete and not self.is_wanted_complete():
+            self.is_complete = False
+
+    def _update_piece_priorities(self):
+        offsets = self.metainfo.get_file_offsets()
+        piece_length = self.metainfo.info['piece_length']
+        priorities = [PRIORITY_SKIP] * len(self.complete_pieces)
+        for (f, priority) in enumerate(self.file_priorities):
+            if offsets[f] == offsets[f + 1]:
+                continue
+            first = offsets[f] // piece_length
+            last = (offsets[f + 1] - 1) // piece_length
+            for i in range(first, last + 1):
+                if priority > priorities[i]:
+                    priorities[i] = priority
+        self.piece_priorities = priorities
+        self.piece_order = sorted(
+            (i for (i, v) in enumerate(priorities) if v != PRIORITY_SKIP),
+            key=lambda i: -priorities[i])
+
+    def get_piece_order(self):
+        """Wanted pieces, highest priority first, else in index order."""
+        if self.piece_order is None:
+            return range(len(self.complete_pieces))
+        return self.piece_order
+
+    def is_wanted(self, piece_index):
+        return (self.piece_priorities is None
+                or self.piece_priorities[piece_index] != PRIORITY_SKIP)
+
+    def is_wanted_complete(self):
+        return all(self.complete_pieces[i] is not None
+                   for i in self.get_piece_order())
+
+    def add_stream(self, stream):
+        self.streams.append(stream)
+
+    def remove_stream(self, stream):
+        if stream in self.streams:
+            self.streams.remove(stream)
+
+    def request_piece_check(self, piece_index):
+        """Have the event loop check a restored piece a stream is waiting
+        for. May be called from any thread; stream_cond is notified once the
+        piece is checked."""
+        call_from_thread = getattr(self.conn_man, 'call_from_thread', None)
+        if call_from_thread is None:
+            self.check_streamed_piece(piece_index)
+        else:
+            call_from_thread(self.check_streamed_piece, piece_index)
+
+    def check_streamed_piece(self, piece_index):
+        if piece_index in self.unverified_pieces:
+            self.verify_piece(piece_index)
+        with self.stream_cond:
+            self.stream_cond.notify_all()
+
+    def close_streams(self):
+        for stream in list(self.streams):
+            stream.abort()
+        self.streams = []
+
+    def get_stream_pieces(self):
+        """Incomplete pieces that open streams will read next.
+
+        Returns:
+            list of (piece_index, is_urgent) tuples, in the order to fetch
+            them; urgent pieces are the ones under a stream's cursor
+        """
+        if not self.streams:
+            return []
+        piece_length = self.metainfo.info['piece_length']
+        pieces = []
+        seen = set()
+        for stream in list(self.streams):
+            (begin, end) = stream.get_window(CONFIG['stream_window_bytes'])
+            first = begin // piece_length
+            for i in range(first, (end + piece_length - 1) // piece_length):
+                if i not in seen and not self.complete_pieces[i]:
+                    seen.add(i)
+                    pieces.append((i, i == first))
+        pieces.sort(key=lambda v: not v[1])
+        return pieces
+
     def handle_peer_stopped(self, peer):
         """A peer failed or completed so start a new one."""
-        # TODO: run this on a timer instead of a connection failed callback
-        # TODO: better active count
-        if self.is_complete:
-            return
-        num_active = sum(1 for p in self.peers
-                         if p.is_started and not p.conn_failed)
-        if num_active >= CONFIG['max_peers']:
-            return
-        # HACK: skip initial peers in case conn failed callback runs before all
-        # initial peers are started
-        for p in self.peers[CONFIG['max_peers']:]:
-        #for p in self.peers:
-            if p.conn or p.is_started or p.conn_failed:
+        self.connect_more_peers()
+
+    def connect_more_peers(self):
+        """Dial peers until the connection budget is used up."""
+        if self.is_complete or not self.is_running:
+            return
+        candidates = [p for p in self.peers if p.is_dial_candidate()]
+        candidates.sort(key=lambda p: p.get_dial_rank())
+        for p in candidates:
+            # Inbound peers count against the same budget. Recount each time
+            # since a failed connect recurses back in here.
+            if self.get_num_active_peers() >= self.max_peers:
+                break
+            if not p.is_dial_candidate():
                 continue
-            log.info('handle_peer_stopped: starting new peer: %s' % p)
+            log.info('connect_more_peers: starting new peer: %s' % p)
             p.connect()
-            break
+
+    def set_max_peers(self, max_peers):
+        """Change the connection budget, dropping the worst peers if over."""
+        self.max_peers = max_peers
+        active = [p for p in self.peers if p.is_active()]
+        excess = len(active) - max_peers
+        if excess <= 0:
+            return
+        # Half-open connections go first, then the slowest.
+        active.sort(key=lambda p: (p.is_started, p.download_rate))
+        for p in active[:excess]:
+            p.disconnect()
+
+    def rotate_peers(self):
+        """Swap the worst connected peer for a fresh candidate.
+
+        Runs only while the connection budget is full and there is someone
+        to dial; snubbed peers go first, then the slowest.
+        """
+        if self.is_complete or not self.is_running:
+            return
+        if self.get_num_active_peers() < self.max_peers:
+            return
+        if not any(p.is_dial_candidate() for p in self.peers):
+            return
+        now = time.monotonic()
+        connected = [p for p in self.peers if p.is_started and p.conn
+                     and now - p.connected_at >= CONFIG['rotate_interval']]
+        if not connected:
+            return
+        worst = min(connected,
+                    key=lambda p: (not p.is_snubbed, p.download_rate))
+        worst.update_rate(now)
+        log.info('%s: rotating out %s (%.0f B/s%s)'
+                 % (self, worst, worst.download_rate,
+                    ', snubbed' if worst.is_snubbed else ''))
+        worst.num_rotations += 1
+        worst.disconnect()
+        self.connect_more_peers()
+
+    def get_num_complete(self):
+        return sum(v is not None for v in self.complete_pieces)
+
+    def get_num_wanted(self):
+        return len(self.get_piece_order())
 
     def get_progress_string(self):
-        num_complete = sum(v is not None for v in self.complete_pieces)
-        num_pieces = len(self.complete_pieces)
-        pct_complete = 100.0 * num_complete / num_pieces
-        return('%s / %s (%02.1f%%) complete'
-               % (num_complete, num_pieces, pct_complete))
+        num_complete = sum(self.complete_pieces[i] is not None
+                           for i in self.get_piece_order())
+        return format_progress(num_complete, self.get_num_wanted())
+
+
+def hash_piece(piece):
+    return hashlib.sha1(piece).digest()
+
+
+def format_progress(num_complete, num_pieces):
+    if not num_pieces:
+        # Every file is skipped.
+        return 'nothing selected'
+    pct_complete = 100.0 * num_complete / num_pieces
+    return('%s / %s (%02.1f%%) complete'
+           % (num_complete, num_pieces, pct_complete))
 
 
 class TorrentPieceError(Exception):
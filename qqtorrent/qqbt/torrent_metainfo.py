@@ -1,9 +1,13 @@
 import os
-import copy
 import hashlib
+import urllib.parse
+from array import array
+from collections.abc import Sequence
 from pprint import pformat
-import bencodepy
-import voluptuous as vol
+
+from qqbt import bencode
+
+SHA_LEN = 20
 
 
 class TorrentMetainfo():
@@ -13,14 +17,17 @@ class TorrentMetainfo():
         Args:
             bencontent (bytes): bencoded torrent file contents
         """
+        self.cache_entry = None
+        self._file_offsets = None
+        self._piece_file_index = None
+
         if not bencontent:
             raise TorrentDecodeError('Empty torrent file')
 
         try:
-            content = bencodepy.decode(bencontent)
-        except bencodepy.DecodingError as e:
-            # TODO: better msg
-            raise TorrentDecodeError from e
+            (content, spans) = bencode.decode_dict_spans(bencontent)
+        except bencode.BencodeDecodeError as e:
+            raise TorrentDecodeError(str(e)) from e
 
         # TODO: validate shape using voluptuous or schema libraries
 
@@ -30,6 +37,7 @@ class TorrentMetainfo():
             raise(TorrentDecodeError('Unsupported encoding: %s' % encoding))
 
         self.announce = content[b'announce'].decode('utf-8')
+        import voluptuous as vol    # deferred: slow to import
         try:
             vol.Url()(self.announce)
         except vol.UrlInvalid as e:
@@ -38,20 +46,62 @@ class TorrentMetainfo():
 
         # Ignore 'creation date', 'comment', 'created by', 'announce-list'
 
-        info_dict = content[b'info']
-        self.info_hash = hashlib.sha1(bencodepy.encode(info_dict)).digest()
-        self.info = self._decode_info_dict(info_dict)
+        self.url_list = self._decode_url_list(content.get(b'url-list'))
+
+        # Hash the info dict straight from its raw span in the file.
+        (begin, end) = spans[b'info']
+        self.info_hash = hashlib.sha1(
+            memoryview(bencontent)[begin:end]).digest()
+        self.info = self._decode_info_dict(content[b'info'])
+
+    @classmethod
+    def from_fields(cls, announce, info_hash, name, info,
+                    piece_file_index=None, cache_entry=None, url_list=None):
+        """Build metainfo from already decoded fields, e.g. from a cache."""
+        self = cls.__new__(cls)
+        self.announce = announce
+        self.url_list = url_list or []
+        self.info_hash = info_hash
+        self.name = name
+        self.info = info
+        self.cache_entry = cache_entry
+        self._file_offsets = None
+        self._piece_file_index = piece_file_index
+        return self
+
+    @staticmethod
+    def _decode_url_list(url_list):
+        """Web seed (BEP 19) URLs: one URL or a list.
+
+        Entries that aren't well-formed http(s) URLs are ignored.
+        """
+        if isinstance(url_list, bytes):
+            url_list = [url_list]
+        if not isinstance(url_list, list):
+            return []
+        urls = []
+        for url in url_list:
+            try:
+                url = url.decode('utf-8')
+            except (AttributeError, UnicodeDecodeError):
+                continue
+            if not url.startswith(('http://', 'https://')):
+                continue
+            try:
+                parts = urllib.parse.urlsplit(url)
+                parts.port    # raises ValueError for a bad port
+            except ValueError:
+                continue
+            if parts.hostname:
+                urls.append(url)
+        return urls
 
     def _decode_info_dict(self, d):
         info = {}
 
         info['piece_length'] = d[b'piece length']
 
-        SHA_LEN = 20
-        pieces_shas = d[b'pieces']
-        info['pieces'] = [pieces_shas[i:i+SHA_LEN]
-                          for i in range(0, len(pieces_shas), SHA_LEN)]
-        # TODO: different representation?
+        info['pieces'] = PieceHashes(d[b'pieces'])
 
         self.name = d[b'name'].decode('utf-8')
 
@@ -60,25 +110,23 @@ class TorrentMetainfo():
             info['format'] = 'SINGLE_FILE'
             info['files'] = None
             info['length'] = d[b'length']
+            info['sha1'] = d.get(b'sha1')
         else:
             info['format'] = 'MULTIPLE_FILE'
-            info['files'] = []
-            for f in d[b'files']:
-                path_segments = [v.decode('utf-8') for v in f[b'path']]
-                info['files'].append({
-                    'length': f[b'length'],
-                    'path': os.path.join(*path_segments)
-                })
-            info['length'] = sum(f['length'] for f in info['files'])
+            info['files'] = TorrentFileList(files)
+            info['length'] = sum(f[b'length'] for f in files)
 
         return info
 
     def __repr__(self):
-        tdict = copy.deepcopy(self.__dict__)
-        if len(tdict['info']['pieces']) > 3:
-            tdict['info']['pieces'] = tdict['info']['pieces'][:3] + ['...']
-        if tdict['info']['files'] and len(tdict['info']['files']) > 3:
-            tdict['info']['files'] = tdict['info']['files'][:3] + ['...']
+        tdict = {k: self.__dict__[k]
+                 for k in ('announce', 'info_hash', 'name')}
+        tdict['info'] = dict(self.info)
+        for key in ('pieces', 'files'):
+            v = self.info[key]
+            if v is not None:
+                tdict['info'][key] = (list(v[:3]) + ['...'] if len(v) > 3
+                                      else list(v))
         return ''.join(('TorrentMetainfo(', pformat(tdict), ')'))
 
     def get_piece_length(self, index):
@@ -88,6 +136,144 @@ class TorrentMetainfo():
             return (self.info['length'] - (num_pieces - 1) * piece_length)
         return piece_length
 
+    def get_file_lengths(self):
+        if self.info['files'] is None:
+            return [self.info['length']]
+        return self.info['files'].lengths()
+
+    def get_file_hashes(self):
+        """Return the SHA-1 of each file (BEP 47), or None for files the
+        torrent gives none for."""
+        files = self.info['files']
+        if files is None:
+            hashes = [self.info.get('sha1')]
+        elif isinstance(files, TorrentFileList):
+            hashes = [f.get(b'sha1') for f in files.raw_files]
+        else:
+            # Files from the metainfo cache don't keep extra keys.
+            hashes = [None] * len(files)
+        return [h if isinstance(h, bytes) and len(h) == SHA_LEN else None
+                for h in hashes]
+
+    def get_file_index(self, path):
+        """Return the index of the file at path within the torrent."""
+        if self.info['files'] is None:
+            if path in (self.name, os.path.basename(self.name)):
+                return 0
+        else:
+            path = os.path.normpath(path)
+            for (i, f) in enumerate(self.info['files']):
+                if f['path'] == path:
+                    return i
+        raise KeyError('No file %s in torrent %s' % (path, self.name))
+
+    def get_file_offsets(self):
+        """Return the start offset of each file, plus the total length."""
+        if self._file_offsets is None:
+            offsets = [0]
+            for length in self.get_file_lengths():
+                offsets.append(offsets[-1] + length)
+            self._file_offsets = offsets
+        return self._file_offsets
+
+    def get_piece_file_index(self):
+        """Return the index of the first file overlapping each piece."""
+        if self._piece_file_index is None:
+            offsets = self.get_file_offsets()
+            piece_length = self.info['piece_length']
+            index = array('I', bytes(4 * len(self.info['pieces'])))
+            f = 0
+            for i in range(len(index)):
+                begin = i * piece_length
+                while offsets[f + 1] <= begin and f + 2 < len(offsets):
+                    f += 1
+                index[i] = f
+            self._piece_file_index = index
+        return self._piece_file_index
+
+    def get_piece_file_spans(self, index):
+        """Map a piece onto the files it covers.
+
+        Returns:
+            list of (file_index, file_offset, length) tuples
+        """
+        offsets = self.get_file_offsets()
+        begin = index * self.info['piece_length']
+        end = begin + self.get_piece_length(index)
+        f = self.get_piece_file_index()[index]
+        spans = []
+        while begin < end:
+            n = min(end, offsets[f + 1]) - begin
+            if n > 0:
+                spans.append((f, begin - offsets[f], n))
+                begin += n
+            f += 1
+        return spans
+
+
+class PieceHashes(Sequence):
+    """Piece SHA-1 hashes kept packed in a single contiguous buffer.
+
+    Indexing returns the 20 byte hash of a piece as bytes; view() returns it as
+    a memoryview into the buffer without copying.
+    """
+    def __init__(self, buf):
+        """
+        Args:
+            buf (bytes): concatenated 20 byte piece hashes
+        """
+        self.buf = buf
+        self._view = memoryview(buf)
+
+    def __len__(self):
+        return len(self.buf) // SHA_LEN
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.view(index).tobytes()
+
+    def view(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('piece index out of range')
+        return self._view[index * SHA_LEN:(index + 1) * SHA_LEN]
+
+
+class TorrentFileList(Sequence):
+    """The files of a MULTIPLE_FILE torrent, decoded lazily on access."""
+    def __init__(self, raw_files):
+        """
+        Args:
+            raw_files (list): bencoded 'files' entries, with bytes keys
+        """
+        self.raw_files = raw_files
+        self.decoded = [None] * len(raw_files)
+
+    def lengths(self):
+        return [f[b'length'] for f in self.raw_files]
+
+    def __len__(self):
+        return len(self.raw_files)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        file_dict = self.decoded[index]
+        if file_dict is None:
+            f = self.raw_files[index]
+            try:
+                path_segments = [v.decode('utf-8') for v in f[b'path']]
+                file_dict = {
+                    'length': f[b'length'],
+                    'path': os.path.join(*path_segments)
+                }
+            except (KeyError, TypeError, UnicodeDecodeError) as e:
+                raise TorrentDecodeError('Invalid file entry: %s' % f) from e
+            self.decoded[index] = file_dict
+        return file_dict
+
 
 class TorrentDecodeError(Exception):
     pass
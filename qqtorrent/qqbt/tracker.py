@@ -1,8 +1,7 @@
 import struct
-import requests
-import bencodepy
 import logging
 
+from qqbt import bencode
 from qqbt.config import CONFIG
 
 log = logging.getLogger(__name__)
@@ -14,25 +13,35 @@ class TorrentTracker():
         self.torrent = torrent
         self.announce = announce
         self.tracker_id = None
+        self.interval = None
 
     def send_announce_request(self):
-        # TODO: send 'port', 'uploaded', 'downloaded', 'left'
+        # TODO: send 'uploaded', 'downloaded', 'left'
         # TODO:'compact', 'no_peer_id', 'event' (started/completed/stopped)
+        import requests     # deferred: slow to import
         http_resp = requests.get(self.announce, {
             'info_hash': self.torrent.metainfo.info_hash,
             'peer_id': CONFIG['peer_id'],
-            'port': 6881,
+            'port': self.get_listen_port(),
             'uploaded': '0',
             'downloaded': '0',
             'left': str(self.torrent.metainfo.info['length'])
         })
         self.handle_announce_response(http_resp)
 
+    def get_listen_port(self):
+        port = getattr(self.torrent.conn_man, 'listen_port', None)
+        return port if port else CONFIG['listen_port']
+
     def handle_announce_response(self, http_resp):
-        resp = bencodepy.decode(http_resp.text.encode('latin-1'))
+        try:
+            resp = bencode.decode(http_resp.content)
+        except bencode.BencodeDecodeError as e:
+            raise AnnounceDecodeError('Invalid announce response') from e
         d = self.decode_announce_response(resp)
+        self.interval = d['interval']
 
-        # TODO: use 'interval', 'tracker id', 'complete', 'incomplete'
+        # TODO: use 'tracker id', 'complete', 'incomplete'
 
         for peer_dict in d['peers']:
             # TODO: raise error or warning on port = 0?
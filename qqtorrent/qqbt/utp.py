@@ -0,0 +1,589 @@
+"""uTP (BEP 29): reliable, ordered peer connections over UDP.
+
+All connections share one UDP socket served by the connection manager's
+event loop, and present the same interface as the TCP peer connections in
+qqbt.conn (write, disconnect and the peer's handle_* callbacks), so a
+TorrentPeer does not care which transport it runs on.
+
+Congestion control is LEDBAT (RFC 6817): the window grows while the one-way
+queuing delay measured from packet timestamps is below TARGET_DELAY and
+shrinks above it, so bulk transfers back off before they fill the link's
+buffers and delay other traffic. Lost packets are detected from selective
+ACKs, duplicate ACKs and timeouts, and resent.
+"""
+import os
+import time
+import socket
+import struct
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+EXT_SACK = 1
+
+HEADER = struct.Struct('!BBHIIIHH')
+SEQ_MASK = 0xFFFF
+
+MSS = 1380                  # payload bytes per packet
+MIN_WINDOW = 2 * MSS
+MAX_WINDOW = 2**20
+RECV_WINDOW = 2**20         # window we advertise
+TARGET_DELAY = 100000       # microseconds of queuing delay to aim for
+GAIN = 1.0
+BASE_HISTORY = 10           # minutes of base delay minima kept
+MIN_TIMEOUT = 0.5           # seconds
+INITIAL_TIMEOUT = 1.0
+MAX_TIMEOUT = 30.0
+SYN_RETRIES = 3
+MAX_RETRIES = 8
+DUP_ACK_LIMIT = 3
+MAX_REORDER = 256           # out-of-order packets buffered (SACK bits)
+TICK_INTERVAL = 0.05        # seconds between timeout checks
+
+CS_SYN_SENT = 'syn_sent'
+CS_CONNECTED = 'connected'
+CS_CLOSING = 'closing'
+CS_CLOSED = 'closed'
+
+
+def timestamp_us():
+    return int(time.monotonic() * 1000000) & 0xFFFFFFFF
+
+
+def seq_less(a, b):
+    """Whether sequence number a comes before b, modulo wrap-around."""
+    return 0 < ((b - a) & SEQ_MASK) < 0x8000
+
+
+def encode_packet(ptype, conn_id, ts, ts_diff, wnd, seq_nr, ack_nr,
+                  payload=b'', sack=None):
+    ext = EXT_SACK if sack else 0
+    header = HEADER.pack((ptype << 4) | VERSION, ext, conn_id, ts, ts_diff,
+                         wnd, seq_nr, ack_nr)
+    if sack:
+        header += bytes([0, len(sack)]) + sack
+    return header + payload
+
+
+def decode_packet(data):
+    """Decode a uTP packet.
+
+    Returns:
+        dict with the header fields, 'sack' (bytes or None) and 'payload'
+    """
+    if len(data) < HEADER.size:
+        raise UTPPacketError('Short packet')
+    (type_ver, ext, conn_id, ts, ts_diff, wnd, seq_nr,
+     ack_nr) = HEADER.unpack_from(data)
+    ptype = type_ver >> 4
+    if type_ver & 0x0F != VERSION or ptype > ST_SYN:
+        raise UTPPacketError('Bad type/version %#x' % type_ver)
+    ofs = HEADER.size
+    sack = None
+    while ext:
+        if ofs + 2 > len(data):
+            raise UTPPacketError('Truncated extension')
+        (next_ext, length) = data[ofs], data[ofs + 1]
+        if ofs + 2 + length > len(data):
+            raise UTPPacketError('Truncated extension')
+        if ext == EXT_SACK:
+            sack = data[ofs + 2:ofs + 2 + length]
+        ext = next_ext
+        ofs += 2 + length
+    return {'type': ptype, 'conn_id': conn_id, 'ts': ts, 'ts_diff': ts_diff,
+            'wnd': wnd, 'seq_nr': seq_nr, 'ack_nr': ack_nr, 'sack': sack,
+            'payload': data[ofs:]}
+
+
+def encode_sack(ack_nr, received):
+    """Bitmask of received packets from ack_nr + 2 on, in 4 byte units."""
+    offsets = [(seq - ack_nr - 2) & SEQ_MASK for seq in received]
+    offsets = [i for i in offsets if i < MAX_REORDER]
+    if not offsets:
+        return None
+    mask = bytearray((max(offsets) // 32 + 1) * 4)
+    for i in offsets:
+        mask[i // 8] |= 1 << (i % 8)
+    return bytes(mask)
+
+
+def decode_sack(ack_nr, mask):
+    return [(ack_nr + 2 + i) & SEQ_MASK for i in range(len(mask) * 8)
+            if mask[i // 8] & (1 << (i % 8))]
+
+
+class UTPSocketManager():
+    """The shared UDP socket and the uTP connections multiplexed over it."""
+    def __init__(self, conn_man, port=0, bind_ip='0.0.0.0', sock=None):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop serving the socket
+            port (int): UDP port, 0 for any free port
+            bind_ip (str): address to bind
+            sock (socket.socket): bound UDP socket owned and read by someone
+                else (e.g. the DHT), who passes uTP datagrams to
+                handle_datagram(); if None, a socket is opened
+        """
+        self.conn_man = conn_man
+        self.conns = {}         # (addr, recv_id) -> UTPConnection
+        self.make_peer = None
+        self.pending_acks = set()
+        self.in_batch = False
+        self.owns_sock = sock is None
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((bind_ip, port))
+            sock.setblocking(False)
+            conn_man.add_reader(sock, self.handle_readable)
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.timer = conn_man.call_every(TICK_INTERVAL, self.check_timeouts)
+
+    def __repr__(self):
+        return 'UTPSocketManager(port=%d)' % self.port
+
+    def listen(self, make_peer):
+        """Accept inbound connections, as ConnectionManager.listen does."""
+        self.make_peer = make_peer
+
+    def connect_peer(self, peer):
+        addr = (peer.ip, peer.port)
+        while True:
+            recv_id = struct.unpack('!H', os.urandom(2))[0]
+            if (addr, recv_id) not in self.conns:
+                break
+        conn = UTPConnection(self, peer, addr, recv_id,
+                             (recv_id + 1) & SEQ_MASK)
+        self.conns[(addr, recv_id)] = conn
+        conn.send_syn()
+        return conn
+
+    def close(self):
+        for conn in list(self.conns.values()):
+            conn.disconnect()
+        self.timer.cancel()
+        if self.owns_sock:
+            self.conn_man.remove_reader(self.sock)
+            self.sock.close()
+
+    def send_datagram(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except OSError as e:
+            log.debug('%s: sendto %s failed: %s' % (self, addr, e))
+
+    def handle_readable(self):
+        self.in_batch = True
+        try:
+            while True:
+                try:
+                    (data, addr) = self.sock.recvfrom(65536)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    log.debug('%s: recvfrom failed: %s' % (self, e))
+                    continue
+                self.handle_datagram(data, addr)
+        finally:
+            self.in_batch = False
+        self.flush_acks()
+
+    def handle_datagram(self, data, addr):
+        try:
+            pkt = decode_packet(data)
+        except UTPPacketError as e:
+            log.debug('%s: bad packet from %s: %s' % (self, addr, e))
+            return
+        if pkt['type'] == ST_SYN:
+            self.handle_syn(pkt, addr)
+        else:
+            conn = self.conns.get((addr, pkt['conn_id']))
+            if conn:
+                conn.handle_packet(pkt)
+            else:
+                log.debug('%s: packet for unknown connection from %s'
+                          % (self, addr))
+        if not self.in_batch:
+            self.flush_acks()
+
+    def handle_syn(self, pkt, addr):
+        recv_id = (pkt['conn_id'] + 1) & SEQ_MASK
+        conn = self.conns.get((addr, recv_id))
+        if conn:
+            # Our SYN-ACK was lost.
+            conn.send_state()
+            return
+        if self.make_peer is None:
+            return
+        seq_nr = struct.unpack('!H', os.urandom(2))[0]
+        conn = UTPConnection(self, None, addr, recv_id, pkt['conn_id'],
+                             seq_nr=seq_nr, ack_nr=pkt['seq_nr'])
+        conn.state = CS_CONNECTED
+        conn.handle_timestamps(pkt)
+        self.conns[(addr, recv_id)] = conn
+        conn.send_state()
+        conn.peer = self.make_peer(*addr)
+        conn.peer.handle_connection_made(conn)
+
+    def flush_acks(self):
+        pending = self.pending_acks
+        self.pending_acks = set()
+        for conn in pending:
+            if conn.state != CS_CLOSED:
+                conn.send_state()
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        for conn in list(self.conns.values()):
+            conn.check_timeout(now)
+
+    def remove(self, conn):
+        self.conns.pop((conn.addr, conn.recv_id), None)
+        self.pending_acks.discard(conn)
+
+
+class UTPConnection():
+    """One uTP connection; the uTP counterpart of PeerConnectionSelect."""
+    def __init__(self, manager, peer, addr, recv_id, send_id, seq_nr=1,
+                 ack_nr=0):
+        """
+        Args:
+            manager (UTPSocketManager): socket to send on
+            peer (TorrentPeer): peer receiving connection callbacks
+            addr (tuple): remote (ip, port)
+            recv_id (int): connection id on packets we receive
+            send_id (int): connection id on packets we send
+            seq_nr (int): sequence number of our next packet
+            ack_nr (int): last in-order sequence number received
+        """
+        self.manager = manager
+        self.peer = peer
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.seq_nr = seq_nr
+        self.ack_nr = ack_nr
+        self.state = CS_SYN_SENT
+
+        # Sending
+        self.write_buffer = bytearray()
+        self.unacked = OrderedDict()    # seq_nr -> UTPOutPacket
+        self.bytes_in_flight = 0
+        self.tx_count = 0               # transmissions so far
+        self.last_acked_tx = 0          # latest transmission acked
+        self.cwnd = 2 * MSS
+        self.peer_wnd = RECV_WINDOW
+        self.last_ack = None
+        self.dup_acks = 0
+        self.recovery_seq = seq_nr      # no window cut for losses before
+        self.fin_seq = None
+
+        # Receiving
+        self.reorder = {}               # seq_nr -> packet dict
+        self.reply_micro = 0            # one-way delay seen on their packets
+
+        # Delay and round trip estimates
+        self.base_delays = []           # [minute, min delay] pairs
+        self.rtt = None
+        self.rtt_var = 0.0
+        self.rto = INITIAL_TIMEOUT
+        self.last_progress = time.monotonic()
+        self.num_timeouts = 0
+
+    def __repr__(self):
+        return ('UTPConnection(%s:%d, id=%d, %s)'
+                % (self.addr[0], self.addr[1], self.recv_id, self.state))
+
+    # ===== PeerConnection interface
+
+    def write(self, data):
+        if self.state in (CS_CLOSING, CS_CLOSED):
+            return
+        self.write_buffer += data
+        self.flush()
+
+    def disconnect(self):
+        """Close once queued data is sent, without calling back the peer."""
+        if self.state == CS_CLOSED:
+            return
+        if self.state == CS_SYN_SENT:
+            self.close()
+            return
+        self.state = CS_CLOSING
+        self.peer = None
+        self.flush()
+
+    # ===== Sending
+
+    def send_syn(self):
+        self.send_packet(ST_SYN, b'')
+
+    def send_state(self):
+        self.manager.pending_acks.discard(self)
+        self._send(ST_STATE, self.seq_nr, b'')
+
+    def _send(self, ptype, seq_nr, payload):
+        sack = encode_sack(self.ack_nr, self.reorder) if self.reorder else None
+        conn_id = self.recv_id if ptype == ST_SYN else self.send_id
+        wnd = max(0, RECV_WINDOW - sum(len(p['payload'])
+                                       for p in self.reorder.values()))
+        self.manager.send_datagram(encode_packet(
+            ptype, conn_id, timestamp_us(), self.reply_micro, wnd, seq_nr,
+            self.ack_nr, payload, sack), self.addr)
+
+    def send_packet(self, ptype, payload):
+        """Send a packet that takes a sequence number and must be acked."""
+        if not self.unacked:
+            self.last_progress = time.monotonic()
+        packet = UTPOutPacket(ptype, self.seq_nr, payload)
+        self.unacked[self.seq_nr] = packet
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self._transmit(packet)
+
+    def _transmit(self, packet):
+        packet.sent_at = time.monotonic()
+        packet.transmissions += 1
+        self.tx_count += 1
+        packet.tx_count = self.tx_count
+        packet.need_resend = False
+        self.bytes_in_flight += packet.size
+        self.manager.pending_acks.discard(self)
+        self._send(packet.type, packet.seq_nr, packet.payload)
+
+    def can_send(self, size):
+        window = min(self.cwnd, self.peer_wnd)
+        return (self.bytes_in_flight == 0
+                or self.bytes_in_flight + size <= window)
+
+    def flush(self):
+        """Send resends and queued data as far as the windows allow."""
+        if self.state not in (CS_CONNECTED, CS_CLOSING):
+            return
+        for packet in self.unacked.values():
+            if packet.need_resend:
+                if not self.can_send(packet.size):
+                    return
+                self._transmit(packet)
+        while self.write_buffer:
+            size = min(MSS, len(self.write_buffer))
+            if not self.can_send(size):
+                return
+            payload = bytes(self.write_buffer[:size])
+            del self.write_buffer[:size]
+            self.send_packet(ST_DATA, payload)
+        if self.state == CS_CLOSING and self.fin_seq is None:
+            self.fin_seq = self.seq_nr
+            self.send_packet(ST_FIN, b'')
+
+    # ===== Receiving
+
+    def handle_packet(self, pkt):
+        if pkt['type'] == ST_RESET:
+            log.debug('%s: reset' % self)
+            self.handle_lost()
+            return
+        self.handle_timestamps(pkt)
+        self.peer_wnd = pkt['wnd']
+        if self.state == CS_SYN_SENT:
+            if pkt['type'] != ST_STATE:
+                return
+            # The SYN-ACK: their next packet is the one after this seq_nr.
+            self.ack_nr = (pkt['seq_nr'] - 1) & SEQ_MASK
+            self.state = CS_CONNECTED
+            self.handle_ack(pkt)
+            self.peer.handle_connection_made(self)
+            self.flush()
+            return
+        self.handle_ack(pkt)
+        if self.state == CS_CLOSED:
+            return
+        if pkt['type'] in (ST_DATA, ST_FIN):
+            self.handle_data(pkt)
+        if self.state != CS_CLOSED:
+            self.flush()
+
+    def handle_timestamps(self, pkt):
+        self.reply_micro = (timestamp_us() - pkt['ts']) & 0xFFFFFFFF
+        if pkt['ts_diff']:
+            self.update_base_delay(pkt['ts_diff'])
+
+    def handle_ack(self, pkt):
+        ack_nr = pkt['ack_nr']
+        now = time.monotonic()
+        # With few packets out there are too few later ones to wait for
+        # (early retransmit, RFC 5827).
+        threshold = max(1, min(DUP_ACK_LIMIT, len(self.unacked) - 1))
+        acked = []
+        for seq in list(self.unacked):
+            if seq_less(ack_nr, seq):
+                break
+            acked.append(self.unacked.pop(seq))
+        if pkt['sack']:
+            for seq in decode_sack(ack_nr, pkt['sack']):
+                packet = self.unacked.pop(seq, None)
+                if packet:
+                    acked.append(packet)
+
+        if acked:
+            self.dup_acks = 0
+            self.num_timeouts = 0
+            self.last_progress = now
+            bytes_acked = 0
+            for packet in acked:
+                if not packet.need_resend:
+                    self.bytes_in_flight -= packet.size
+                bytes_acked += packet.size
+                if packet.transmissions == 1:
+                    self.update_rtt(now - packet.sent_at)
+                self.last_acked_tx = max(self.last_acked_tx, packet.tx_count)
+                if packet.type == ST_FIN and self.state == CS_CLOSING:
+                    self.close()
+                    return
+            if pkt['ts_diff']:
+                self.update_cwnd(bytes_acked, pkt['ts_diff'])
+        elif (ack_nr == self.last_ack and self.unacked
+                and pkt['type'] == ST_STATE):
+            self.dup_acks += 1
+            if self.dup_acks == DUP_ACK_LIMIT:
+                self.handle_loss(next(iter(self.unacked.values())))
+        self.last_ack = ack_nr
+
+        # A packet is lost once a packet sent threshold transmissions after
+        # it has arrived; this catches lost resends too.
+        for packet in self.unacked.values():
+            if (not packet.need_resend
+                    and packet.tx_count + threshold <= self.last_acked_tx):
+                self.handle_loss(packet)
+
+    def handle_loss(self, packet):
+        log.debug('%s: packet %d lost' % (self, packet.seq_nr))
+        if not packet.need_resend:
+            packet.need_resend = True
+            self.bytes_in_flight -= packet.size
+        if not seq_less(packet.seq_nr, self.recovery_seq):
+            # Halve the window at most once per window of packets.
+            self.cwnd = max(MIN_WINDOW, self.cwnd / 2)
+            self.recovery_seq = self.seq_nr
+
+    def handle_data(self, pkt):
+        seq = pkt['seq_nr']
+        expected = (self.ack_nr + 1) & SEQ_MASK
+        if seq == expected:
+            self.deliver(pkt)
+            while self.state != CS_CLOSED:
+                pkt = self.reorder.pop((self.ack_nr + 1) & SEQ_MASK, None)
+                if pkt is None:
+                    break
+                self.deliver(pkt)
+        elif (seq_less(expected, seq)
+                and ((seq - expected) & SEQ_MASK) < MAX_REORDER):
+            self.reorder.setdefault(seq, pkt)
+        if self.state != CS_CLOSED:
+            self.manager.pending_acks.add(self)
+
+    def deliver(self, pkt):
+        self.ack_nr = pkt['seq_nr']
+        if pkt['type'] == ST_FIN:
+            log.debug('%s: closed by remote' % self)
+            self.send_state()
+            self.handle_lost()
+            return
+        if pkt['payload'] and self.peer and self.state == CS_CONNECTED:
+            self.peer.handle_data_received(pkt['payload'])
+
+    # ===== Congestion control
+
+    def update_base_delay(self, delay):
+        minute = int(time.monotonic() // 60)
+        if self.base_delays and self.base_delays[-1][0] == minute:
+            self.base_delays[-1][1] = min(self.base_delays[-1][1], delay)
+        else:
+            self.base_delays.append([minute, delay])
+            del self.base_delays[:-BASE_HISTORY]
+
+    def update_cwnd(self, bytes_acked, delay):
+        """LEDBAT: grow or shrink the window by how far the queuing delay
+        is from TARGET_DELAY."""
+        base_delay = min(v[1] for v in self.base_delays)
+        queuing_delay = max(0, delay - base_delay)
+        off_target = (TARGET_DELAY - queuing_delay) / TARGET_DELAY
+        self.cwnd += GAIN * off_target * bytes_acked * MSS / self.cwnd
+        self.cwnd = min(MAX_WINDOW, max(MIN_WINDOW, self.cwnd))
+
+    def update_rtt(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.rto = min(MAX_TIMEOUT,
+                       max(MIN_TIMEOUT, self.rtt + 4 * self.rtt_var))
+
+    def check_timeout(self, now):
+        if not self.unacked or now - self.last_progress < self.rto:
+            return
+        self.num_timeouts += 1
+        limit = SYN_RETRIES if self.state == CS_SYN_SENT else MAX_RETRIES
+        if self.num_timeouts > limit:
+            log.debug('%s: timed out' % self)
+            if self.state == CS_SYN_SENT:
+                self.close()
+                self.peer.handle_connection_failed()
+            else:
+                self.handle_lost()
+            return
+        # Everything outstanding is presumed lost; start over from one
+        # packet and back off the timer.
+        for packet in self.unacked.values():
+            packet.need_resend = True
+        self.bytes_in_flight = 0
+        self.cwnd = MIN_WINDOW
+        self.rto = min(MAX_TIMEOUT, self.rto * 2)
+        self.last_progress = now
+        if self.state == CS_SYN_SENT:
+            self._transmit(next(iter(self.unacked.values())))
+        else:
+            self.flush()
+
+    # ===== Teardown
+
+    def close(self):
+        self.state = CS_CLOSED
+        self.manager.remove(self)
+
+    def handle_lost(self):
+        """The connection is gone: tell the peer, unless we closed it."""
+        state = self.state
+        peer = self.peer
+        self.close()
+        if not peer:
+            return
+        if state == CS_SYN_SENT:
+            # Reset before the handshake completed: the dial failed.
+            peer.handle_connection_failed()
+        elif state == CS_CONNECTED:
+            peer.handle_connection_lost()
+
+
+class UTPOutPacket():
+    def __init__(self, ptype, seq_nr, payload):
+        self.type = ptype
+        self.seq_nr = seq_nr
+        self.payload = payload
+        self.size = len(payload) + HEADER.size
+        self.sent_at = None
+        self.transmissions = 0
+        self.tx_count = 0
+        self.need_resend = False
+
+
+class UTPPacketError(Exception):
+    pass
@@ -0,0 +1,313 @@
+"""HTTP web seeds (BEP 19).
+
+A web seed is an HTTP server holding the torrent's files under the URLs in
+the metainfo's url-list. Each is treated as a peer that has every piece: a
+WebSeedPeer picks pieces with the normal piece picker, fetches each whole
+piece with Range requests (one per file the piece spans), and hands the data
+to the torrent in blocks, so it is verified like any other peer's.
+
+The blocking HTTP requests run on a WebSeedPool's threads over keep-alive
+connections pooled per host. Results are handed back to the event loop
+through a socketpair watched with add_reader, so peer and torrent state is
+only touched from the loop.
+"""
+import time
+import queue
+import socket
+import logging
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from qqbt.config import CONFIG
+from qqbt.peer import TorrentPeer, PeerNoUnrequestedPiecesError
+
+log = logging.getLogger(__name__)
+
+MAX_RETRY_INTERVAL = 300    # seconds, backoff cap after failed requests
+
+
+def get_file_url(url, metainfo, file_index):
+    """Map a file of the torrent onto a web seed URL, per BEP 19.
+
+    For a single file torrent the URL names the file itself, unless it ends
+    in '/', in which case the torrent's name is appended. For a multi-file
+    torrent it is the directory holding the torrent's top-level directory.
+    """
+    if metainfo.info['files'] is None:
+        if url.endswith('/'):
+            url += urllib.parse.quote(metainfo.name)
+        return url
+    if not url.endswith('/'):
+        url += '/'
+    path = metainfo.info['files'][file_index]['path']
+    segments = [metainfo.name] + path.replace('\\', '/').split('/')
+    return url + '/'.join(urllib.parse.quote(s) for s in segments)
+
+
+class WebSeedPool():
+    """Runs web seed requests on threads over pooled keep-alive connections.
+    """
+    def __init__(self, conn_man, max_workers=None, timeout=None):
+        """
+        Args:
+            conn_man (ConnectionManager): event loop to deliver results on
+            max_workers (int): threads, i.e. requests in flight at once
+            timeout (float): socket timeout for HTTP requests; defaults to
+                CONFIG['request_timeout']
+        """
+        self.conn_man = conn_man
+        self.timeout = timeout or CONFIG['request_timeout']
+        self.executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='webseed')
+        self.idle_conns = {}    # (scheme, netloc) -> [HTTPConnection]
+        self.lock = threading.Lock()
+        self.results = queue.Queue()
+        (self.wake_recv, self.wake_send) = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.conn_man.add_reader(self.wake_recv, self.handle_results)
+        self.is_closed = False
+
+    def fetch(self, ranges, callback):
+        """Fetch byte ranges and call callback(data, error) from the loop.
+
+        Args:
+            ranges (list): (url, offset, length) tuples; the data is their
+                contents joined together
+            callback (function): called with (data, None) on success or
+                (None, exception) on failure
+        """
+        self.executor.submit(self._run_fetch, ranges, callback)
+
+    def _run_fetch(self, ranges, callback):
+        try:
+            data = b''.join(self.get_range(url, offset, length)
+                            for (url, offset, length) in ranges)
+            result = (callback, data, None)
+        except (OSError, http.client.HTTPException, WebSeedError) as e:
+            result = (callback, None, e)
+        self.results.put(result)
+        try:
+            self.wake_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Already woken, or closed.
+            pass
+
+    def handle_results(self):
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                (callback, data, error) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if not self.is_closed:
+                callback(data, error)
+
+    def get_range(self, url, offset, length):
+        """Read length bytes at offset of url. Runs on a pool thread."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+
+        conn = self._get_conn(key)
+        is_reused = conn is not None
+        while True:
+            if conn is None:
+                conn = self._new_conn(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                if not is_reused:
+                    raise
+                # A pooled connection the server had already closed.
+                conn = None
+                is_reused = False
+            except BaseException:
+                conn.close()
+                raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+        if resp.status == 200 and offset == 0 and len(data) >= length:
+            # Server ignored the Range header.
+            data = data[:length]
+        elif resp.status != 206:
+            raise WebSeedError('%s: HTTP %d %s' % (url, resp.status,
+                                                    resp.reason))
+        if len(data) != length:
+            raise WebSeedError('%s: got %d bytes at %d, expected %d'
+                               % (url, len(data), offset, length))
+        return data
+
+    def _new_conn(self, key):
+        (scheme, netloc) = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get_conn(self, key):
+        with self.lock:
+            conns = self.idle_conns.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def _put_conn(self, key, conn):
+        with self.lock:
+            if not self.is_closed:
+                self.idle_conns.setdefault(key, []).append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            self.is_closed = True
+            conns = [c for v in self.idle_conns.values() for c in v]
+            self.idle_conns = {}
+        for conn in conns:
+            conn.close()
+        self.conn_man.remove_reader(self.wake_recv)
+        self.executor.shutdown(wait=False)
+        self.wake_recv.close()
+        self.wake_send.close()
+
+
+class WebSeedConnection():
+    """Stands in for a peer connection; a web seed has no socket of its own.
+    """
+    def write(self, data):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class WebSeedPeer(TorrentPeer):
+    """A web seed, downloaded from like a peer that has every piece."""
+    def __init__(self, torrent, url, pool):
+        """
+        Args:
+            torrent (Torrent): torrent to download
+            url (str): web seed URL from the metainfo's url-list
+            pool (WebSeedPool): pool to run the HTTP requests on
+        """
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        TorrentPeer.__init__(self, torrent, parts.hostname, port)
+        self.url = url
+        self.pool = pool
+        self.use_utp = False
+        self.retry_timer = None
+        self.num_failures = 0
+
+    def __repr__(self):
+        return 'WebSeedPeer(url=%s)' % self.url
+
+    def connect(self):
+        """Start fetching pieces; there is no connection to open."""
+        if self.conn or self.ip in self.torrent.banned_ips:
+            return
+        self.conn = WebSeedConnection()
+        self.is_started = True
+        self.has_all = True
+        self.peer_choking = False
+        now = time.monotonic()
+        self.last_receive = self.connected_at = self.last_rate_update = now
+        log.info('%s: started' % self)
+        self.run_download()
+
+    def is_dial_candidate(self):
+        return False
+
+    def run_download(self):
+        if self.conn is None or self.requested_piece is not None:
+            return
+        if self.ip in self.torrent.banned_ips:
+            self.disconnect()
+            return
+        if self.is_held_back():
+            return
+        try:
+            piece = self._choose_next_piece()
+        except PeerNoUnrequestedPiecesError:
+            # Look again later, e.g. once a failed piece is released.
+            self.schedule_retry(CONFIG['connect_interval'])
+            return
+        self.requested_piece = piece
+        self.torrent.piece_requests[piece].append(self)
+        self.pool.fetch(self.get_piece_ranges(piece),
+                        lambda data, error: self.handle_fetch(piece, data,
+                                                              error))
+
+    def request_next_block(self, piece_index, begin):
+        # Pieces are fetched whole.
+        pass
+
+    def get_piece_ranges(self, piece_index):
+        """Return the (url, offset, length) ranges holding a piece."""
+        metainfo = self.torrent.metainfo
+        return [(get_file_url(self.url, metainfo, f), offset, length)
+                for (f, offset, length)
+                in metainfo.get_piece_file_spans(piece_index)]
+
+    def handle_fetch(self, piece_index, data, error):
+        if self.conn is None or self.requested_piece != piece_index:
+            # Stopped, or the piece was finished elsewhere meanwhile.
+            return
+        if error:
+            self.num_failures += 1
+            delay = min(CONFIG['connect_interval']
+                        * 2 ** (self.num_failures - 1), MAX_RETRY_INTERVAL)
+            log.warning('%s: piece %d failed: %s; retrying in %ds'
+                        % (self, piece_index, error, delay))
+            self.torrent.release_piece(self, piece_index)
+            self.schedule_retry(delay)
+            return
+
+        self.num_failures = 0
+        now = time.monotonic()
+        self.last_receive = now
+        block_length = CONFIG['block_length']
+        for begin in range(0, len(data), block_length):
+            if self.requested_piece != piece_index:
+                # Completed (or failed) with the previous block.
+                break
+            self.torrent.handle_block(self, piece_index, begin,
+                                      data[begin:begin+block_length])
+        self.update_rate(now)
+
+    def schedule_retry(self, delay):
+        if self.retry_timer:
+            self.retry_timer.cancel()
+        self.retry_timer = self.torrent.conn_man.call_later(
+            delay, self.handle_retry)
+
+    def handle_retry(self):
+        self.retry_timer = None
+        self.run_download()
+
+    def stop_timers(self):
+        TorrentPeer.stop_timers(self)
+        if self.retry_timer:
+            self.retry_timer.cancel()
+            self.retry_timer = None
+
+
+class WebSeedError(Exception):
+    pass
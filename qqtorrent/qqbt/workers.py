@@ -0,0 +1,268 @@
+"""Sharding of torrents across worker processes.
+
+Each worker process runs its own QqbtClient with its own event loop, so
+hashing and protocol handling for different torrents run on different cores.
+The parent assigns torrents to workers and relays progress and completion
+from each worker back to its own client callbacks over a pipe.
+
+Messages are tuples whose first item is the message type:
+    parent -> worker: ('add', filename, info_hash), ('pause', info_hash),
+                      ('resume', info_hash), ('remove', info_hash), ('stop',)
+    worker -> parent: ('progress', info_hash, piece_index, num_complete),
+                      ('completed', info_hash), ('error', info_hash, msg)
+"""
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+
+from qqbt.client import QqbtClient
+from qqbt.torrent import format_progress
+from qqbt.timers import TimerQueue
+
+log = logging.getLogger(__name__)
+
+
+class WorkerPool():
+    """Worker processes that torrents are assigned to."""
+    def __init__(self, num_workers, client, **client_kwargs):
+        """
+        Args:
+            num_workers (int): number of worker processes
+            client (QqbtClient): parent client receiving relayed callbacks
+            client_kwargs: arguments for each worker's QqbtClient
+        """
+        self.client = client
+        self.client_kwargs = client_kwargs
+        self.workers = [WorkerProcess(i) for i in range(num_workers)]
+        self.torrents = {}      # info_hash -> ShardedTorrent
+        self.readers = {}       # fileobj -> callback
+        self.timers = TimerQueue()
+        self.is_started = False
+
+    def start(self):
+        for worker in self.workers:
+            worker.start(self.client_kwargs)
+        self.is_started = True
+
+    def add_torrent(self, filename, metainfo):
+        if not self.is_started:
+            self.start()
+        worker = self._choose_worker(metainfo.info_hash)
+        torrent = ShardedTorrent(metainfo, worker)
+        self.torrents[metainfo.info_hash] = torrent
+        worker.torrents.add(torrent)
+        worker.send('add', filename, metainfo.info_hash)
+        log.info('%s: assigned to worker %d' % (torrent, worker.index))
+        return torrent
+
+    def send_command(self, torrent, command, *args):
+        """Send a 'pause', 'resume', 'remove' or 'file_priority' command."""
+        torrent.worker.send(command, torrent.metainfo.info_hash, *args)
+        if command == 'resume':
+            # Back on its worker if it had failed there.
+            torrent.worker.torrents.add(torrent)
+        elif command == 'remove':
+            torrent.worker.torrents.discard(torrent)
+            del self.torrents[torrent.metainfo.info_hash]
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() from run() whenever fileobj is readable."""
+        self.readers[fileobj] = callback
+
+    def remove_reader(self, fileobj):
+        del self.readers[fileobj]
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) from run() after delay seconds."""
+        return self.timers.call_later(delay, callback, *args)
+
+    def _choose_worker(self, info_hash):
+        """Pick the info hash's home worker unless it is busier than others."""
+        preferred = self.workers[
+            int.from_bytes(info_hash[:4], 'big') % len(self.workers)]
+        least_loaded = min(self.workers, key=lambda w: w.load())
+        if preferred.load() > least_loaded.load() + 1:
+            return least_loaded
+        return preferred
+
+    def run(self):
+        """Relay worker messages to the client until the pool is stopped."""
+        if not self.is_started:
+            self.start()
+        while self.is_started:
+            conns = [w.conn for w in self.workers if w.conn]
+            if not conns:
+                break
+            ready = wait(conns + list(self.readers),
+                         self.timers.next_timeout())
+            self.timers.run_expired()
+            for conn in ready:
+                if not self.is_started:
+                    break
+                if conn in self.readers:
+                    self.readers[conn]()
+                    continue
+                worker = next(w for w in self.workers if w.conn is conn)
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    self.handle_worker_died(worker)
+                    continue
+                self.handle_message(worker, msg)
+
+    def handle_message(self, worker, msg):
+        msg_type = msg[0]
+        torrent = self.torrents.get(msg[1])
+        if torrent is None:
+            log.warning('Message for unknown torrent: %s' % (msg,))
+            return
+        if msg_type == 'progress':
+            (_, _, piece_index, torrent.num_complete) = msg
+            self.client.on_completed_piece(torrent, piece_index)
+        elif msg_type == 'completed':
+            torrent.is_complete = True
+            worker.torrents.discard(torrent)
+            self.client.on_completed_torrent(torrent, None)
+        elif msg_type == 'error':
+            log.error('%s: failed in worker %d: %s'
+                      % (torrent, worker.index, msg[2]))
+            worker.torrents.discard(torrent)
+            self.client.on_failed_torrent(torrent)
+        else:
+            log.warning('Unrecognized worker message: %s' % (msg,))
+
+    def handle_worker_died(self, worker):
+        log.error('Worker %d exited unexpectedly' % worker.index)
+        worker.conn = None
+        for torrent in list(worker.torrents):
+            worker.torrents.discard(torrent)
+            self.client.on_failed_torrent(torrent)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.is_started = False
+
+
+class WorkerProcess():
+    """Parent side of one worker process."""
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.torrents = set()
+
+    def load(self):
+        return len(self.torrents)
+
+    def start(self, client_kwargs):
+        client_kwargs = dict(client_kwargs)
+        if client_kwargs.get('listen_port'):
+            client_kwargs['listen_port'] += 1 + self.index
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_worker, args=(child_conn, client_kwargs),
+            name='qqbt-worker-%d' % self.index, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send(self, *msg):
+        self.conn.send(msg)
+
+    def stop(self):
+        if self.conn:
+            try:
+                self.send('stop')
+            except (BrokenPipeError, EOFError):
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process:
+            self.process.join()
+            self.process = None
+
+
+class ShardedTorrent():
+    """Parent-side stand-in for a torrent running in a worker."""
+    def __init__(self, metainfo, worker):
+        self.metainfo = metainfo
+        self.worker = worker
+        self.storage = None
+        self.is_complete = False
+        self.is_paused = False
+        self.num_complete = 0
+
+    def __repr__(self):
+        return 'ShardedTorrent(%s)' % self.metainfo.name
+
+    def get_num_complete(self):
+        return self.num_complete
+
+    def get_progress_string(self):
+        return format_progress(self.num_complete,
+                               len(self.metainfo.info['pieces']))
+
+
+class WorkerClient(QqbtClient):
+    """Client running in a worker process, controlled over a pipe."""
+    def __init__(self, conn, **client_kwargs):
+        QqbtClient.__init__(self, **client_kwargs)
+        if self.metainfo_cache:
+            # The parent parses each torrent first and writes its entry;
+            # workers sharing the directory only read it.
+            self.metainfo_cache.read_only = True
+        self.conn = conn
+        self.keep_running = True
+        self.conn_man.add_reader(conn, self.handle_control)
+
+    def run(self):
+        self.conn_man.start_event_loop()
+
+    def handle_control(self):
+        while self.conn.poll():
+            try:
+                msg = self.conn.recv()
+            except EOFError:
+                msg = ('stop',)
+            if msg[0] == 'add':
+                self.handle_add(msg[1], msg[2])
+            elif msg[0] in ('pause', 'resume', 'remove'):
+                torrent = self.find_torrent(msg[1])
+                if torrent:
+                    getattr(self, msg[0] + '_torrent')(torrent)
+            elif msg[0] == 'file_priority':
+                torrent = self.find_torrent(msg[1])
+                if torrent:
+                    self.set_file_priority(torrent, msg[2], msg[3])
+            elif msg[0] == 'stop':
+                self.conn_man.remove_reader(self.conn)
+                self.stop()
+                return
+
+    def handle_add(self, filename, info_hash):
+        try:
+            torrent = self.add_torrent(filename)
+            self.start_torrent(torrent)
+        except Exception as e:
+            log.exception('handle_add: %s' % filename)
+            self.conn.send(('error', info_hash, str(e)))
+
+    def on_completed_piece(self, torrent, piece_index):
+        QqbtClient.on_completed_piece(self, torrent, piece_index)
+        num_complete = torrent.get_num_complete()
+        self.conn.send(('progress', torrent.metainfo.info_hash, piece_index,
+                        num_complete))
+
+    def on_completed_torrent(self, torrent, data):
+        QqbtClient.on_completed_torrent(self, torrent, data)
+        self.conn.send(('completed', torrent.metainfo.info_hash))
+
+    def on_failed_torrent(self, torrent):
+        QqbtClient.on_failed_torrent(self, torrent)
+        self.conn.send(('error', torrent.metainfo.info_hash,
+                        'failed to start'))
+
+
+def run_worker(conn, client_kwargs):
+    """Worker process entry point."""
+    WorkerClient(conn, **client_kwargs).run()
@@ -0,0 +1,36 @@
+from nose.tools import *
+
+from benchmarks import (BENCHMARKS, load_benchmarks, time_benchmark,
+                        compare_results)
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def test_benchmarks_run():
+    load_benchmarks()
+    for name in ('peer.build_message', 'torrent.assemble_piece',
+                 'tracker.decode_binary_peers'):
+        result = time_benchmark(BENCHMARKS[name], min_time=0, rounds=1)
+        assert_greater(result['ops_per_sec'], 0)
+
+
+def _doc(**seconds):
+    return {'results': {name.replace('_', '.'): {'seconds': v, 'ops': 1}
+                        for (name, v) in seconds.items()}}
+
+
+def test_compare_against_baseline():
+    baseline = _doc(a_x=1.0, a_y=1.0, a_z=1.0)
+    baseline['thresholds'] = {'a.y': 1.0}
+    doc = _doc(a_x=1.2, a_y=1.8, a_z=1.5, a_new=9.0)
+    comparison = compare_results(doc, baseline, threshold=0.25,
+                                 thresholds={'a.z': 0.1})
+    assert_equal([(name, is_regression)
+                  for (name, ratio, allowed, is_regression) in comparison],
+                 [('a.x', False), ('a.y', False), ('a.z', True)])
@@ -0,0 +1,131 @@
+import struct
+import hashlib
+from nose.tools import *
+
+from qqbt.budget import MemoryBudget
+from qqbt.torrent import Torrent
+from qqbt.peer import TorrentPeer
+from tests.mocks import (MetainfoMock, ConnectionManagerMock, ConnMock,
+                         message)
+
+PIECE = b'\x00' * 2**15
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _metainfo():
+    return MetainfoMock(2, [hashlib.sha1(PIECE).digest()] * 2)
+
+
+def test_requests_held_back_while_budget_full():
+    conn_man = ConnectionManagerMock()
+    budget = MemoryBudget(conn_man, max_bytes=len(PIECE))
+    unflushed = [len(PIECE)]
+    budget.add_source(lambda: unflushed[0])
+    t = Torrent(conn_man, _metainfo(), budget=budget)
+    t.is_running = True
+
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': 6881})
+    peer.conn = ConnMock()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        t.metainfo.info_hash, b'-XX0000-000000000000'))
+    peer.handle_data_received(message(5, b'\xc0') + message(1))
+    assert_is_none(peer.requested_piece)
+    assert_equal(budget.waiters, [peer.handle_budget_available])
+
+    # Still above the resume mark: keep waiting.
+    unflushed[0] = len(PIECE) - 1
+    conn_man.timers[-1].callback()
+    assert_is_none(peer.requested_piece)
+
+    unflushed[0] = 0
+    conn_man.timers[-1].callback()
+    assert_equal(peer.requested_piece, 0)
+    assert_equal(budget.waiters, [])
+
+    block = struct.pack('!LL', 0, 0) + PIECE[:2**14]
+    peer.handle_data_received(message(7, block))
+    assert_equal(budget.get_used_bytes(), 2**14)
+    block = struct.pack('!LL', 0, 2**14) + PIECE[2**14:]
+    peer.handle_data_received(message(7, block))
+    # The verified piece is no longer held as blocks.
+    assert_equal(budget.get_used_bytes(), 0)
+    assert_equal(peer.requested_piece, 1)
+
+
+def _start_peer(t, port):
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': port})
+    peer.conn = ConnMock()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        t.metainfo.info_hash, b'-XX0000-000000000000'))
+    peer.handle_data_received(message(5, b'\xc0') + message(1))
+    return peer
+
+
+def test_abandoned_partial_piece_finished_while_budget_full():
+    conn_man = ConnectionManagerMock()
+    budget = MemoryBudget(conn_man, max_bytes=2**14)
+    t = Torrent(conn_man, _metainfo(), budget=budget)
+    t.is_running = True
+
+    a = _start_peer(t, 1)
+    assert_equal(a.requested_piece, 0)
+    block = struct.pack('!LL', 0, 0) + PIECE[:2**14]
+    a.handle_data_received(message(7, block))
+    assert_true(budget.is_full())
+    # The peer goes away, leaving its half piece charged to the budget.
+    a.handle_connection_lost()
+
+    b = _start_peer(t, 2)
+    assert_equal(b.requested_piece, 0)
+    block = struct.pack('!LL', 0, 2**14) + PIECE[2**14:]
+    b.handle_data_received(message(7, block))
+    assert_true(t.complete_pieces[0])
+    assert_equal(budget.get_used_bytes(), 0)
+
+
+def test_stopped_torrent_not_charged():
+    conn_man = ConnectionManagerMock()
+    budget = MemoryBudget(conn_man, max_bytes=2**14)
+    t = Torrent(conn_man, _metainfo(), budget=budget)
+    t.is_running = True
+
+    a = _start_peer(t, 1)
+    block = struct.pack('!LL', 0, 0) + PIECE[:2**14]
+    a.handle_data_received(message(7, block))
+    assert_equal(budget.get_used_bytes(), 2**14)
+    t.stop_torrent()
+    assert_equal(budget.get_used_bytes(), 0)
+    # Blocks kept while stopped are released without touching the budget.
+    t.discard_partial_pieces()
+    assert_equal((t.held_bytes, budget.get_used_bytes()), (0, 0))
+
+
+def test_requests_held_back_while_limit_reached():
+    conn_man = ConnectionManagerMock()
+    budget = MemoryBudget(conn_man, max_bytes=2**20)
+    dirty = [len(PIECE)]
+    budget.add_limit(lambda: dirty[0], len(PIECE))
+    t = Torrent(conn_man, _metainfo(), budget=budget)
+    t.is_running = True
+    assert_true(budget.is_full())
+
+    peer = _start_peer(t, 6881)
+    assert_is_none(peer.requested_piece)
+    assert_equal(budget.waiters, [peer.handle_budget_available])
+
+    # Below the limit but above its resume mark: keep waiting.
+    dirty[0] = len(PIECE) - 1
+    assert_false(budget.is_full())
+    conn_man.timers[-1].callback()
+    assert_is_none(peer.requested_piece)
+
+    dirty[0] = 0
+    conn_man.timers[-1].callback()
+    assert_equal(peer.requested_piece, 0)
@@ -0,0 +1,84 @@
+import os
+import socket
+import hashlib
+import tempfile
+import threading
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.client import QqbtClient
+from qqbt.peer import TorrentPeer
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _write_torrent(dirname, name):
+    data = name.encode('utf-8') * 100
+    path = os.path.join(dirname, name + '.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencode.encode({
+            'announce': 'http://tracker.example.com/announce',
+            'info': {
+                'name': name,
+                'length': len(data),
+                'piece length': 2**14,
+                'pieces': hashlib.sha1(data).digest()
+            }
+        }))
+    return path
+
+
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_inbound_connection_routed_by_info_hash():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = QqbtClient(outdir=tmpdir, listen_port=0)
+        client.keep_running = True
+        t1 = client.add_torrent(_write_torrent(tmpdir, 'aaa'))
+        t2 = client.add_torrent(_write_torrent(tmpdir, 'bbb'))
+        # Running without announcing to the (fake) tracker.
+        t1.is_running = t2.is_running = True
+        port = client.conn_man.listen_port
+        (stop_r, stop_w) = socket.socketpair()
+        client.conn_man.add_reader(stop_r, client.stop)
+        thread = threading.Thread(target=client.conn_man.start_event_loop)
+        thread.start()
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            sock.sendall(TorrentPeer.build_handshake(
+                t2.metainfo.info_hash, b'-XX0000-000000000000'))
+            reply = _recv_exactly(sock, 68)
+            assert_equal(TorrentPeer.decode_handshake(19, reply[1:])
+                         ['info_hash'], t2.metainfo.info_hash)
+            assert_equal(len(t1.peers), 0)
+            assert_equal(len(t2.peers), 1)
+            assert_true(t2.peers[0].is_inbound)
+            assert_true(t2.peers[0].is_started)
+            assert_equal(t2.get_num_active_peers(), 1)
+            sock.close()
+
+            # Unknown info hashes are dropped.
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            sock.sendall(TorrentPeer.build_handshake(
+                b'\xff' * 20, b'-XX0000-000000000000'))
+            assert_equal(sock.recv(68), b'')
+            sock.close()
+        finally:
+            stop_w.send(b'x')
+            thread.join(5.0)
+            stop_r.close()
+            stop_w.close()
@@ -0,0 +1,146 @@
+import os
+import socket
+import tempfile
+import threading
+from nose.tools import *
+
+from qqbt.client import QqbtClient
+from qqbt.tracker import AnnounceFailureError
+from qqbt.daemon import (
+    ControlServer, ControlClient, encode_frame, decode_frames,
+    ControlProtocolError)
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def test_control_frames():
+    data = encode_frame({'cmd': 'status'}) + encode_frame({'cmd': 'x'})
+    (msgs, rest) = decode_frames(data[:-2])
+    assert_equal(msgs, [{b'cmd': b'status'}])
+    assert_equal(rest, data[len(encode_frame({'cmd': 'status'})):-2])
+    (msgs, rest) = decode_frames(rest + data[-2:])
+    assert_equal(msgs, [{b'cmd': b'x'}])
+    assert_equal(rest, b'')
+    assert_raises(ControlProtocolError, decode_frames, b'\x00\x00\x00\x01l')
+    assert_raises(ControlProtocolError, decode_frames,
+                  b'\x00\x00\x00\x03i1e')
+
+
+def test_daemon_control_socket():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'ctl.sock')
+        client = QqbtClient(outdir=tmpdir, listen_port=0)
+        client.keep_running = True
+        ControlServer(client, path)
+        thread = threading.Thread(target=client.start_torrents)
+        thread.start()
+
+        ctl = ControlClient(path)
+        resp = ctl.request('status')
+        assert_equal(resp, {b'ok': 1, b'torrents': []})
+
+        resp = ctl.request('add', path=os.path.join(tmpdir, 'missing'))
+        assert_equal(resp[b'ok'], 0)
+        resp = ctl.request('pause', info_hash='00' * 20)
+        assert_equal(resp, {b'ok': 0, b'error': b'No such torrent'})
+        resp = ctl.request('bogus')
+        assert_equal(resp[b'ok'], 0)
+
+        resp = ctl.request('shutdown')
+        assert_equal(resp, {b'ok': 1})
+        ctl.close()
+        thread.join(5.0)
+        assert_false(thread.is_alive())
+        assert_false(os.path.exists(path))
+
+
+def test_add_same_torrent_twice():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = QqbtClient(outdir=tmpdir, listen_port=0)
+        filename = '../shared/flagfromserver.torrent'
+        torrent = client.add_torrent(filename)
+        assert_is(client.add_torrent(filename), torrent)
+        assert_equal(client.active_torrents, [torrent])
+        client.stop()
+
+
+def test_failed_torrent_listed_and_resumed():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = QqbtClient(outdir=tmpdir, listen_port=0)
+        client.keep_running = True
+        # Don't start torrents for real.
+        client.scheduler.reschedule = lambda: None
+        server = ControlServer(client, os.path.join(tmpdir, 'ctl.sock'))
+        filename = '../shared/flagfromserver.torrent'
+        torrent = client.add_torrent(filename)
+        client.scheduler.handle_start_failure(
+            torrent, AnnounceFailureError('unregistered torrent'))
+        assert_equal(client.failed_torrents, [torrent])
+        assert_equal(server._torrent_status(torrent)['state'], 'failed')
+        assert_is(client.add_torrent(filename), torrent)
+
+        client.resume_torrent(torrent)
+        assert_equal(client.active_torrents, [torrent])
+        assert_equal(server._torrent_status(torrent)['state'], 'queued')
+        server.close()
+        client.stop()
+
+
+class ClientMock():
+    def __init__(self):
+        self.readers = {}
+        self.timers = []
+
+    def add_reader(self, fileobj, callback):
+        self.readers[fileobj] = callback
+
+    def remove_reader(self, fileobj):
+        del self.readers[fileobj]
+
+    def call_later(self, delay, callback, *args):
+        timer = TimerMock(callback, *args)
+        self.timers.append(timer)
+        return timer
+
+
+class TimerMock():
+    def __init__(self, callback, *args):
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        pass
+
+    def fire(self):
+        self.callback(*self.args)
+
+
+def test_slow_reader_does_not_block():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        client = ClientMock()
+        server = ControlServer(client, os.path.join(tmpdir, 'ctl.sock'))
+        (conn, other) = socket.socketpair()
+        conn.setblocking(False)
+        server.conns[conn] = b''
+        client.add_reader(conn, lambda: server.handle_read(conn))
+        data = os.urandom(4 * 2**20)
+
+        # More than the socket buffer holds: the rest waits in memory.
+        server.send(conn, data)
+        assert_true(server.pending[conn])
+        received = b''
+        while client.timers:
+            received += other.recv(2**20)
+            client.timers.pop(0).fire()
+        while len(received) < len(data):
+            received += other.recv(2**20)
+        assert_equal(received, data)
+        assert_equal(server.pending[conn], b'')
+        server.close()
+        other.close()
@@ -0,0 +1,170 @@
+import os
+import time
+import socket
+import tempfile
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.conn import ConnectionManagerSelect
+from qqbt.dht import (DHTNode, DHTContact, DHTLookup, RoutingTable, K,
+                      encode_compact_nodes, decode_compact_nodes)
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _run_until(conn_man, cond, timeout=5.0):
+    """Serve the DHT sockets until cond() holds."""
+    deadline = time.monotonic() + timeout
+    while not cond() and time.monotonic() < deadline:
+        for key, mask in conn_man.sel.select(0.05):
+            key.data(key.fileobj, mask)
+    return cond()
+
+
+def _make_network(conn_man, num_nodes):
+    nodes = [DHTNode(conn_man, bind_ip='127.0.0.1') for _ in range(num_nodes)]
+    seed = ('127.0.0.1', nodes[0].port)
+    for node in nodes[1:]:
+        lookup = node.bootstrap([seed])
+        assert_true(_run_until(conn_man, lambda: lookup.is_done))
+    return nodes
+
+
+def test_compact_nodes_roundtrip():
+    contacts = [DHTContact(bytes([i]) * 20, '10.0.0.%d' % i, 6881 + i)
+                for i in range(1, 4)]
+    decoded = decode_compact_nodes(encode_compact_nodes(contacts))
+    assert_equal([(c.node_id, c.ip, c.port) for c in decoded],
+                 [(c.node_id, c.ip, c.port) for c in contacts])
+
+
+def test_routing_table_bucket_limit():
+    table = RoutingTable(b'\x00' * 20)
+    # All of these share the top bit so they land in one bucket.
+    contacts = [DHTContact(b'\x80' + os.urandom(19), '10.0.0.1', 1000 + i)
+                for i in range(K + 4)]
+    for c in contacts:
+        table.add(c)
+    assert_equal(len(table), K)
+
+    # A stale node gets replaced.
+    contacts[0].failures = 5
+    table.add(contacts[K])
+    assert_equal(len(table), K)
+    assert_is_none(table.find(contacts[0].node_id))
+    assert_is_not_none(table.find(contacts[K].node_id))
+
+
+def test_malformed_query_gets_protocol_error():
+    conn_man = ConnectionManagerSelect()
+    node = DHTNode(conn_man, bind_ip='127.0.0.1')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5.0)
+    try:
+        for args in [{'id': 5}, {'id': [b'x']}, 5]:
+            node.handle_datagram(bencode.encode(
+                {'t': 'aa', 'y': 'q', 'q': 'ping', 'a': args}),
+                sock.getsockname())
+            (data, _) = sock.recvfrom(65536)
+            msg = bencode.decode(data)
+            assert_equal(msg[b'y'], b'e')
+            assert_equal(msg[b'e'][0], 203)
+        assert_equal(len(node.routing_table), 0)
+    finally:
+        sock.close()
+        node.close()
+
+
+def test_malformed_response_ignored():
+    conn_man = ConnectionManagerSelect()
+    node = DHTNode(conn_man, bind_ip='127.0.0.1')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5.0)
+    try:
+        found = []
+        lookup = DHTLookup(node, os.urandom(20), 'get_peers',
+                           on_peers=found.extend)
+        lookup.add_candidate(DHTContact(None, *sock.getsockname()))
+        lookup.start()
+        (data, addr) = sock.recvfrom(65536)
+        tid = bencode.decode(data)[b't']
+        node.handle_datagram(bencode.encode(
+            {'t': tid, 'y': 'r',
+             'r': {'id': b'\x22' * 20, 'nodes': 5, 'values': 5,
+                   'token': 5}}),
+            sock.getsockname())
+        assert_true(lookup.is_done)
+        assert_equal(found, [])
+        assert_equal(lookup.responded[0][1], None)
+
+        # A response whose id isn't a node id fails the query.
+        lookup = DHTLookup(node, os.urandom(20), 'find_node')
+        lookup.add_candidate(DHTContact(None, *sock.getsockname()))
+        lookup.start()
+        (data, addr) = sock.recvfrom(65536)
+        tid = bencode.decode(data)[b't']
+        node.handle_datagram(bencode.encode(
+            {'t': tid, 'y': 'r', 'r': {'id': 5}}), sock.getsockname())
+        assert_true(lookup.is_done)
+        assert_equal(lookup.candidates, [])
+    finally:
+        sock.close()
+        node.close()
+
+
+def test_get_peers_and_announce_on_loopback():
+    conn_man = ConnectionManagerSelect()
+    nodes = _make_network(conn_man, 12)
+    try:
+        for node in nodes[1:]:
+            assert_greater(len(node.routing_table), 0)
+
+        info_hash = os.urandom(20)
+        announced = nodes[3].get_peers(info_hash, lambda peers: None,
+                                       announce_port=51413)
+        assert_true(_run_until(conn_man, lambda: announced.is_done))
+        assert_true(_run_until(conn_man, lambda: any(
+            info_hash in n.peer_store for n in nodes)))
+
+        found = []
+        lookup = nodes[9].get_peers(info_hash, found.extend)
+        assert_true(_run_until(conn_man, lambda: lookup.is_done))
+        assert_in({'ip': '127.0.0.1', 'port': 51413}, found)
+    finally:
+        for node in nodes:
+            node.close()
+
+
+def test_routing_table_persisted():
+    conn_man = ConnectionManagerSelect()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        nodes = _make_network(conn_man, 4)
+        state_path = os.path.join(tmpdir, 'dht.state')
+        node = DHTNode(conn_man, bind_ip='127.0.0.1', state_path=state_path)
+        lookup = node.bootstrap([('127.0.0.1', nodes[0].port)])
+        assert_true(_run_until(conn_man, lambda: lookup.is_done))
+        node_id = node.node_id
+        num_contacts = len(node.routing_table)
+        assert_greater(num_contacts, 0)
+        node.close()
+
+        node = DHTNode(conn_man, bind_ip='127.0.0.1', state_path=state_path)
+        try:
+            assert_equal(node.node_id, node_id)
+            assert_equal(len(node.routing_table), num_contacts)
+            # Bootstraps from the saved table without seed addresses.
+            lookup = node.bootstrap()
+            assert_true(_run_until(conn_man, lambda: lookup.is_done))
+            assert_greater(len(lookup.responded) + len(node.routing_table), 0)
+        finally:
+            node.close()
+            for n in nodes:
+                n.close()
@@ -0,0 +1,45 @@
+import sys
+import subprocess
+from nose.tools import *
+
+from qqbt.conn import get_backend, ConnectionBackendError
+
+
+# Generous bound on the time to import the CLI in a fresh interpreter, to
+# catch heavy dependencies creeping back into module-level imports.
+MAX_IMPORT_SECONDS = 0.5
+
+DEFERRED_MODULES = ['twisted', 'requests', 'voluptuous', 'multiprocessing']
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def test_cli_import_is_lazy():
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import qqbt.cli\n'
+            'print(time.perf_counter() - t)\n'
+            'print(" ".join(m for m in %r if m in sys.modules))\n'
+            % DEFERRED_MODULES)
+    # Best of three runs, to ignore a cold disk cache.
+    times = []
+    for _ in range(3):
+        out = subprocess.check_output([sys.executable, '-c', code])
+        lines = out.decode('utf-8').split('\n')
+        assert_equal(lines[1], '')
+        times.append(float(lines[0]))
+    assert_less(min(times), MAX_IMPORT_SECONDS)
+
+
+def test_get_backend():
+    from qqbt.conn import ConnectionManagerSelect
+    assert_is(get_backend('select'), ConnectionManagerSelect)
+    from qqbt.conn_threads import ConnectionManagerThreaded
+    assert_is(get_backend('threads'), ConnectionManagerThreaded)
+    assert_raises(ConnectionBackendError, get_backend, 'bogus')
@@ -0,0 +1,71 @@
+import random
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+from qqbt.conn import ConnectionManagerSelect
+from qqbt.lsd import (LocalServiceDiscovery, encode_announce, decode_announce,
+                      LSDDecodeError)
+from qqbt.torrent import Torrent
+from tests.mocks import MetainfoMock, ConnectionManagerMock
+
+INFO_HASH = b'\x22' * 20
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def test_announce_roundtrip():
+    info_hashes = [b'\x01' * 20, b'\xab' * 20]
+    data = encode_announce(6881, info_hashes, 'c00k1e')
+    assert_true(data.startswith(b'BT-SEARCH * HTTP/1.1\r\n'
+                                b'Host: 239.192.152.143:6771\r\n'))
+    assert_true(data.endswith(b'\r\n\r\n'))
+    assert_equal(decode_announce(data), (6881, info_hashes, 'c00k1e'))
+    assert_raises(LSDDecodeError, decode_announce, b'GET / HTTP/1.1\r\n\r\n')
+    assert_raises(LSDDecodeError, decode_announce,
+                  b'BT-SEARCH * HTTP/1.1\r\nInfohash: 00\r\n\r\n')
+
+
+def test_local_peers_dialed_first():
+    conn_man = ConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4, info_hash=INFO_HASH))
+    t.is_running = True
+    t.max_peers = 1
+    t.add_peer({'ip': '10.0.0.1', 'port': 1}).best_rate = 100000.0
+    t.add_local_peer('192.168.1.5', 6881)
+    (peer,) = conn_man.dialed
+    assert_equal((peer.ip, peer.port), ('192.168.1.5', 6881))
+    assert_true(peer.is_local)
+
+
+def test_loopback_multicast_discovery():
+    conn_man = ConnectionManagerSelect()
+    port = random.randint(20000, 60000)
+    found = []
+
+    def on_peer(info_hash, ip, peer_port):
+        found.append((info_hash, ip, peer_port))
+        conn_man.stop_event_loop()
+    try:
+        a = LocalServiceDiscovery(conn_man, 7001, on_peer, port=port,
+                                  interface='127.0.0.1')
+        b = LocalServiceDiscovery(conn_man, 7002, on_peer, port=port,
+                                  interface='127.0.0.1')
+    except OSError as e:
+        raise SkipTest('multicast not available: %s' % e)
+
+    a.add(INFO_HASH)
+    timeout = conn_man.call_later(5.0, conn_man.stop_event_loop)
+    conn_man.start_event_loop()
+    timeout.cancel()
+    a.close()
+    b.close()
+    if not found:
+        raise SkipTest('multicast loopback not delivered')
+    # b hears a's announce; a ignores its own.
+    assert_equal(found, [(INFO_HASH, '127.0.0.1', 7001)])
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.metainfo_cache import MetainfoCache
+from qqbt.torrent_metainfo import TorrentMetainfo
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def test_metainfo_cache_roundtrip():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        _check_metainfo_cache_roundtrip(cache_dir)
+
+
+def _check_metainfo_cache_roundtrip(cache_dir):
+    filename = '../shared/amusementsinmath16713gut_archive.torrent'
+    with open(filename, 'rb') as f:
+        ref = TorrentMetainfo(f.read())
+
+    m1 = MetainfoCache(cache_dir).load_metainfo(filename)
+    assert_equal(m1.info_hash, ref.info_hash)
+
+    # A new cache instance loads the mmapped entry instead of parsing.
+    m2 = MetainfoCache(cache_dir).load_metainfo(filename)
+    assert_is_not(m2.info['pieces'], m1.info['pieces'])
+    assert_equal(m2.info_hash, ref.info_hash)
+    assert_equal(m2.announce, ref.announce)
+    assert_equal(m2.name, ref.name)
+    assert_equal(m2.url_list, ref.url_list)
+    assert_equal(m2.info['length'], ref.info['length'])
+    assert_equal(list(m2.info['pieces']), list(ref.info['pieces']))
+    assert_equal(list(m2.info['files']), list(ref.info['files']))
+    assert_equal(list(m2.get_piece_file_index()),
+                 list(ref.get_piece_file_index()))
+
+
+def test_metainfo_cache_invalidated_by_mtime():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        _check_metainfo_cache_invalidated_by_mtime(cache_dir)
+
+
+def _check_metainfo_cache_invalidated_by_mtime(cache_dir):
+    filename = os.path.join(cache_dir, 'flag.torrent')
+    shutil.copy('../shared/flagfromserver.torrent', filename)
+    cache = MetainfoCache(cache_dir)
+    m1 = cache.load_metainfo(filename)
+
+    st = os.stat(filename)
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    m2 = cache.load_metainfo(filename)
+    assert_equal(m2.info_hash, m1.info_hash)
+    # The entry was rebuilt for the new mtime.
+    assert_equal(m2.cache_entry.mtime_ns, st.st_mtime_ns + 10**9)
+    assert_equal(m1.cache_entry.mtime_ns, st.st_mtime_ns)
+
+
+def test_piece_file_spans():
+    filename = '../shared/gd1978-02-03.betty.reel.flac16.torrent'
+    with open(filename, 'rb') as f:
+        m = TorrentMetainfo(f.read())
+    lengths = m.get_file_lengths()
+    covered = [0] * len(lengths)
+    for i in range(len(m.info['pieces'])):
+        spans = m.get_piece_file_spans(i)
+        assert_equal(sum(n for (_, _, n) in spans), m.get_piece_length(i))
+        for (f, ofs, n) in spans:
+            assert_equal(ofs, covered[f])
+            covered[f] += n
+    assert_equal(covered, lengths)
+
+
+def test_metainfo_cache_long_announce():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        _check_metainfo_cache_long_announce(cache_dir)
+
+
+def _check_metainfo_cache_long_announce(cache_dir):
+    announce = b'http://tracker.example/announce?key=' + b'k' * 70000
+    info = {b'name': b'n', b'piece length': 2**14, b'length': 1,
+            b'pieces': b'\x00' * 20}
+    filename = os.path.join(cache_dir, 'long.torrent')
+    with open(filename, 'wb') as f:
+        f.write(bencode.encode({b'announce': announce, b'info': info}))
+    MetainfoCache(cache_dir).load_metainfo(filename)
+    m = MetainfoCache(cache_dir).load_metainfo(filename)
+    assert_is_not_none(m.cache_entry)
+    assert_equal(m.announce, announce.decode())
+
+
+def test_metainfo_cache_shared_between_processes():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        _check_metainfo_cache_shared_between_processes(cache_dir)
+
+
+def _check_metainfo_cache_shared_between_processes(cache_dir):
+    filenames = ['../shared/flagfromserver.torrent',
+                 '../shared/amusementsinmath16713gut_archive.torrent']
+    # Caches opened at the same time, as by a client and its workers.
+    writers = [MetainfoCache(cache_dir), MetainfoCache(cache_dir)]
+    reader = MetainfoCache(cache_dir, read_only=True)
+    entries = set(os.listdir(cache_dir))
+
+    # A read-only cache never writes, even on a miss.
+    m = reader.load_metainfo(filenames[0])
+    assert_is_none(m.cache_entry)
+    assert_equal(set(os.listdir(cache_dir)), entries)
+
+    # Each writer's store keeps the other's entries.
+    for (cache, filename) in zip(writers, filenames):
+        cache.load_metainfo(filename)
+    for filename in filenames:
+        assert_is_not_none(reader.load_metainfo(filename).cache_entry)
+        assert_is_not_none(
+            MetainfoCache(cache_dir).load_metainfo(filename).cache_entry)
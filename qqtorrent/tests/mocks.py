@@ -0,0 +1,90 @@
+"""Mocks shared by the tests of torrents and their peers."""
+import struct
+
+from qqbt import bencode
+from qqbt.peer import MESSAGE_TYPES
+
+
+class MetainfoMock():
+    def __init__(self, num_pieces=1, pieces=None, piece_length=2**15,
+                 info_hash=b'\x11' * 20):
+        self.info_hash = info_hash
+        self.name = info_hash.hex()
+        self.info = {
+            'piece_length': piece_length,
+            'pieces': pieces or [b'\x00' * 20] * num_pieces
+        }
+
+    def get_piece_length(self, piece_index):
+        return self.info['piece_length']
+
+
+class TimerMock():
+    def __init__(self, callback):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ConnectionManagerMock():
+    def __init__(self, listen_port=None):
+        self.listen_port = listen_port
+        self.dialed = []
+        self.timers = []
+
+    def connect_peer(self, peer):
+        self.dialed.append(peer)
+
+    def call_later(self, delay, callback, *args):
+        self.timers.append(TimerMock(callback))
+        return self.timers[-1]
+
+
+class ThreadedConnectionManagerMock(ConnectionManagerMock):
+    """Queues run_in_thread calls in calls, to be run by the test."""
+    def __init__(self, listen_port=None):
+        ConnectionManagerMock.__init__(self, listen_port)
+        self.calls = []
+
+    def run_in_thread(self, callback, func, *args):
+        self.calls.append(lambda: callback(func(*args)))
+
+
+class LoopConnectionManagerMock(ConnectionManagerMock):
+    """Queues call_from_thread calls in calls, to be run by the test as if
+    by the event loop."""
+    def __init__(self, listen_port=None):
+        ConnectionManagerMock.__init__(self, listen_port)
+        self.calls = []
+
+    def call_from_thread(self, callback, *args):
+        self.calls.append(lambda: callback(*args))
+
+
+class ConnMock():
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def disconnect(self):
+        pass
+
+    def sent(self):
+        """Message types and payloads written after the handshake."""
+        return [(MESSAGE_TYPES[data[4]], data[5:]) for data in self.written
+                if len(data) > 4 and data[0] != 19]
+
+    def extended_messages(self):
+        msgs = []
+        for data in self.written:
+            if len(data) > 5 and data[4] == 20:
+                msgs.append((data[5], bencode.decode(data[6:])))
+        return msgs
+
+
+def message(msg_id, payload=b''):
+    return struct.pack('!LB', len(payload) + 1, msg_id) + payload
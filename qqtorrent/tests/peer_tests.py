@@ -0,0 +1,381 @@
+import time
+import struct
+import hashlib
+from nose.tools import *
+
+from qqbt.torrent import Torrent
+from qqbt.peer import TorrentPeer, PeerNoUnrequestedPiecesError
+from qqbt.utp import UTPConnection, ST_RESET
+from tests.mocks import (MetainfoMock, ConnectionManagerMock,
+                         ThreadedConnectionManagerMock, ConnMock, message)
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _connect(torrent, reserved, port=6881):
+    peer = torrent.add_peer({'ip': '10.0.0.1', 'port': port})
+    peer.conn = ConnMock()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        torrent.metainfo.info_hash, b'-XX0000-000000000000', reserved))
+    return peer
+
+
+def test_fast_peer_gets_have_none():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, TorrentPeer.build_reserved())
+    assert_true(peer.supports_fast)
+    assert_equal(peer.conn.sent()[0], ('have_none', b''))
+
+    # Plain peers get no availability message.
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, bytes(8))
+    assert_false(peer.supports_fast)
+    assert_equal([m[0] for m in peer.conn.sent()], ['interested'])
+
+
+def test_have_all_and_have_none():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, TorrentPeer.build_reserved())
+    peer.handle_data_received(message(14))
+    assert_true(peer.has_all)
+    assert_is_none(peer.peer_pieces)
+    assert_true(all(peer.has_piece(i) for i in range(4)))
+
+    peer.handle_data_received(message(15))
+    assert_false(any(peer.has_piece(i) for i in range(4)))
+    assert_is_none(peer.peer_pieces)
+
+    peer.handle_data_received(message(4, struct.pack('!L', 2)))
+    assert_equal([peer.has_piece(i) for i in range(4)],
+                 [False, False, True, False])
+
+
+def test_allowed_fast_while_choked_and_reject():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, TorrentPeer.build_reserved())
+    peer.handle_data_received(message(14))
+    assert_true(peer.peer_choking)
+
+    peer.handle_data_received(message(17, struct.pack('!L', 3)))
+    assert_equal(peer.requested_piece, 3)
+    assert_equal(peer.conn.sent()[-1],
+                 ('request', struct.pack('!LLL', 3, 0, 2**14)))
+
+    # A rejected request frees the piece for other peers.
+    peer.handle_data_received(message(16, struct.pack('!LLL', 3, 0, 2**14)))
+    assert_is_none(peer.requested_piece)
+    assert_equal(t.piece_requests[3], [])
+    assert_in(3, peer.rejected_pieces)
+
+    # Once unchoked, other pieces are requested.
+    peer.handle_data_received(message(1))
+    assert_equal(peer.requested_piece, 0)
+
+
+def test_piece_rejected_on_choke_requested_after_unchoke():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(1))
+    peer = _connect(t, TorrentPeer.build_reserved())
+    peer.handle_data_received(message(14) + message(1))
+    assert_equal(peer.requested_piece, 0)
+
+    peer.handle_data_received(message(0))
+    peer.handle_data_received(message(16, struct.pack('!LLL', 0, 0, 2**14)))
+    assert_is_none(peer.requested_piece)
+
+    peer.handle_data_received(message(1))
+    assert_equal(peer.requested_piece, 0)
+    assert_equal(peer.conn.sent()[-1],
+                 ('request', struct.pack('!LLL', 0, 0, 2**14)))
+
+
+def test_out_of_range_piece_indices_ignored():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, TorrentPeer.build_reserved())
+    peer.handle_data_received(message(14))
+    for msg_id in (4, 13, 17):
+        for index in (4, 2**32 - 1):
+            peer.handle_data_received(message(msg_id,
+                                              struct.pack('!L', index)))
+    assert_equal(peer.suggested_pieces, [])
+    assert_equal(peer.allowed_fast, set())
+    assert_is_none(peer.requested_piece)
+
+    # The connection carries on.
+    peer.handle_data_received(message(17, struct.pack('!L', 3)))
+    assert_equal(peer.requested_piece, 3)
+    peer.handle_data_received(message(13, struct.pack('!L', 1)))
+    assert_equal(peer.suggested_pieces, [1])
+
+
+def test_choke_without_fast_releases_piece():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, bytes(8))
+    peer.handle_data_received(message(5, b'\xf0'))
+    peer.handle_data_received(message(1))
+    assert_equal(peer.requested_piece, 0)
+    peer.handle_data_received(message(0))
+    assert_is_none(peer.requested_piece)
+    assert_equal(t.piece_requests[0], [])
+
+
+def test_unknown_message_ignored():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, bytes(8))
+    peer.handle_data_received(message(99, b'xyz'))
+    assert_true(peer.is_started)
+
+
+def test_request_timeout_snubs_peer():
+    conn_man = ConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4))
+    peer = _connect(t, bytes(8))
+    peer.handle_data_received(message(5, b'\xf0') + message(1))
+    assert_equal(peer.requested_piece, 0)
+    timer = conn_man.timers[-1]
+    assert_equal(timer.callback, peer.handle_request_timeout)
+
+    timer.callback()
+    assert_true(peer.is_snubbed)
+    assert_is_none(peer.requested_piece)
+    assert_equal(t.piece_requests[0], [])
+
+    # The piece goes to the next peer asking for one.
+    other = _connect(t, bytes(8), port=6882)
+    other.handle_data_received(message(5, b'\xf0') + message(1))
+    assert_equal(other.requested_piece, 0)
+
+    # A late block is kept and the peer gets another piece.
+    block = struct.pack('!LL', 0, 0) + b'x' * 2**14
+    peer.handle_data_received(message(7, block))
+    assert_false(peer.is_snubbed)
+    assert_equal(peer.requested_piece, 1)
+    assert_equal(len(t.piece_blocks[0]), 1)
+
+
+def test_dial_candidates_ranked():
+    conn_man = ConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4))
+    t.is_running = True
+    untried = t.add_peer({'ip': '10.0.0.1', 'port': 1})
+    rotated = t.add_peer({'ip': '10.0.0.2', 'port': 1})
+    rotated.num_rotations = 1
+    fast = t.add_peer({'ip': '10.0.0.3', 'port': 1})
+    fast.best_rate = 100000.0
+    t.connect_more_peers()
+    assert_equal(conn_man.dialed, [fast, untried, rotated])
+
+
+def test_rotate_out_slowest_peer():
+    conn_man = ConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4))
+    t.is_running = True
+    t.max_peers = 2
+    slow = _connect(t, bytes(8), port=1)
+    quick = _connect(t, bytes(8), port=2)
+    candidate = t.add_peer({'ip': '10.0.0.9', 'port': 1})
+    long_ago = time.monotonic() - 3600
+    for (p, rate) in ((slow, 10.0), (quick, 50000.0)):
+        p.connected_at = p.last_rate_update = long_ago
+        p.download_rate = rate
+
+    t.rotate_peers()
+    assert_is_none(slow.conn)
+    assert_equal(slow.num_rotations, 1)
+    assert_is_not_none(quick.conn)
+    assert_equal(conn_man.dialed, [candidate])
+
+
+def _piecemessage(index, begin, data):
+    return message(7, struct.pack('!LL', index, begin) + data)
+
+
+def test_hash_failure_from_one_peer_then_ban():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4))
+    peer = _connect(t, bytes(8))
+    peer.handle_data_received(message(14) + message(1))
+    assert_equal(peer.requested_piece, 0)
+
+    peer.handle_data_received(_piecemessage(0, 0, b'x' * 2**14)
+                              + _piecemessage(0, 2**14, b'x' * 2**14))
+    assert_equal(peer.hash_failures, 1)
+    assert_is_none(t.complete_pieces[0])
+    assert_equal(t.piece_blocks[0], [])
+    assert_in(0, t.failed_blocks)
+    # Untrusted peers don't get to re-fetch failed pieces.
+    assert_equal(peer.requested_piece, 1)
+
+    peer.handle_data_received(_piecemessage(1, 0, b'x' * 2**14)
+                              + _piecemessage(1, 2**14, b'x' * 2**14))
+    assert_in('10.0.0.1', t.banned_ips)
+    assert_is_none(peer.conn)
+    assert_is_none(t.add_peer({'ip': '10.0.0.1', 'port': 9999}))
+
+
+def test_hash_failure_blamed_on_bad_block():
+    good = b'g' * 2**15
+    pieces = [hashlib.sha1(good).digest()] + [b'\x00' * 20] * 3
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(4, pieces))
+    a = _connect(t, bytes(8), port=1)
+    b = _connect(t, bytes(8), port=2)
+    for p in (a, b):
+        p.handle_data_received(message(14) + message(1))
+    assert_equal((a.requested_piece, b.requested_piece), (0, 1))
+
+    # Piece 0 is assembled from a bad block from a and a good one from b.
+    t.handle_block(a, 0, 0, b'x' * 2**14)
+    t.handle_block(b, 0, 2**14, good[2**14:])
+    assert_equal((a.hash_failures, b.hash_failures), (0, 0))
+    assert_equal(len(t.failed_blocks[0]), 2)
+
+    # It is re-fetched from one peer; blocks from others are ignored.
+    (fetcher,) = t.piece_requests[0]
+    other = b if fetcher is a else a
+    t.handle_block(other, 0, 0, good[:2**14])
+    assert_equal(t.piece_blocks[0], [])
+    t.handle_block(fetcher, 0, 0, good[:2**14])
+    t.handle_block(fetcher, 0, 2**14, good[2**14:])
+    assert_true(t.complete_pieces[0])
+    assert_equal((a.hash_failures, b.hash_failures), (1, 0))
+    assert_not_in(0, t.failed_blocks)
+
+
+def test_failed_piece_refetched_by_untrusted_peer_as_last_resort():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock(2))
+    t.failed_blocks[0] = []
+    a = _connect(t, bytes(8), port=1)
+    a.hash_failures = 1
+    a.handle_data_received(message(14) + message(1))
+    assert_equal(a.requested_piece, 1)
+
+    # Nobody trusted has piece 0, so a fetches it once it is out of others.
+    t.release_piece(a, 1)
+    t.complete_pieces[1] = b'x'
+    t.piece_requests[1] = None
+    a.run_download()
+    assert_equal(a.requested_piece, 0)
+
+    # With a trusted peer holding it, a leaves it alone.
+    t.release_piece(a, 0)
+    b = _connect(t, bytes(8), port=2)
+    b.handle_data_received(message(14))
+    assert_raises(PeerNoUnrequestedPiecesError, a._choose_next_piece)
+
+
+def test_utp_dial_falls_back_to_tcp():
+    conn_man = ConnectionManagerMock()
+    utp = ConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4), utp=utp)
+    t.is_running = True
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': 1})
+    t.connect_more_peers()
+    assert_equal((utp.dialed, conn_man.dialed), ([peer], []))
+
+    peer.handle_connection_failed()
+    assert_false(peer.conn_failed)
+    assert_equal(conn_man.dialed, [peer])
+
+
+class UTPManagerMock():
+    def __init__(self):
+        self.conns = []
+        self.pending_acks = set()
+
+    def connect_peer(self, peer):
+        conn = UTPConnection(self, peer, (peer.ip, peer.port), 1, 2)
+        self.conns.append(conn)
+        conn.send_syn()
+        return conn
+
+    def send_datagram(self, data, addr):
+        pass
+
+    def remove(self, conn):
+        if conn in self.conns:
+            self.conns.remove(conn)
+
+
+def test_utp_dial_reset_falls_back_to_tcp():
+    conn_man = ConnectionManagerMock()
+    utp = UTPManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4), utp=utp)
+    t.is_running = True
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': 1})
+    t.connect_more_peers()
+    assert_equal(len(utp.conns), 1)
+
+    utp.conns[0].handle_packet({'type': ST_RESET})
+    assert_false(peer.use_utp)
+    assert_is_none(peer.pending_conn)
+    assert_equal(conn_man.dialed, [peer])
+
+
+def test_utp_dial_cancelled_by_disconnect():
+    conn_man = ConnectionManagerMock()
+    utp = UTPManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4), utp=utp)
+    t.is_running = True
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': 1})
+    t.connect_more_peers()
+    conn = peer.pending_conn
+    assert_is_not_none(conn)
+
+    peer.disconnect()
+    assert_equal(utp.conns, [])
+    assert_false(peer.is_active())
+    # A late reset for the cancelled dial is ignored.
+    conn.handle_packet({'type': ST_RESET})
+    assert_true(peer.use_utp)
+    assert_equal(conn_man.dialed, [])
+
+
+def test_piece_hashed_in_thread():
+    good = b'g' * 2**15
+    pieces = [hashlib.sha1(good).digest()] * 4
+    conn_man = ThreadedConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock(4, pieces))
+    a = _connect(t, bytes(8), port=1)
+    b = _connect(t, bytes(8), port=2)
+    for p in (a, b):
+        p.handle_data_received(message(14) + message(1))
+
+    # Blocks that don't tile the piece can't be hashed as they arrive, so
+    # the whole piece is hashed on a thread.
+    t.handle_block(a, 0, 0, good[:2**14])
+    t.handle_block(a, 0, 2**14 + 1, good[2**14:])
+    assert_equal(len(conn_man.calls), 1)
+    assert_in(0, t.verifying_pieces)
+    assert_is_none(t.complete_pieces[0])
+    # Blocks for a piece being hashed are dropped.
+    t.handle_block(b, 0, 0, good[:2**14])
+    assert_equal(len(t.piece_blocks[0]), 2)
+
+    conn_man.calls.pop()()
+    assert_true(t.complete_pieces[0])
+    assert_equal(t.verifying_pieces, set())
+    assert_equal(a.requested_piece, 2)
+
+
+def test_piece_hashed_as_blocks_arrive():
+    class UnthreadedConnectionManagerMock(ConnectionManagerMock):
+        def run_in_thread(self, callback, func, *args):
+            raise AssertionError('piece hashed whole')
+
+    good = bytes(range(256)) * 2**7
+    pieces = [hashlib.sha1(good).digest()] * 4
+    t = Torrent(UnthreadedConnectionManagerMock(), MetainfoMock(4, pieces))
+    a = _connect(t, bytes(8), port=1)
+    a.handle_data_received(message(14) + message(1))
+
+    # Out of order: the second block waits for the first to be hashed.
+    t.handle_block(a, 0, 2**14, good[2**14:])
+    assert_equal(t.piece_hashes[0][2], 0)
+    assert_equal(list(t.piece_hashes[0][3]), [2**14])
+    t.handle_block(a, 0, 0, good[:2**14])
+    assert_true(t.complete_pieces[0])
+    assert_not_in(0, t.piece_hashes)
@@ -0,0 +1,78 @@
+import struct
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.torrent import Torrent
+from qqbt.peer import TorrentPeer
+from qqbt.pex import encode_pex_peers, decode_pex_peers
+from tests.mocks import MetainfoMock, ConnectionManagerMock, ConnMock
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _extended(ext_id, msg):
+    payload = bytes([20, ext_id]) + bencode.encode(msg)
+    return struct.pack('!L', len(payload)) + payload
+
+
+def _connect(torrent, ip, port):
+    peer = torrent.add_peer({'ip': ip, 'port': port})
+    peer.conn = ConnMock()
+    reserved = TorrentPeer.build_reserved()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        torrent.metainfo.info_hash, b'-XX0000-000000000000', reserved))
+    return peer
+
+
+def test_pex_peers_roundtrip():
+    addrs = [('10.0.0.1', 6881), ('192.168.1.20', 51413)]
+    assert_equal(decode_pex_peers(encode_pex_peers(addrs)),
+                 [{'ip': ip, 'port': port} for (ip, port) in addrs])
+    # Truncated trailing entries are ignored.
+    assert_equal(len(decode_pex_peers(encode_pex_peers(addrs) + b'\x01')), 2)
+
+
+def test_handshake_advertises_extensions():
+    msg = TorrentPeer.build_handshake(b'\x11' * 20, b'\x22' * 20,
+                                      TorrentPeer.build_reserved())
+    handshake = TorrentPeer.decode_handshake(19, msg[1:])
+    assert_true(handshake['reserved'][5] & 0x10)
+    assert_equal(handshake['info_hash'], b'\x11' * 20)
+
+
+def test_pex_exchange():
+    conn_man = ConnectionManagerMock(listen_port=6881)
+    t = Torrent(conn_man, MetainfoMock())
+    t.is_running = True
+    other = _connect(t, '10.0.0.9', 6881)
+    peer = _connect(t, '10.0.0.1', 6881)
+    assert_true(peer.supports_extensions)
+    (ext_id, msg) = peer.conn.extended_messages()[0]
+    assert_equal(ext_id, 0)
+    assert_in(b'ut_pex', msg[b'm'])
+
+    # Once the peer supports ut_pex, we send our connected peers.
+    peer.handle_data_received(_extended(0, {'m': {'ut_pex': 7}}))
+    (ext_id, msg) = peer.conn.extended_messages()[-1]
+    assert_equal(ext_id, 7)
+    assert_equal(decode_pex_peers(msg[b'added']),
+                 [{'ip': other.ip, 'port': other.port}])
+
+    # Added peers are deduplicated into the peer table and dialed.
+    added = encode_pex_peers([('10.0.0.2', 6881), ('10.0.0.9', 6881),
+                              ('10.0.0.3', 6881)])
+    peer.handle_data_received(_extended(1, {'added': added}))
+    assert_equal(len(t.peers), 4)
+    assert_equal(set((p.ip, p.port) for p in conn_man.dialed),
+                 {('10.0.0.2', 6881), ('10.0.0.3', 6881)})
+
+    # Messages arriving too quickly are ignored.
+    added = encode_pex_peers([('10.0.0.4', 6881)])
+    peer.handle_data_received(_extended(1, {'added': added}))
+    assert_is_none(t.find_peer('10.0.0.4', 6881))
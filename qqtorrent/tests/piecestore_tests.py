@@ -0,0 +1,172 @@
+import os
+import hashlib
+import tempfile
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.piecestore import PieceStore, clone_file
+from qqbt.storage import TorrentStorage, WriteBackCache
+from qqbt.torrent import Torrent
+from qqbt.torrent_metainfo import TorrentMetainfo
+from tests.mocks import ConnectionManagerMock, ThreadedConnectionManagerMock
+
+PIECE_LENGTH = 2**14
+X = bytes(i * 7 % 251 for i in range(40000))
+Y = bytes(i * 11 % 253 for i in range(30000))
+Z = b'z' * 20000
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _metainfo(name, files, file_hashes=True):
+    data = b''.join(content for (_, content) in files)
+    pieces = b''.join(hashlib.sha1(data[i:i+PIECE_LENGTH]).digest()
+                      for i in range(0, len(data), PIECE_LENGTH))
+    file_dicts = []
+    for (path, content) in files:
+        d = {b'length': len(content), b'path': [path.encode()]}
+        if file_hashes:
+            d[b'sha1'] = hashlib.sha1(content).digest()
+        file_dicts.append(d)
+    info = {b'name': name.encode(), b'piece length': PIECE_LENGTH,
+            b'pieces': pieces, b'files': file_dicts}
+    return TorrentMetainfo(bencode.encode(
+        {b'announce': b'http://127.0.0.1:9/announce', b'info': info}))
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_pieces_and_files_from_store():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _check_pieces_and_files_from_store(tmpdir)
+
+
+def _check_pieces_and_files_from_store(tmpdir):
+    store = PieceStore(os.path.join(tmpdir, 'store'))
+    outdir = os.path.join(tmpdir, 'out')
+    cache = WriteBackCache()
+
+    # A finished torrent holding x and y.
+    a = _metainfo('a', [('x', X), ('y', Y)])
+    storage = TorrentStorage(a, cache, outdir)
+    for (path, content) in zip(storage.paths, (X, Y)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+    store.add_torrent(a, storage.paths, range(len(a.info['pieces'])))
+    assert_equal(set(store.files), {hashlib.sha1(X).digest(),
+                                    hashlib.sha1(Y).digest()})
+
+    # Same content under another name, without file hashes: every piece is
+    # found by hash and the torrent finishes without any peers.
+    conn_man = ConnectionManagerMock()
+    done = []
+    c = _metainfo('c', [('x', X), ('y', Y)], file_hashes=False)
+    t = Torrent(conn_man, c, lambda t, data: done.append(t),
+                storage=TorrentStorage(c, cache, outdir),
+                piece_store=PieceStore(store.store_dir))
+    t.start_torrent()
+    assert_is_none(t.tracker)
+    (timer,) = conn_man.timers
+    timer.callback()
+    assert_equal(done, [t])
+    t.storage.close()
+    assert_equal(_read(os.path.join(outdir, 'c', 'x')), X)
+    assert_equal(_read(os.path.join(outdir, 'c', 'y')), Y)
+
+    # x alongside a new file: x is linked into place and the pieces inside
+    # it are complete; the piece straddling x and z is not.
+    b = _metainfo('b', [('x', X), ('z', Z)])
+    t = Torrent(conn_man, b, storage=TorrentStorage(b, cache, outdir),
+                piece_store=store)
+    assert_equal(t.fill_from_store(), 2)
+    assert_equal(t.complete_pieces, [True, True, None, None])
+    assert_equal(_read(os.path.join(outdir, 'b', 'x')), X)
+    t.storage.close()
+    cache.close()
+
+
+def _write_files(storage, contents):
+    for (path, content) in zip(storage.paths, contents):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+
+def test_store_read_off_loop():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = PieceStore(os.path.join(tmpdir, 'store'))
+        outdir = os.path.join(tmpdir, 'out')
+        cache = WriteBackCache()
+        a = _metainfo('a', [('x', X), ('y', Y)])
+        storage = TorrentStorage(a, cache, outdir)
+        _write_files(storage, (X, Y))
+        store.add_torrent(a, storage.paths, range(len(a.info['pieces'])))
+
+        conn_man = ThreadedConnectionManagerMock()
+        c = _metainfo('c', [('x', X), ('y', Y)], file_hashes=False)
+        t = Torrent(conn_man, c, storage=TorrentStorage(c, cache, outdir),
+                    piece_store=store)
+        t.start_torrent()
+        # Nothing is read on the loop, and starting waits for the store.
+        assert_equal(t.complete_pieces, [None] * 5)
+        assert_equal(conn_man.timers, [])
+        t.stop_torrent()
+        t.start_torrent()
+        (call,) = conn_man.calls
+        call()
+        assert_equal(t.complete_pieces, [True] * 5)
+        assert_equal(len(conn_man.timers), 1)
+        t.storage.close()
+        cache.close()
+
+
+def test_store_shared_between_processes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_dir = os.path.join(tmpdir, 'store')
+        cache = WriteBackCache()
+        a = _metainfo('a', [('x', X)])
+        b = _metainfo('b', [('z', Z)])
+        storage_a = TorrentStorage(a, cache, tmpdir)
+        storage_b = TorrentStorage(b, cache, tmpdir)
+        _write_files(storage_a, (X,))
+        _write_files(storage_b, (Z,))
+
+        # Two workers, each with its own copy of the index.
+        first = PieceStore(store_dir)
+        second = PieceStore(store_dir)
+        first.add_torrent(a, storage_a.paths, range(len(a.info['pieces'])))
+        second.add_torrent(b, storage_b.paths, range(len(b.info['pieces'])))
+        store = PieceStore(store_dir)
+        assert_equal(set(store.pieces),
+                     set(a.info['pieces']) | set(b.info['pieces']))
+        assert_equal(set(store.files), {hashlib.sha1(X).digest(),
+                                        hashlib.sha1(Z).digest()})
+
+        # The first worker sees the second's entries once it reloads.
+        first.reload()
+        assert_is_not_none(first.get_piece(b.info['pieces'][0],
+                                           PIECE_LENGTH))
+        cache.close()
+
+
+def test_clone_file_shares_storage():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src')
+        dst = os.path.join(tmpdir, 'dst')
+        with open(src, 'wb') as f:
+            f.write(X)
+        how = clone_file(src, dst)
+        assert_in(how, ('reflink', 'hardlink'))
+        if how == 'hardlink':
+            assert_true(os.path.samefile(src, dst))
+        assert_equal(_read(dst), X)
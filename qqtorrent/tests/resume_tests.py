@@ -0,0 +1,171 @@
+import os
+import struct
+import hashlib
+import tempfile
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.peer import TorrentPeer
+from qqbt.resume import ResumeState, ResumeError
+from qqbt.storage import TorrentStorage, WriteBackCache
+from qqbt.torrent import Torrent, TorrentPieceError
+from qqbt.torrent_metainfo import TorrentMetainfo
+from tests.mocks import (ConnectionManagerMock, ThreadedConnectionManagerMock,
+                         ConnMock)
+
+PIECE_LENGTH = 2**15
+X = bytes(i * 7 % 251 for i in range(70000))
+Y = bytes(i * 11 % 253 for i in range(40000))
+DATA = X + Y
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _metainfo():
+    pieces = b''.join(hashlib.sha1(DATA[i:i+PIECE_LENGTH]).digest()
+                      for i in range(0, len(DATA), PIECE_LENGTH))
+    info = {b'name': b'r', b'piece length': PIECE_LENGTH, b'pieces': pieces,
+            b'files': [{b'length': len(X), b'path': [b'x']},
+                       {b'length': len(Y), b'path': [b'y']}]}
+    return TorrentMetainfo(bencode.encode(
+        {b'announce': b'http://127.0.0.1:9/announce', b'info': info}))
+
+
+def _piece(i):
+    return DATA[i * PIECE_LENGTH:(i + 1) * PIECE_LENGTH]
+
+
+def test_state_roundtrip():
+    metainfo = _metainfo()
+    state = ResumeState(metainfo.info_hash, [True, False, False, True], [3],
+                        [[65536, 1], [-1, 0]], {2: [(0, b'abc')]},
+                        [('10.0.0.1', 6881, 5000.0)])
+    decoded = ResumeState.decode(state.encode(), metainfo)
+    assert_equal(decoded.complete, [True, False, False, True])
+    assert_equal(decoded.unverified, {3})
+    assert_equal(decoded.files, [[65536, 1], [-1, 0]])
+    assert_equal(decoded.partial, {2: [(0, b'abc')]})
+    assert_equal(decoded.peers, [('10.0.0.1', 6881, 5000)])
+
+    state.info_hash = b'\x00' * 20
+    assert_raises(ResumeError, ResumeState.decode, state.encode(), metainfo)
+    assert_raises(ResumeError, ResumeState.decode, b'garbage', metainfo)
+
+
+def test_restart_from_resume_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _check_restart_from_resume_file(tmpdir)
+
+
+def _check_restart_from_resume_file(tmpdir):
+    metainfo = _metainfo()
+    cache = WriteBackCache()
+    resume_path = os.path.join(tmpdir, 'r.resume')
+    (x_path, y_path) = TorrentStorage(metainfo, cache, tmpdir).paths
+
+    # Pieces 0, 1 and 3 done and the first block of piece 2 received when
+    # the state is saved.
+    t = Torrent(ConnectionManagerMock(), metainfo,
+                storage=TorrentStorage(metainfo, cache, tmpdir),
+                resume_path=resume_path)
+    for i in (0, 1, 3):
+        t.storage.write_piece(i, _piece(i))
+        t.complete_pieces[i] = True
+    peer = t.add_peer({'ip': '10.0.0.1', 'port': 6881})
+    peer.best_rate = 5000.0
+    t.piece_blocks[2].append((0, _piece(2)[:2**14], peer))
+    # Without a flush, pieces still in the write cache aren't recorded.
+    t.save_resume()
+    state = ResumeState.load(resume_path, metainfo)
+    assert_equal(state.complete, [False] * 4)
+    assert_equal(t.storage.get_unwritten_pieces(), {0, 1, 3})
+    t.save_resume(flush=True)
+    t.storage.close()
+
+    def restart():
+        t = Torrent(ConnectionManagerMock(), metainfo,
+                    storage=TorrentStorage(metainfo, cache, tmpdir),
+                    resume_path=resume_path)
+        t.load_resume()
+        return t
+
+    # Files untouched: everything comes back without reading the data.
+    t = restart()
+    assert_equal(t.complete_pieces, [True, True, None, True])
+    assert_equal(t.unverified_pieces, set())
+    assert_equal(t.piece_blocks[2], [(0, _piece(2)[:2**14], None)])
+    (peer,) = t.peers
+    assert_equal(peer.best_rate, 5000.0)
+
+    # The restored block is not requested again.
+    peer.conn = ConnMock()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        metainfo.info_hash, b'-XX0000-000000000000'))
+    peer.peer_choking = False
+    peer.request_next_block(2, None)
+    (_, _, index, begin, length) = struct.unpack('!LBLLL',
+                                                 peer.conn.written[-1])
+    assert_equal((index, begin, length), (2, 2**14, 2**14))
+    t.storage.close()
+
+    # x changed after the save: its pieces are checked when read.
+    with open(x_path, 'r+b') as f:
+        f.write(b'\xff')
+    st = os.stat(x_path)
+    os.utime(x_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    t = restart()
+    assert_equal(t.complete_pieces, [True, True, None, True])
+    assert_equal(t.unverified_pieces, {0, 1})
+    assert_equal(t.read_block(1, 0, 4), _piece(1)[:4])
+    assert_raises(TorrentPieceError, t.read_block, 0, 0, 4)
+    assert_equal(t.complete_pieces, [None, True, None, True])
+    assert_equal(t.unverified_pieces, set())
+    t.save_resume()
+    t.storage.close()
+
+    # y lost data: its pieces are fetched again.
+    os.truncate(y_path, 100)
+    t = restart()
+    assert_equal(t.complete_pieces, [None, True, None, None])
+    t.storage.close()
+    cache.close()
+
+
+def test_resume_saved_on_thread():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        metainfo = _metainfo()
+        cache = WriteBackCache()
+        resume_path = os.path.join(tmpdir, 'r.resume')
+        conn_man = ThreadedConnectionManagerMock()
+        t = Torrent(conn_man, metainfo,
+                    storage=TorrentStorage(metainfo, cache, tmpdir),
+                    resume_path=resume_path)
+        t.save_resume()
+        assert_false(os.path.exists(resume_path))
+        t.storage.write_piece(0, _piece(0))
+        t.complete_pieces[0] = True
+        t.storage.flush()
+        t.save_resume()
+        assert_equal(len(conn_man.calls), 2)
+
+        # Written out of order, the older state doesn't replace the newer.
+        conn_man.calls.pop()()
+        conn_man.calls.pop()()
+        state = ResumeState.load(resume_path, metainfo)
+        assert_equal(state.complete, [True, False, False, False])
+
+        # A flushing save is written at once.
+        t.storage.write_piece(1, _piece(1))
+        t.complete_pieces[1] = True
+        t.save_resume(flush=True)
+        assert_equal(conn_man.calls, [])
+        state = ResumeState.load(resume_path, metainfo)
+        assert_equal(state.complete, [True, True, False, False])
+        t.storage.close()
+        cache.close()
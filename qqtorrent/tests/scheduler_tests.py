@@ -0,0 +1,144 @@
+from nose.tools import *
+
+from qqbt.config import CONFIG
+from qqbt.scheduler import (TorrentScheduler, PRIORITY_LOW, PRIORITY_NORMAL,
+                            PRIORITY_HIGH)
+from qqbt.tracker import AnnounceFailureError, AnnounceDecodeError
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+class TorrentMock():
+    def __init__(self, name, fail_start=False, error=AnnounceFailureError):
+        self.name = name
+        self.fail_start = fail_start
+        self.error = error
+        self.is_running = False
+        self.is_paused = False
+        self.is_complete = False
+        self.max_peers = None
+        self.num_complete = 0
+
+    def __repr__(self):
+        return 'TorrentMock(%s)' % self.name
+
+    def start_torrent(self):
+        self.is_running = True
+        if self.fail_start:
+            raise self.error('tracker down')
+
+    def stop_torrent(self):
+        self.is_running = False
+
+    def set_max_peers(self, max_peers):
+        self.max_peers = max_peers
+
+    def get_num_complete(self):
+        return self.num_complete
+
+
+def _running(torrents):
+    return [t.name for t in torrents if t.is_running]
+
+
+def test_max_active_and_promotion():
+    s = TorrentScheduler(None, max_active=2, max_connections=8)
+    torrents = [TorrentMock(str(i)) for i in range(4)]
+    for t in torrents:
+        s.add(t)
+    s.reschedule()
+    assert_equal(_running(torrents), ['0', '1'])
+    assert_true(s.is_queued(torrents[2]))
+
+    torrents[0].is_complete = True
+    torrents[0].is_running = False
+    s.reschedule()
+    assert_equal(_running(torrents), ['1', '2'])
+
+    torrents[1].is_paused = True
+    torrents[1].is_running = False
+    s.reschedule()
+    assert_equal(_running(torrents), ['2', '3'])
+
+
+def test_priorities_preempt_and_share_connections():
+    s = TorrentScheduler(None, max_active=2, max_connections=8)
+    low = TorrentMock('low')
+    normal = TorrentMock('normal')
+    high = TorrentMock('high')
+    s.add(low, PRIORITY_LOW)
+    s.add(normal, PRIORITY_NORMAL)
+    s.reschedule()
+    assert_equal(_running([low, normal]), ['low', 'normal'])
+
+    s.add(high, PRIORITY_HIGH)
+    s.reschedule()
+    assert_equal(_running([low, normal, high]), ['normal', 'high'])
+    # Slots are split by weight: 8 * 2/5 and 8 * 3/5.
+    assert_equal((normal.max_peers, high.max_peers),
+                 (3, min(4, CONFIG['max_peers'])))
+
+
+def test_stalled_torrent_requeued():
+    s = TorrentScheduler(None, max_active=1, max_connections=8)
+    stuck = TorrentMock('stuck')
+    waiting = TorrentMock('waiting')
+    s.add(stuck)
+    s.add(waiting)
+    s.reschedule()
+    assert_equal(_running([stuck, waiting]), ['stuck'])
+
+    s.entries[stuck].last_progress -= CONFIG['stall_timeout'] + 1
+    s.reschedule()
+    assert_equal(_running([stuck, waiting]), ['waiting'])
+
+
+def test_failed_start_fills_slot():
+    failed = []
+    s = TorrentScheduler(None, max_active=1, max_connections=8,
+                         on_failed_torrent=failed.append)
+    bad = TorrentMock('bad', fail_start=True)
+    good = TorrentMock('good')
+    s.add(bad)
+    s.add(good)
+    s.reschedule()
+    assert_equal(failed, [bad])
+    assert_equal(_running([bad, good]), ['good'])
+
+
+def test_transient_start_failure_retried_with_backoff():
+    failed = []
+    s = TorrentScheduler(None, max_active=1, max_connections=8,
+                         on_failed_torrent=failed.append)
+    flaky = TorrentMock('flaky', fail_start=True, error=AnnounceDecodeError)
+    s.add(flaky)
+    delays = []
+    for _ in range(CONFIG['start_retries']):
+        s.reschedule()
+        entry = s.entries[flaky]
+        delays.append(round(entry.retry_at - entry.last_progress))
+        assert_false(flaky.is_running)
+        assert_true(s.is_queued(flaky))
+        # Not started again until the delay has passed.
+        s.reschedule()
+        assert_equal(entry.num_failures, len(delays))
+        entry.retry_at = 0
+    assert_equal(delays, [CONFIG['start_retry_delay'] * 2 ** i
+                          for i in range(CONFIG['start_retries'])])
+    assert_equal(failed, [])
+
+    s.reschedule()
+    assert_equal(failed, [flaky])
+    assert_true(s.is_failed(flaky))
+    assert_false(s.is_queued(flaky))
+
+    flaky.fail_start = False
+    s.retry(flaky)
+    s.reschedule()
+    assert_equal(_running([flaky]), ['flaky'])
@@ -0,0 +1,164 @@
+import os
+import hashlib
+import tempfile
+import threading
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.torrent_metainfo import TorrentMetainfo
+from qqbt.storage import TorrentStorage, WriteBackCache, StorageError
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _make_torrent(file_lengths, piece_length):
+    data = os.urandom(sum(file_lengths))
+    pieces = b''.join(hashlib.sha1(data[i:i+piece_length]).digest()
+                      for i in range(0, len(data), piece_length))
+    metainfo = TorrentMetainfo(bencode.encode({
+        'announce': 'http://tracker.example.com/announce',
+        'info': {
+            'name': 'multi',
+            'piece length': piece_length,
+            'pieces': pieces,
+            'files': [{'length': n, 'path': ['d%d' % i, 'f%d' % i]}
+                      for (i, n) in enumerate(file_lengths)]
+        }
+    }))
+    return (metainfo, data)
+
+
+class CountingStorage(TorrentStorage):
+    def __init__(self, *args, **kwargs):
+        TorrentStorage.__init__(self, *args, **kwargs)
+        self.writes = []
+
+    def write_file(self, file_index, offset, buffers):
+        self.writes.append((file_index, offset, len(buffers)))
+        TorrentStorage.write_file(self, file_index, offset, buffers)
+
+
+def test_write_back_cache_coalesces_and_reads():
+    (metainfo, data) = _make_torrent([1000, 50, 3000, 0, 1234], 256)
+    piece_length = metainfo.info['piece_length']
+    num_pieces = len(metainfo.info['pieces'])
+
+    with tempfile.TemporaryDirectory() as outdir:
+        cache = WriteBackCache(max_bytes=1 << 20)
+        storage = CountingStorage(metainfo, cache, outdir)
+        # Out of order, so that only coalescing yields one write per file.
+        for i in reversed(range(num_pieces)):
+            piece = data[i*piece_length:(i+1)*piece_length]
+            storage.write_piece(i, piece)
+        assert_equal(storage.read(5, 10, 20),
+                     data[5*piece_length+10:5*piece_length+30])
+        storage.close()
+
+        assert_equal(sorted(f for (f, _, _) in storage.writes), [0, 1, 2, 4])
+        for (i, path) in enumerate(storage.paths):
+            expected = data[metainfo.get_file_offsets()[i]:
+                            metainfo.get_file_offsets()[i+1]]
+            if expected:
+                with open(path, 'rb') as f:
+                    assert_equal(f.read(), expected)
+
+        # Reads spanning a file boundary come back from disk.
+        cache.entries.clear()
+        cache.clean_keys.clear()
+        assert_equal(storage.read(3, 0, piece_length),
+                     data[3*piece_length:4*piece_length])
+        storage.close()
+        cache.close()
+
+
+def test_write_back_cache_budget():
+    (metainfo, data) = _make_torrent([64 * 1024], 1024)
+    with tempfile.TemporaryDirectory() as outdir:
+        cache = WriteBackCache(max_bytes=8 * 1024)
+        storage = TorrentStorage(metainfo, cache, outdir)
+        for i in range(64):
+            storage.write_piece(i, data[i*1024:(i+1)*1024])
+        storage.flush()
+        assert_true(cache.total_bytes <= cache.max_bytes)
+
+        # Clean pieces are evicted least recently used first.
+        cached = sorted(i for (_, i) in cache.clean_keys)
+        assert_equal(storage.read(cached[0], 0, 4),
+                     data[cached[0]*1024:cached[0]*1024+4])
+        for i in range(2):
+            storage.write_piece(i, data[i*1024:(i+1)*1024])
+        storage.flush()
+        assert_in((storage, cached[0]), cache.entries)
+        assert_not_in((storage, cached[1]), cache.entries)
+        storage.close()
+        cache.close()
+        with open(storage.paths[0], 'rb') as f:
+            assert_equal(f.read(), data)
+
+
+class SlowStorage(TorrentStorage):
+    def __init__(self, *args, **kwargs):
+        TorrentStorage.__init__(self, *args, **kwargs)
+        self.can_write = threading.Event()
+
+    def write_file(self, file_index, offset, buffers):
+        self.can_write.wait()
+        TorrentStorage.write_file(self, file_index, offset, buffers)
+
+
+def test_write_back_cache_does_not_wait_for_disk():
+    (metainfo, data) = _make_torrent([16 * 1024], 1024)
+    with tempfile.TemporaryDirectory() as outdir:
+        cache = WriteBackCache(max_bytes=4 * 1024)
+        storage = SlowStorage(metainfo, cache, outdir)
+        # Over budget while the disk is stuck, rather than blocking.
+        for i in range(16):
+            storage.write_piece(i, data[i*1024:(i+1)*1024])
+        assert_greater(cache.get_dirty_bytes(), cache.max_bytes)
+
+        storage.can_write.set()
+        storage.flush()
+        assert_equal(cache.get_dirty_bytes(), 0)
+        assert_true(cache.total_bytes <= cache.max_bytes)
+        storage.close()
+        cache.close()
+        with open(storage.paths[0], 'rb') as f:
+            assert_equal(f.read(), data)
+
+
+class FailingStorage(TorrentStorage):
+    def __init__(self, *args, **kwargs):
+        TorrentStorage.__init__(self, *args, **kwargs)
+        self.num_failures = 1
+
+    def write_file(self, file_index, offset, buffers):
+        if self.num_failures:
+            self.num_failures -= 1
+            raise OSError(28, 'No space left on device')
+        TorrentStorage.write_file(self, file_index, offset, buffers)
+
+
+def test_write_back_cache_keeps_failed_pieces_dirty():
+    (metainfo, data) = _make_torrent([4096], 1024)
+    with tempfile.TemporaryDirectory() as outdir:
+        cache = WriteBackCache(max_bytes=1 << 20)
+        storage = FailingStorage(metainfo, cache, outdir)
+        for i in range(4):
+            storage.write_piece(i, data[i*1024:(i+1)*1024])
+        assert_raises(StorageError, storage.flush)
+        # Nothing reached the disk, so nothing may be dropped from memory.
+        assert_equal(cache.dirty_bytes, 4096)
+        assert_equal(storage.read(2, 0, 1024), data[2048:3072])
+
+        storage.flush()
+        assert_equal(cache.dirty_bytes, 0)
+        storage.close()
+        cache.close()
+        with open(storage.paths[0], 'rb') as f:
+            assert_equal(f.read(), data)
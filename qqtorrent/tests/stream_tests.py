@@ -0,0 +1,146 @@
+import io
+import struct
+import hashlib
+import threading
+from nose.tools import *
+
+from qqbt.torrent import Torrent
+from qqbt.peer import TorrentPeer
+from qqbt.stream import TorrentStream, StreamClosedError, StreamTimeoutError
+from tests.mocks import (ConnectionManagerMock, LoopConnectionManagerMock,
+                         ConnMock, message)
+
+PIECE_LENGTH = 2**15
+DATA = bytes(range(256)) * (4 * PIECE_LENGTH // 256)
+FILE_LENGTHS = [40000, len(DATA) - 40000]
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+class MetainfoMock():
+    def __init__(self):
+        self.info_hash = b'\x11' * 20
+        self.info = {
+            'piece_length': PIECE_LENGTH,
+            'pieces': [hashlib.sha1(DATA[i:i+PIECE_LENGTH]).digest()
+                       for i in range(0, len(DATA), PIECE_LENGTH)]
+        }
+
+    def get_piece_length(self, piece_index):
+        return PIECE_LENGTH
+
+    def get_file_offsets(self):
+        return [0, FILE_LENGTHS[0], len(DATA)]
+
+
+def _connect(torrent, port):
+    peer = torrent.add_peer({'ip': '10.0.0.1', 'port': port})
+    peer.conn = ConnMock()
+    peer.handle_data_received(TorrentPeer.build_handshake(
+        torrent.metainfo.info_hash, b'-XX0000-000000000000'))
+    return peer
+
+
+def _send_piece(peer, index):
+    for begin in range(0, PIECE_LENGTH, 2**14):
+        block = DATA[index * PIECE_LENGTH + begin:][:2**14]
+        peer.handle_data_received(
+            message(7, struct.pack('!LL', index, begin) + block))
+
+
+def test_stream_pieces_fetched_first():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock())
+    stream = TorrentStream(t, 1)
+    stream.seek(PIECE_LENGTH)
+    # The file starts inside piece 1, so the cursor is in piece 2.
+    assert_equal(t.get_stream_pieces(), [(2, True), (3, False)])
+
+    peers = [_connect(t, port) for port in (1, 2, 3, 4)]
+    for p in peers:
+        p.handle_data_received(message(5, b'\xf0') + message(1))
+    # Two peers race for the piece under the cursor.
+    assert_equal([p.requested_piece for p in peers], [2, 2, 3, 0])
+
+    stream.close()
+    assert_equal(t.get_stream_pieces(), [])
+
+
+def test_read_blocks_until_piece_verified():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock())
+    peer = _connect(t, 1)
+    peer.handle_data_received(message(5, b'\xf0') + message(1))
+    stream = io.BufferedReader(TorrentStream(t, 1, timeout=5.0))
+    result = []
+    reader = threading.Thread(target=lambda: result.append(stream.read(100)))
+    reader.start()
+    reader.join(0.1)
+    assert_true(reader.is_alive())
+
+    for i in range(4):
+        _send_piece(peer, i)
+    reader.join(5.0)
+    assert_false(reader.is_alive())
+    assert_equal(result, [DATA[40000:40100]])
+
+    # Reads cross piece boundaries and stop at the end of the file.
+    stream.seek(-10, io.SEEK_END)
+    assert_equal(stream.read(), DATA[-10:])
+    stream.seek(0)
+    assert_equal(stream.read(), DATA[40000:])
+
+
+def test_restored_piece_checked_on_loop():
+    conn_man = LoopConnectionManagerMock()
+    t = Torrent(conn_man, MetainfoMock())
+    t.complete_pieces[0] = DATA[:PIECE_LENGTH]
+    t.unverified_pieces.add(0)
+    checked = []
+
+    def verify_piece(piece_index):
+        # Without storage the piece is in memory: nothing to read back.
+        checked.append(piece_index)
+        t.unverified_pieces.discard(piece_index)
+        return True
+    t.verify_piece = verify_piece
+
+    stream = TorrentStream(t, 0, timeout=5.0)
+    result = []
+    reader = threading.Thread(target=lambda: result.append(stream.read(10)))
+    reader.start()
+    reader.join(0.1)
+    # The reader leaves the check to the event loop and waits for it.
+    assert_true(reader.is_alive())
+    assert_equal(checked, [])
+    (call,) = conn_man.calls
+    call()
+    reader.join(5.0)
+    assert_false(reader.is_alive())
+    assert_equal(checked, [0])
+    assert_equal(result, [DATA[:10]])
+
+
+def test_read_timeout_and_abort():
+    t = Torrent(ConnectionManagerMock(), MetainfoMock())
+    stream = TorrentStream(t, 0, timeout=0.01)
+    assert_raises(StreamTimeoutError, stream.read, 10)
+
+    stream.timeout = None
+    errors = []
+
+    def read():
+        try:
+            stream.read(10)
+        except StreamClosedError as e:
+            errors.append(e)
+    reader = threading.Thread(target=read)
+    reader.start()
+    t.close_streams()
+    reader.join(5.0)
+    assert_false(reader.is_alive())
+    assert_equal(len(errors), 1)
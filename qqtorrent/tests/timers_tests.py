@@ -0,0 +1,106 @@
+import threading
+from nose.tools import *
+
+from qqbt.conn import ConnectionManagerSelect
+from qqbt.timers import TimerQueue
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_call_later_order_and_cancel():
+    clock = Clock()
+    timers = TimerQueue(clock)
+    calls = []
+    timers.call_later(2.0, calls.append, 'b')
+    timers.call_later(1.0, calls.append, 'a')
+    t = timers.call_later(1.5, calls.append, 'x')
+    t.cancel()
+    assert_equal(len(timers), 2)
+    assert_equal(timers.next_timeout(), 1.0)
+
+    clock.now = 1.0
+    timers.run_expired()
+    assert_equal(calls, ['a'])
+    clock.now = 5.0
+    timers.run_expired()
+    assert_equal(calls, ['a', 'b'])
+    assert_is_none(timers.next_timeout())
+    # Cancelling a timer that already ran is harmless.
+    t.cancel()
+    assert_equal(len(timers), 0)
+
+
+def test_call_every():
+    clock = Clock()
+    timers = TimerQueue(clock)
+    calls = []
+    t = timers.call_every(1.0, lambda: calls.append(clock.now))
+    for now in (0.5, 1.0, 2.0, 2.5, 10.0, 11.0):
+        clock.now = now
+        timers.run_expired()
+    # Missed runs are skipped, not replayed.
+    assert_equal(calls, [1.0, 2.0, 10.0, 11.0])
+
+    # A repeating timer can cancel itself from its callback.
+    t.cancel()
+    t = timers.call_every(1.0, lambda: t.cancel())
+    clock.now = 12.0
+    timers.run_expired()
+    assert_equal(len(timers), 0)
+
+
+def test_many_cancelled_timers_compacted():
+    timers = TimerQueue(Clock())
+    live = [timers.call_later(i, lambda: None) for i in range(1000)]
+    for t in live[:900]:
+        t.cancel()
+    assert_equal(len(timers), 100)
+    assert_less(len(timers.heap), 500)
+
+
+def test_select_loop_runs_timers():
+    conn_man = ConnectionManagerSelect()
+    calls = []
+
+    def tick():
+        calls.append(1)
+        if len(calls) == 3:
+            conn_man.stop_event_loop()
+    conn_man.call_every(0.01, tick)
+    thread = threading.Thread(target=conn_man.start_event_loop)
+    thread.start()
+    thread.join(5.0)
+    assert_false(thread.is_alive())
+    assert_equal(len(calls), 3)
+
+
+def test_select_loop_woken_by_call_from_thread():
+    conn_man = ConnectionManagerSelect()
+    calls = []
+
+    def stop(value):
+        calls.append((value, threading.current_thread()))
+        conn_man.stop_event_loop()
+    # A far timer: only the wakeup can get the loop to run the call soon.
+    conn_man.call_later(60, stop, 'timer')
+    thread = threading.Thread(target=conn_man.start_event_loop)
+    thread.start()
+    thread.join(0.05)
+    conn_man.call_from_thread(stop, 'thread')
+    thread.join(5.0)
+    assert_false(thread.is_alive())
+    assert_equal(calls, [('thread', thread)])
@@ -3,7 +3,9 @@ import copy
 from nose.tools import *
 import bencodepy
 
-from qqbt.torrent_metainfo import TorrentMetainfo, TorrentDecodeError
+from qqbt import bencode
+from qqbt.torrent_metainfo import (
+    TorrentMetainfo, TorrentDecodeError, PieceHashes)
 
 
 def setup():
@@ -28,6 +30,7 @@ def test_single_file_torrent():
     assert_equal(t.info_hash,
                  b'+\x15\xca+\xfdH\xcd\xd7m9\xecU\xa3\xab\x1b\x8aW\x18\n\t')
     assert_equal(t.name, 'flag.jpg')
+    assert_equal(t.url_list, [])
     assert_is_none(info['files'])
     assert_equal(info['format'], 'SINGLE_FILE')
     assert_equal(info['piece_length'], 16384)
@@ -44,6 +47,9 @@ def test_multiple_file_torrent():
     assert_equal(t.info_hash,
                  b'SO;Z;\xa8\x14\x15\x1f\xd6h$"fa\xd0\x10Vw\x80')
     assert_equal(t.name, 'amusementsinmath16713gut')
+    assert_equal(t.url_list, ['https://archive.org/download/',
+                              'http://ia600300.us.archive.org/27/items/',
+                              'http://ia800300.us.archive.org/27/items/'])
     assert_is_not_none(info['files'])
     assert_equal(len(info['files']), 497)
     assert_true(all(type(v) is dict
@@ -84,3 +90,28 @@ def test_torrent_decode_exceptions():
     t = copy.deepcopy(sample)
     t['encoding'] = 'zzz'
     assert_raises(TorrentDecodeError, TorrentMetainfo, bencodepy.encode(t))
+
+
+def test_piece_hashes_packed():
+    buf = bytes(range(20)) + bytes(range(20, 40)) + bytes(range(40, 60))
+    pieces = PieceHashes(buf)
+    assert_equal(len(pieces), 3)
+    assert_equal(pieces[1], bytes(range(20, 40)))
+    assert_equal(pieces[-1], bytes(range(40, 60)))
+    assert_true(isinstance(pieces.view(2), memoryview))
+    assert_equal(pieces.view(2).tobytes(), bytes(range(40, 60)))
+    assert_equal(pieces[:2], [bytes(range(20)), bytes(range(20, 40))])
+    assert_raises(IndexError, pieces.view, 3)
+
+
+def test_bencode_decode_dict_spans():
+    data = bencodepy.encode({'a': 1, 'info': {'x': [b'y', 2]}, 'z': b''})
+    (d, spans) = bencode.decode_dict_spans(data)
+    assert_equal(d, bencodepy.decode(data))
+    (begin, end) = spans[b'info']
+    assert_equal(data[begin:end], bencodepy.encode({'x': [b'y', 2]}))
+    assert_equal(bencode.encode(d), data)
+
+    for bad in (b'd', b'd1:ai1', b'd1:ai1ee ', b'l1:ae', b'd1:ai1xee'):
+        assert_raises(bencode.BencodeDecodeError,
+                      bencode.decode_dict_spans, bad)
@@ -1,6 +1,7 @@
 from nose.tools import *
 
-from qqbt.torrent import Torrent
+from qqbt.torrent import Torrent, PRIORITY_SKIP
+from qqbt.scheduler import PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
 from qqbt.tracker import TorrentTracker, AnnounceDecodeError
 
 
@@ -50,3 +51,47 @@ def test_torrent_tracker_decode_binary_model_peers():
     peers_bytes = b'\xce\xfc\xd7\x8a\x00'
     assert_raises(AnnounceDecodeError,
                   TorrentTracker.decode_binary_model_peers, peers_bytes)
+
+
+class FilesMetainfoMock():
+    """Four 32 KiB pieces over three files; pieces 1 and 2 span files."""
+    def __init__(self):
+        self.info = {
+            'piece_length': 2**15,
+            'pieces': [b'\x00' * 20] * 4
+        }
+
+    def get_file_lengths(self):
+        return [50000, 30000, 51072]
+
+    def get_file_offsets(self):
+        return [0, 50000, 80000, 131072]
+
+
+def test_file_priorities_map_to_pieces():
+    t = Torrent(None, FilesMetainfoMock())
+    assert_equal(list(t.get_piece_order()), [0, 1, 2, 3])
+
+    t.set_file_priority(0, PRIORITY_SKIP)
+    t.set_file_priority(2, PRIORITY_HIGH)
+    # Piece 1 is shared with file 1, so it is still wanted.
+    assert_equal(t.piece_priorities,
+                 [PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH,
+                  PRIORITY_HIGH])
+    assert_equal(t.get_piece_order(), [2, 3, 1])
+
+    peer = t.add_peer({'ip': '1.1.1.1', 'port': 1})
+    peer.has_all = True
+    assert_equal(peer._choose_next_piece(), 2)
+
+    # Completion counts wanted pieces only.
+    t.complete_pieces[1:] = [b'x'] * 3
+    assert_true(t.is_wanted_complete())
+    assert_equal(t.get_progress_string(), '3 / 3 (100.0%) complete')
+    t.is_complete = True
+    t.set_file_priority(0, PRIORITY_LOW)
+    assert_false(t.is_complete)
+
+    for f in range(3):
+        t.set_file_priority(f, PRIORITY_SKIP)
+    assert_equal(t.get_progress_string(), 'nothing selected')
@@ -0,0 +1,164 @@
+import random
+import threading
+from nose.tools import *
+
+from qqbt.conn import ConnectionManagerSelect
+from qqbt import utp
+from qqbt.utp import (UTPSocketManager, UTPConnection, encode_packet,
+                      decode_packet, encode_sack, decode_sack)
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+class LossyManager(UTPSocketManager):
+    """Drops and delays outgoing datagrams."""
+    def __init__(self, conn_man, loss, delay, seed):
+        UTPSocketManager.__init__(self, conn_man, bind_ip='127.0.0.1')
+        self.loss = loss
+        self.delay = delay
+        self.random = random.Random(seed)
+
+    def send_datagram(self, data, addr):
+        if self.random.random() < self.loss:
+            return
+        self.conn_man.call_later(self.delay, UTPSocketManager.send_datagram,
+                                 self, data, addr)
+
+
+class PeerMock():
+    def __init__(self, ip='127.0.0.1', port=None, on_data=None,
+                 on_connect=None):
+        self.ip = ip
+        self.port = port
+        self.on_data = on_data
+        self.on_connect = on_connect
+        self.conn = None
+        self.received = bytearray()
+        self.failed = False
+        self.lost = False
+
+    def handle_connection_made(self, conn):
+        self.conn = conn
+        if self.on_connect:
+            self.on_connect(self)
+
+    def handle_data_received(self, data):
+        self.received += data
+        if self.on_data:
+            self.on_data(self, data)
+
+    def handle_connection_failed(self):
+        self.failed = True
+
+    def handle_connection_lost(self):
+        self.lost = True
+
+
+def test_packet_and_sack_roundtrip():
+    sack = encode_sack(100, [102, 105, 140])
+    assert_equal(len(sack), 8)
+    assert_equal(decode_sack(100, sack), [102, 105, 140])
+    data = encode_packet(utp.ST_DATA, 7, 1, 2, 3, 65535, 100, b'xyz', sack)
+    pkt = decode_packet(data)
+    assert_equal((pkt['type'], pkt['conn_id'], pkt['seq_nr'], pkt['ack_nr']),
+                 (utp.ST_DATA, 7, 65535, 100))
+    assert_equal((pkt['sack'], pkt['payload']), (sack, b'xyz'))
+    assert_raises(utp.UTPPacketError, decode_packet, b'\x01' * 10)
+
+
+def _transfer(loss, delay, size):
+    conn_man = ConnectionManagerSelect()
+    server = LossyManager(conn_man, loss, delay, seed=1)
+    client = LossyManager(conn_man, loss, delay, seed=2)
+    data = random.Random(3).randbytes(size)
+
+    def echo(peer, chunk):
+        peer.conn.write(chunk)
+    server.listen(lambda ip, port: PeerMock(ip, port, on_data=echo))
+
+    def check_done(peer, chunk):
+        if len(peer.received) >= size:
+            conn_man.stop_event_loop()
+    peer = PeerMock(port=server.port, on_data=check_done,
+                    on_connect=lambda peer: peer.conn.write(data))
+    client.connect_peer(peer)
+    timeout = conn_man.call_later(30.0, conn_man.stop_event_loop)
+
+    thread = threading.Thread(target=conn_man.start_event_loop)
+    thread.start()
+    thread.join(40.0)
+    timeout.cancel()
+    return (peer, data, client, server)
+
+
+def test_transfer_over_loopback():
+    (peer, data, client, server) = _transfer(0.0, 0.0, 200000)
+    assert_equal(bytes(peer.received), data)
+
+
+def test_transfer_with_loss_and_delay():
+    (peer, data, client, server) = _transfer(0.1, 0.01, 100000)
+    assert_equal(bytes(peer.received), data)
+
+    # Closing sends a FIN; the other end sees the connection go. The loop
+    # has stopped, so send without the injected delay.
+    for m in (client, server):
+        m.send_datagram = m.sock.sendto
+    (conn,) = [c for c in server.conns.values()]
+    remote_peer = conn.peer
+    peer.conn.disconnect()
+    assert_false(peer.lost)
+    for _ in range(10):
+        client.handle_readable()
+        server.handle_readable()
+        if remote_peer.lost:
+            break
+        threading.Event().wait(0.05)
+    assert_true(remote_peer.lost)
+
+
+class ManagerMock():
+    def __init__(self):
+        self.sent = []
+        self.pending_acks = set()
+        self.removed = []
+
+    def send_datagram(self, data, addr):
+        self.sent.append(decode_packet(data))
+
+    def remove(self, conn):
+        self.removed.append(conn)
+
+
+def test_syn_timeout_fails_connection():
+    peer = PeerMock(port=9)
+    conn = UTPConnection(ManagerMock(), peer, ('127.0.0.1', 9), 1, 2)
+    conn.send_syn()
+    now = conn.last_progress
+    for _ in range(utp.SYN_RETRIES + 1):
+        now += utp.MAX_TIMEOUT
+        conn.check_timeout(now)
+    assert_equal(len(conn.manager.sent), utp.SYN_RETRIES + 1)
+    assert_true(peer.failed)
+    assert_equal(conn.manager.removed, [conn])
+
+
+def test_ledbat_window_follows_queuing_delay():
+    conn = UTPConnection(ManagerMock(), PeerMock(), ('127.0.0.1', 9), 1, 2)
+    conn.update_base_delay(20000)
+    cwnd = conn.cwnd
+    conn.update_cwnd(utp.MSS, 20000)
+    assert_greater(conn.cwnd, cwnd)
+    cwnd = conn.cwnd
+    # Twice the target delay in the queue shrinks the window.
+    conn.update_cwnd(utp.MSS, 20000 + 2 * utp.TARGET_DELAY)
+    assert_less(conn.cwnd, cwnd)
+    for _ in range(100):
+        conn.update_cwnd(utp.MSS, 20000 + 2 * utp.TARGET_DELAY)
+    assert_equal(conn.cwnd, utp.MIN_WINDOW)
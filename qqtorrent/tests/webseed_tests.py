@@ -0,0 +1,138 @@
+import re
+import hashlib
+import threading
+import http.server
+from nose.tools import *
+
+from qqbt import bencode
+from qqbt.conn import ConnectionManagerSelect
+from qqbt.torrent import Torrent
+from qqbt.torrent_metainfo import TorrentMetainfo
+from qqbt.webseed import WebSeedPool, get_file_url
+
+PIECE_LENGTH = 2**15
+FILES = [('a.bin', 40000), ('sub/b c.bin', 50000), ('d.bin', 1000)]
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+def _make_torrent(url_list):
+    data = bytes(i * 7 % 251 for i in range(sum(n for (_, n) in FILES)))
+    pieces = b''.join(hashlib.sha1(data[i:i+PIECE_LENGTH]).digest()
+                      for i in range(0, len(data), PIECE_LENGTH))
+    info = {
+        b'name': b'multi',
+        b'piece length': PIECE_LENGTH,
+        b'pieces': pieces,
+        b'files': [{b'length': n,
+                    b'path': [s.encode() for s in path.split('/')]}
+                   for (path, n) in FILES],
+    }
+    content = {b'announce': b'http://127.0.0.1:9/announce', b'info': info,
+               b'url-list': [u.encode() for u in url_list]}
+    return (TorrentMetainfo(bencode.encode(content)), data)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /seed/multi/<path> with Range support over keep-alive."""
+    protocol_version = 'HTTP/1.1'
+    files = {}
+    requests = []
+    connections = set()
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        self.connections.add(self.client_address)
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        m = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        status = 200
+        if m:
+            status = 206
+            body = body[int(m.group(1)):int(m.group(2)) + 1]
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(data):
+    ofs = 0
+    RangeHandler.files = {}
+    for (path, n) in FILES:
+        url_path = '/seed/multi/' + path.replace(' ', '%20')
+        RangeHandler.files[url_path] = data[ofs:ofs+n]
+        ofs += n
+    RangeHandler.requests = []
+    RangeHandler.connections = set()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_file_urls():
+    (metainfo, data) = _make_torrent([])
+    assert_equal(get_file_url('http://h/seed', metainfo, 1),
+                 'http://h/seed/multi/sub/b%20c.bin')
+    assert_equal(get_file_url('http://h/seed/', metainfo, 0),
+                 'http://h/seed/multi/a.bin')
+    metainfo.info['files'] = None
+    assert_equal(get_file_url('http://h/f.iso', metainfo, 0),
+                 'http://h/f.iso')
+    assert_equal(get_file_url('http://h/dir/', metainfo, 0),
+                 'http://h/dir/multi')
+
+
+def test_malformed_urls_ignored():
+    (metainfo, data) = _make_torrent(['http://h:99999/seed/', 'http://:80/',
+                                      'http://[::1/seed/', 'http://h:x/',
+                                      'https://h:8443/seed/'])
+    assert_equal(metainfo.url_list, ['https://h:8443/seed/'])
+
+
+def test_download_from_web_seed():
+    (metainfo, data) = _make_torrent(['ftp://127.0.0.1/seed/'])
+    assert_equal(metainfo.url_list, [])
+    server = _serve(data)
+    metainfo.url_list = ['http://127.0.0.1:%d/seed/'
+                         % server.server_address[1]]
+
+    conn_man = ConnectionManagerSelect()
+    pool = WebSeedPool(conn_man)
+    result = []
+
+    def on_completed_torrent(torrent, data):
+        result.append(data)
+        conn_man.stop_event_loop()
+    t = Torrent(conn_man, metainfo, on_completed_torrent, web_seeds=pool)
+    assert_equal(len(t.web_seeds), 4)
+    assert_equal(t.get_num_active_peers(), 0)
+    t.is_running = True
+    for p in t.web_seeds:
+        p.connect()
+    timeout = conn_man.call_later(10.0, conn_man.stop_event_loop)
+    conn_man.start_event_loop()
+    timeout.cancel()
+    pool.close()
+    server.shutdown()
+    server.server_close()
+
+    assert_equal(result, [data])
+    # Piece 1 spans a.bin and sub/b c.bin: one range request each.
+    assert_in(('/seed/multi/a.bin', 'bytes=32768-39999'),
+              RangeHandler.requests)
+    assert_in(('/seed/multi/sub/b%20c.bin', 'bytes=0-25535'),
+              RangeHandler.requests)
+    # Requests reuse pooled connections.
+    assert_less(len(RangeHandler.connections), len(RangeHandler.requests))
@@ -0,0 +1,60 @@
+from nose.tools import *
+
+from qqbt.workers import WorkerPool, ShardedTorrent
+from tests.mocks import MetainfoMock
+
+
+def setup():
+    pass
+
+
+def teardown():
+    pass
+
+
+class ClientMock():
+    def __init__(self):
+        self.events = []
+
+    def on_completed_piece(self, torrent, piece_index):
+        self.events.append(('piece', torrent, piece_index))
+
+    def on_completed_torrent(self, torrent, data):
+        self.events.append(('completed', torrent))
+
+    def on_failed_torrent(self, torrent):
+        self.events.append(('failed', torrent))
+
+
+def test_worker_pool_choose_worker():
+    pool = WorkerPool(3, ClientMock())
+    home = pool._choose_worker(b'\x00\x00\x00\x04' + bytes(16))
+    assert_equal(home.index, 1)
+
+    # The home worker is used until it is busier than the least loaded one.
+    for _ in range(2):
+        home.torrents.add(object())
+    assert_equal(pool._choose_worker(b'\x00\x00\x00\x04' + bytes(16)).index,
+                 0)
+    pool.workers[0].torrents.add(object())
+    pool.workers[2].torrents.add(object())
+    assert_equal(pool._choose_worker(b'\x00\x00\x00\x04' + bytes(16)).index,
+                 1)
+
+
+def test_worker_pool_relays_messages():
+    client = ClientMock()
+    pool = WorkerPool(1, client)
+    worker = pool.workers[0]
+    metainfo = MetainfoMock(4, info_hash=b'\x01' * 20)
+    torrent = ShardedTorrent(metainfo, worker)
+    pool.torrents[metainfo.info_hash] = torrent
+    worker.torrents.add(torrent)
+
+    pool.handle_message(worker, ('progress', metainfo.info_hash, 2, 1))
+    assert_equal(torrent.get_progress_string(), '1 / 4 (25.0%) complete')
+    pool.handle_message(worker, ('completed', metainfo.info_hash))
+    assert_true(torrent.is_complete)
+    assert_equal(worker.load(), 0)
+    assert_equal(client.events,
+                 [('piece', torrent, 2), ('completed', torrent)])